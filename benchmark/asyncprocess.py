@@ -0,0 +1,154 @@
+#!/usr/bin/env python
+##
+# Copyright 2012 Ghent University
+# Copyright 2012 Stijn De Weirdt
+#
+# This file is part of VSC-tools,
+# originally created by the HPC team of Ghent University (http://ugent.be/hpc/en),
+# with support of Ghent University (http://ugent.be/hpc),
+# the Flemish Supercomputer Centre (VSC) (https://vscentrum.be/nl/en),
+# the Hercules foundation (http://www.herculesstichting.be/in_English)
+# and the Department of Economy, Science and Innovation (EWI) (http://www.ewi-vlaanderen.be/en).
+#
+# http://github.com/hpcugent/VSC-tools
+#
+# VSC-tools is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation v2.
+#
+# VSC-tools is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with VSC-tools. If not, see <http://www.gnu.org/licenses/>.
+##
+"""
+Microbenchmark for the read throughput of vsc.utils.asyncprocess
+
+Reads the output of 'cat /dev/zero | head -c SIZE' with
+ - legacy: the previous recv_some (fcntl toggles per read, select with timeout 0 and sleeps)
+ - recv_some: the current recv_some
+ - recv_into: reads into a single preallocated buffer, no strings are created
+
+usage: python benchmark/asyncprocess.py [-s size_in_MB] [-m maxread]
+"""
+from optparse import OptionParser
+import fcntl
+import os
+import resource
+import select
+import subprocess
+import time
+
+from vsc.utils import asyncprocess
+
+
+def legacy_recv(p, maxsize):
+    """The previous Popen._recv"""
+    conn = p.stdout
+    if conn is None:
+        return None
+    flags = fcntl.fcntl(conn, fcntl.F_GETFL)
+    if not conn.closed:
+        fcntl.fcntl(conn, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+    try:
+        if not select.select([conn], [], [], 0)[0]:
+            return ''
+        r = conn.read(maxsize)
+        if not r:
+            conn.close()
+            p.stdout = None
+            return None
+        return r
+    finally:
+        if not conn.closed:
+            fcntl.fcntl(conn, fcntl.F_SETFL, flags)
+
+
+def legacy_recv_some(p, t=.1, tr=5, maxread=-1):
+    """The previous recv_some"""
+    x = time.time() + t
+    y = []
+    len_y = 0
+    r = ''
+    while (maxread < 0 or len_y <= maxread) and (time.time() < x or r):
+        r = legacy_recv(p, maxread)
+        if r is None:
+            break
+        elif r:
+            y.append(r)
+            len_y += len(r)
+        else:
+            time.sleep(max((x - time.time()) / tr, 0))
+    return ''.join(y)
+
+
+def read_legacy(cmd, maxread):
+    p = subprocess.Popen(cmd, shell=True, stdout=subprocess.PIPE, stdin=subprocess.PIPE)
+    total = 0
+    while p.stdout is not None:
+        total += len(legacy_recv_some(p, maxread=maxread))
+    p.wait()
+    return total
+
+
+def read_recv_some(cmd, maxread):
+    p = asyncprocess.Popen(cmd, shell=True, stdout=asyncprocess.PIPE, stdin=asyncprocess.PIPE)
+    total = 0
+    while p.stdout is not None:
+        total += len(asyncprocess.recv_some(p, maxread=maxread))
+    p.wait()
+    return total
+
+
+def read_recv_into(cmd, maxread):
+    p = asyncprocess.Popen(cmd, shell=True, stdout=asyncprocess.PIPE, stdin=asyncprocess.PIPE)
+    view = memoryview(p.recv_buffer)
+    if maxread > 0:
+        view = view[:maxread]
+    total = 0
+    while True:
+        nbytes = p.recv_into(view, timeout=None)
+        if nbytes is None:
+            break
+        total += nbytes
+    p.wait()
+    return total
+
+
+def cputime():
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return usage.ru_utime + usage.ru_stime
+
+
+def main():
+    parser = OptionParser()
+    parser.add_option("-s", "--size", type="int", default=1024, help="Size in MB [default: %default]")
+    parser.add_option("-m", "--maxread", type="int", default=-1,
+                      help="maxread for each read, -1 for the default buffer [default: %default]")
+    parser.add_option("--skip-legacy", action="store_true", default=False, help="Skip the legacy read")
+    (options, _) = parser.parse_args()
+
+    size = options.size * 1024 * 1024
+    cmd = "cat /dev/zero 2>/dev/null | head -c %s" % size
+
+    methods = [('recv_some', read_recv_some), ('recv_into', read_recv_into)]
+    if not options.skip_legacy:
+        methods.insert(0, ('legacy', read_legacy))
+
+    print "%-10s %10s %10s %10s" % ('method', 'wall (s)', 'cpu (s)', 'MB/s')
+    for name, method in methods:
+        start = time.time()
+        start_cpu = cputime()
+        total = method(cmd, options.maxread)
+        wall = time.time() - start
+        cpu = cputime() - start_cpu
+        if total != size:
+            raise Exception("%s read %s bytes, expected %s" % (name, total, size))
+        print "%-10s %10.3f %10.3f %10.1f" % (name, wall, cpu, options.size / wall)
+
+
+if __name__ == '__main__':
+    main()
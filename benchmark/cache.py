@@ -0,0 +1,105 @@
+#!/usr/bin/env python
+##
+# Copyright 2012 Ghent University
+# Copyright 2012 Stijn De Weirdt
+#
+# This file is part of VSC-tools,
+# originally created by the HPC team of Ghent University (http://ugent.be/hpc/en),
+# with support of Ghent University (http://ugent.be/hpc),
+# the Flemish Supercomputer Centre (VSC) (https://vscentrum.be/nl/en),
+# the Hercules foundation (http://www.herculesstichting.be/in_English)
+# and the Department of Economy, Science and Innovation (EWI) (http://www.ewi-vlaanderen.be/en).
+#
+# http://github.com/hpcugent/VSC-tools
+#
+# VSC-tools is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation v2.
+#
+# VSC-tools is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with VSC-tools. If not, see <http://www.gnu.org/licenses/>.
+##
+"""
+Benchmark the FileCache serializers: time to write (close) and to read (open)
+a cache with a number of entries, and the size of the file.
+
+usage: python benchmark/cache.py [-n number[,number...]] [-s serializer[,serializer...]]
+"""
+from optparse import OptionParser
+import os
+import shutil
+import tempfile
+import time
+
+from vsc import fancylogger
+from vsc.utils.cache import FileCache, SERIALIZER_NAMES, get_serializer
+
+
+def payload(number):
+    """number entries of the kind of data that is cached: dictionaries of strings and numbers"""
+    now = time.time()
+    data = {}
+    for idx in xrange(number):
+        data['node%06d' % idx] = (now, {
+            'state': 'free',
+            'jobs': ['%d.master' % job for job in xrange(idx % 4)],
+            'np': 16,
+            'load': idx * 0.01,
+            'properties': 'ib,harpertown',
+        })
+    return data
+
+
+def bench(filename, data, serializer):
+    """Return the write and read time and the size of the file"""
+    cache = FileCache(filename, serializer=serializer)
+    cache.new_shelf = data
+    start = time.time()
+    cache.close()
+    write = time.time() - start
+    size = os.stat(filename).st_size
+
+    start = time.time()
+    cache = FileCache(filename)
+    read = time.time() - start
+    if len(cache.shelf) != len(data):
+        raise Exception("read %s entries, expected %s" % (len(cache.shelf), len(data)))
+    os.unlink(filename)
+    return write, read, size
+
+
+def main():
+    parser = OptionParser()
+    parser.add_option("-n", "--number", default="1000,100000,1000000",
+                      help="Comma-separated numbers of entries [default: %default]")
+    parser.add_option("-s", "--serializer", default="default,%s" % ','.join(sorted(SERIALIZER_NAMES)),
+                      help="Comma-separated serializers, default is the headerless pickle [default: %default]")
+    (options, _) = parser.parse_args()
+
+    ## a new cache logs an error for the missing file
+    fancylogger.setLogLevel('CRITICAL')
+
+    tmpdir = tempfile.mkdtemp()
+    filename = os.path.join(tmpdir, 'cache')
+
+    print "%-10s %9s %10s %10s %12s" % ('serializer', 'entries', 'write (s)', 'read (s)', 'size (kB)')
+    for number in [int(x) for x in options.number.split(',')]:
+        data = payload(number)
+        for name in options.serializer.split(','):
+            if name == 'default':
+                serializer = None
+            else:
+                serializer = get_serializer(name)
+            write, read, size = bench(filename, data, serializer)
+            print "%-10s %9d %10.3f %10.3f %12d" % (name, number, write, read, size / 1024)
+
+    shutil.rmtree(tmpdir)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,81 @@
+#!/usr/bin/env python
+##
+# Copyright 2012 Ghent University
+# Copyright 2012 Stijn De Weirdt
+#
+# This file is part of VSC-tools,
+# originally created by the HPC team of Ghent University (http://ugent.be/hpc/en),
+# with support of Ghent University (http://ugent.be/hpc),
+# the Flemish Supercomputer Centre (VSC) (https://vscentrum.be/nl/en),
+# the Hercules foundation (http://www.herculesstichting.be/in_English)
+# and the Department of Economy, Science and Innovation (EWI) (http://www.ewi-vlaanderen.be/en).
+#
+# http://github.com/hpcugent/VSC-tools
+#
+# VSC-tools is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation v2.
+#
+# VSC-tools is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with VSC-tools. If not, see <http://www.gnu.org/licenses/>.
+##
+"""
+Benchmark creating objects that call fancylogger.getLogger in their constructor (cpu_set_t),
+with the root module name from inspect.stack() on every call (as before), and cached.
+
+usage: python benchmark/getlogger.py [-n number] [-d depth]
+"""
+from optparse import OptionParser
+import inspect
+import time
+
+from vsc import fancylogger
+from vsc.utils.affinity import cpu_set_t
+
+
+def _getRootModuleName_inspect():
+    """The previous implementation: inspect.stack() reads the source of every frame"""
+    try:
+        return inspect.stack()[-1][1].split('/')[-1].split('.')[0]
+    except Exception:
+        return None
+
+
+def create(number, depth):
+    """Create number cpu_set_t instances, depth frames deep; return the time it took"""
+    if depth > 0:
+        return create(number, depth - 1)
+    start = time.time()
+    for _ in xrange(number):
+        cpu_set_t()
+    return time.time() - start
+
+
+def main():
+    parser = OptionParser()
+    parser.add_option("-n", "--number", type="int", default=100000, help="Number of objects [default: %default]")
+    parser.add_option("-d", "--depth", type="int", default=20, help="Depth of the stack [default: %default]")
+    (options, _) = parser.parse_args()
+
+    cached = fancylogger._getRootModuleName
+    modes = [
+        ('inspect.stack', _getRootModuleName_inspect),
+        ('cached', cached),
+    ]
+
+    print "%-16s %10s %6s %10s %12s" % ('root module', 'objects', 'depth', 'time (s)', 'objects/s')
+    for (name, func) in modes:
+        fancylogger._getRootModuleName = func
+        elapsed = create(options.number, options.depth)
+        print "%-16s %10d %6d %10.3f %12.0f" % (name, options.number, options.depth, elapsed,
+                                               options.number / elapsed)
+    fancylogger._getRootModuleName = cached
+
+
+if __name__ == '__main__':
+    main()
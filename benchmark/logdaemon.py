@@ -0,0 +1,183 @@
+#!/usr/bin/env python
+##
+# Copyright 2012 Ghent University
+# Copyright 2012 Stijn De Weirdt
+#
+# This file is part of VSC-tools,
+# originally created by the HPC team of Ghent University (http://ugent.be/hpc/en),
+# with support of Ghent University (http://ugent.be/hpc),
+# the Flemish Supercomputer Centre (VSC) (https://vscentrum.be/nl/en),
+# the Hercules foundation (http://www.herculesstichting.be/in_English)
+# and the Department of Economy, Science and Innovation (EWI) (http://www.ewi-vlaanderen.be/en).
+#
+# http://github.com/hpcugent/VSC-tools
+#
+# VSC-tools is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation v2.
+#
+# VSC-tools is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with VSC-tools. If not, see <http://www.gnu.org/licenses/>.
+##
+"""
+Load generator for the log daemon: a number of processes log to the daemon over UDP,
+plain (DatagramHandler) or batched (BatchedDatagramHandler), and the records written are counted for
+    - the classic loop of bin/logdaemon.py (one recvfrom and logger.handle per datagram)
+    - the LogServer of bin/logdaemon.py --fast (batched receive, writer thread, buffered writes)
+or, with --tcp, the processes log over tcp connections (BatchedStreamHandler) to
+    - the StreamLogServer of bin/logdaemon.py --tcp
+
+usage: python benchmark/logdaemon.py [-p processes] [-n records] [-s size] [-b] [--tcp]
+"""
+from optparse import OptionParser
+import logging
+import logging.handlers
+import os
+import shutil
+import signal
+import socket
+import tempfile
+import time
+
+from vsc import fancylogger
+from vsc.fancylogger import BatchedDatagramDecoder, BatchedDatagramHandler, BatchedStreamHandler
+from vsc.utils.logserver import LogServer, StreamLogServer
+
+## time without new records after which the daemon is assumed done
+IDLE = 1.0
+
+
+def classic(sock, logfile):
+    """The classic logdaemon loop"""
+    fancylogger.logToScreen(False)
+    fancylogger.setLogLevel(0)
+    fancylogger.logToFile(logfile)
+    logger = fancylogger.getLogger()
+    decoder = BatchedDatagramDecoder()
+    while True:
+        message, address = sock.recvfrom(LogServer.MAX_DATAGRAM)
+        for unpickled in decoder.decode(message, address):
+            logger.handle(logging.makeLogRecord(unpickled))
+
+
+def fast(sock, logfile):
+    """The LogServer, reporting its counters on SIGTERM"""
+    server = LogServer(sock, logfile)
+    signal.signal(signal.SIGTERM, lambda signum, frame: server.stop())
+    server.serve()
+    print "    %s" % server.stats_line()
+
+
+def stream(sock, logfile):
+    """The StreamLogServer, reporting its counters on SIGTERM"""
+    server = StreamLogServer(sock, logfile)
+    signal.signal(signal.SIGTERM, lambda signum, frame: server.stop())
+    server.serve()
+    print "    %s" % server.stats_line()
+
+
+def send(port, records, size, batched, tcp):
+    """Log records records of size bytes to the daemon"""
+    if tcp:
+        handler = BatchedStreamHandler('127.0.0.1', port)
+    elif batched:
+        handler = BatchedDatagramHandler('127.0.0.1', port)
+    else:
+        handler = logging.handlers.DatagramHandler('127.0.0.1', port)
+    logger = fancylogger.getLogger('bench_%s' % os.getpid())
+    logger.propagate = False
+    logger.handlers = [handler]
+    logger.setLevel(logging.INFO)
+    message = 'x' * size
+    for _ in xrange(records):
+        logger.info(message)
+    handler.close()
+
+
+def lines(filename):
+    """Return the number of lines in filename"""
+    if not os.path.exists(filename):
+        return 0
+    fh = open(filename)
+    count = sum([chunk.count('\n') for chunk in iter(lambda: fh.read(1 << 20), '')])
+    fh.close()
+    return count
+
+
+def bench(daemon, options, tmpdir):
+    """Run the daemon and the senders, return (records written, seconds)"""
+    logfile = os.path.join(tmpdir, "%s.log" % daemon.__name__)
+    if options.tcp:
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    else:
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+
+    pid = os.fork()
+    if pid == 0:
+        try:
+            daemon(sock, logfile)
+        finally:
+            os._exit(0)
+    sock.close()
+
+    start = time.time()
+    senders = []
+    for _ in range(options.processes):
+        sender = os.fork()
+        if sender == 0:
+            try:
+                send(port, options.records, options.size, options.batched, options.tcp)
+            finally:
+                os._exit(0)
+        senders.append(sender)
+    for sender in senders:
+        os.waitpid(sender, 0)
+
+    ## wait until the daemon has written everything (the size of the file does not change anymore)
+    (size, last) = (-1, time.time())
+    while time.time() - last < IDLE:
+        time.sleep(0.1)
+        if os.path.exists(logfile) and os.path.getsize(logfile) != size:
+            (size, last) = (os.path.getsize(logfile), time.time())
+    os.kill(pid, signal.SIGTERM)
+    os.waitpid(pid, 0)
+    return (lines(logfile), last - start)
+
+
+def main():
+    parser = OptionParser()
+    parser.add_option("-p", "--processes", type="int", default=4, help="Number of senders [default: %default]")
+    parser.add_option("-n", "--records", type="int", default=50000,
+                      help="Number of records per sender [default: %default]")
+    parser.add_option("-s", "--size", type="int", default=100, help="Size of the messages [default: %default]")
+    parser.add_option("-b", "--batched", action="store_true", default=False,
+                      help="Send with the BatchedDatagramHandler [default: %default]")
+    parser.add_option("--tcp", action="store_true", default=False,
+                      help="Send over tcp with the BatchedStreamHandler [default: %default]")
+    (options, _) = parser.parse_args()
+
+    tmpdir = tempfile.mkdtemp()
+    total = options.processes * options.records
+    try:
+        if options.tcp:
+            (transport, daemons) = ('tcp', [stream])
+        else:
+            (transport, daemons) = (['plain', 'batched'][options.batched], [classic, fast])
+        print "%s senders, %s records of %s bytes, %s" % (options.processes, total, options.size, transport)
+        print "%-10s %12s %12s %12s" % ('daemon', 'written', 'dropped', 'records/s')
+        for daemon in daemons:
+            (written, seconds) = bench(daemon, options, tmpdir)
+            print "%-10s %12d %12d %12.0f" % (daemon.__name__, written, total - written, written / seconds)
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+if __name__ == '__main__':
+    main()
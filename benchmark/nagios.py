@@ -0,0 +1,119 @@
+#!/usr/bin/env python
+##
+# Copyright 2012 Ghent University
+# Copyright 2012 Stijn De Weirdt
+#
+# This file is part of VSC-tools,
+# originally created by the HPC team of Ghent University (http://ugent.be/hpc/en),
+# with support of Ghent University (http://ugent.be/hpc),
+# the Flemish Supercomputer Centre (VSC) (https://vscentrum.be/nl/en),
+# the Hercules foundation (http://www.herculesstichting.be/in_English)
+# and the Department of Economy, Science and Innovation (EWI) (http://www.ewi-vlaanderen.be/en).
+#
+# http://github.com/hpcugent/VSC-tools
+#
+# VSC-tools is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation v2.
+#
+# VSC-tools is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with VSC-tools. If not, see <http://www.gnu.org/licenses/>.
+##
+"""
+Benchmark the nagios checks served from the NagiosReporter cache file:
+    - a script calling NagiosReporter.report_and_exit (interpreter start, vsc imports, unpickle)
+    - the nagiosdaemon.py client asking the resident NagiosResultServer
+    - the requests to the server only (no process per check)
+
+usage: python benchmark/nagios.py [-n number]
+"""
+from optparse import OptionParser
+import os
+import pwd
+import shutil
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+from vsc import fancylogger
+from vsc.utils.nagios import NagiosReporter, NagiosResultServer, NAGIOS_EXIT_OK
+
+CLIENT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'bin', 'nagiosdaemon.py')
+REPORT = "from vsc.utils.nagios import NagiosReporter; NagiosReporter('bench', '%s', 60).report_and_exit()"
+
+
+def bench_cmd(cmd, number):
+    """Run cmd number times, return checks per second"""
+    start = time.time()
+    for _ in xrange(number):
+        proc = subprocess.Popen(cmd, stdout=subprocess.PIPE)
+        output = proc.communicate()[0]
+        if proc.returncode != NAGIOS_EXIT_OK[0]:
+            raise Exception("cmd %s failed with exitcode %s: %s" % (cmd, proc.returncode, output))
+    return number / (time.time() - start)
+
+
+def bench_socket(socket_path, number):
+    """Send number requests to the server, return requests per second"""
+    start = time.time()
+    for _ in xrange(number):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.connect(socket_path)
+        sock.sendall("bench\n")
+        while sock.recv(4096):
+            pass
+        sock.close()
+    return number / (time.time() - start)
+
+
+def main():
+    parser = OptionParser()
+    parser.add_option("-n", "--number", type="int", default=200, help="Number of checks [default: %default]")
+    (options, _) = parser.parse_args()
+
+    ## a new cache logs an error for the missing file
+    fancylogger.setLogLevel('CRITICAL')
+
+    tmpdir = tempfile.mkdtemp()
+    filename = os.path.join(tmpdir, 'cache')
+    socket_path = os.path.join(tmpdir, 'socket')
+    reporter = NagiosReporter('bench', filename, 60, pwd.getpwuid(os.getuid()).pw_name)
+    reporter.cache(NAGIOS_EXIT_OK, 'all is well')
+
+    server = NagiosResultServer(socket_path, {'bench': reporter}, os.path.join(tmpdir, 'pid'))
+    server.bind()
+    pid = os.fork()
+    if pid == 0:
+        try:
+            server.run()
+        finally:
+            os._exit(0)
+    server.socket_.close()
+
+    modes = [
+        ('report_and_exit script', lambda: bench_cmd([sys.executable, '-c', REPORT % filename], options.number)),
+        ('nagiosdaemon.py check', lambda: bench_cmd([sys.executable, CLIENT, 'check', 'bench', socket_path],
+                                                    options.number)),
+        ('server requests', lambda: bench_socket(socket_path, options.number * 10)),
+    ]
+
+    try:
+        print "%-24s %12s" % ('mode', 'checks/s')
+        for name, func in modes:
+            print "%-24s %12.1f" % (name, func())
+    finally:
+        os.kill(pid, signal.SIGTERM)
+        os.waitpid(pid, 0)
+        shutil.rmtree(tmpdir)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,95 @@
+#!/usr/bin/env python
+##
+# Copyright 2012 Ghent University
+# Copyright 2012 Stijn De Weirdt
+#
+# This file is part of VSC-tools,
+# originally created by the HPC team of Ghent University (http://ugent.be/hpc/en),
+# with support of Ghent University (http://ugent.be/hpc),
+# the Flemish Supercomputer Centre (VSC) (https://vscentrum.be/nl/en),
+# the Hercules foundation (http://www.herculesstichting.be/in_English)
+# and the Department of Economy, Science and Innovation (EWI) (http://www.ewi-vlaanderen.be/en).
+#
+# http://github.com/hpcugent/VSC-tools
+#
+# VSC-tools is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation v2.
+#
+# VSC-tools is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with VSC-tools. If not, see <http://www.gnu.org/licenses/>.
+##
+"""
+Benchmark the threshold evaluation and perfdata rendering of many metrics (eg a quota check):
+    - per metric: NagiosRange.alert for each value and a NagiosResult with all metrics
+    - batch_perfdata in pure Python
+    - batch_perfdata with NumPy (if it is available)
+
+usage: python benchmark/perfdata.py [-n number]
+"""
+from optparse import OptionParser
+import random
+import time
+
+from vsc import fancylogger
+from vsc.utils.nagios import NagiosRange, NagiosResult, batch_perfdata, numpy
+
+WARNING = '~:80'
+CRITICAL = '~:95'
+
+
+def per_metric(labels, values):
+    """Evaluate and render one metric at a time"""
+    warning = NagiosRange(WARNING)
+    critical = NagiosRange(CRITICAL)
+    worst = 0
+    result = NagiosResult('quota')
+    for (label, value) in zip(labels, values):
+        if critical.alert(value):
+            worst = 2
+        elif warning.alert(value):
+            worst = max(worst, 1)
+        setattr(result, label, value)
+        setattr(result, "%s_warning" % label, WARNING)
+        setattr(result, "%s_critical" % label, CRITICAL)
+    return (worst, str(result))
+
+
+def bench(func, number):
+    """Return the time to evaluate number metrics with func"""
+    labels = ['user%06d' % idx for idx in xrange(number)]
+    values = [random.randint(0, 100) for _ in xrange(number)]
+    start = time.time()
+    func(labels, values)
+    return time.time() - start
+
+
+def main():
+    parser = OptionParser()
+    parser.add_option("-n", "--number", type="int", default=100000, help="Number of metrics [default: %default]")
+    (options, _) = parser.parse_args()
+
+    fancylogger.setLogLevelWarning()
+
+    modes = [
+        ('per metric', per_metric),
+        ('batch_perfdata python', lambda l, v: batch_perfdata(l, v, WARNING, CRITICAL, '%', use_numpy=False)),
+    ]
+    if numpy is not None:
+        modes.append(('batch_perfdata numpy', lambda l, v: batch_perfdata(l, v, WARNING, CRITICAL, '%',
+                                                                           use_numpy=True)))
+    else:
+        print "NumPy is not available"
+
+    print "%-24s %10s %10s" % ('mode', 'metrics', 'time (s)')
+    for (name, func) in modes:
+        print "%-24s %10d %10.3f" % (name, options.number, bench(func, options.number))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,75 @@
+#!/usr/bin/env python
+##
+# Copyright 2012 Ghent University
+# Copyright 2012 Stijn De Weirdt
+#
+# This file is part of VSC-tools,
+# originally created by the HPC team of Ghent University (http://ugent.be/hpc/en),
+# with support of Ghent University (http://ugent.be/hpc),
+# the Flemish Supercomputer Centre (VSC) (https://vscentrum.be/nl/en),
+# the Hercules foundation (http://www.herculesstichting.be/in_English)
+# and the Department of Economy, Science and Innovation (EWI) (http://www.ewi-vlaanderen.be/en).
+#
+# http://github.com/hpcugent/VSC-tools
+#
+# VSC-tools is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation v2.
+#
+# VSC-tools is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with VSC-tools. If not, see <http://www.gnu.org/licenses/>.
+##
+"""
+Benchmark the event driven RunLoop against the timed (sleeping) loop
+by running many tiny commands.
+
+usage: python benchmark/runloop.py [-n number] [-c cmd] [--skip-timed]
+
+The timed loop costs at least LOOP_TIMEOUT_INIT per command, so for large -n
+the timed run can take a while (use --skip-timed).
+"""
+from optparse import OptionParser
+import time
+
+from vsc import fancylogger
+from vsc.utils.run import RunLoop, RunAsyncLoop
+
+
+def bench(klass, cmd, number, loop_event):
+    """Run cmd number times, return total time"""
+    start = time.time()
+    for _ in xrange(number):
+        ec, _ = klass.run(cmd, loop_event=loop_event)
+        if ec != 0:
+            raise Exception("cmd %s failed with exitcode %s" % (cmd, ec))
+    return time.time() - start
+
+
+def main():
+    parser = OptionParser()
+    parser.add_option("-n", "--number", type="int", default=2000, help="Number of commands [default: %default]")
+    parser.add_option("-c", "--cmd", default="true", help="Command to run [default: %default]")
+    parser.add_option("--skip-timed", action="store_true", default=False, help="Skip the timed loop")
+    (options, _) = parser.parse_args()
+
+    fancylogger.setLogLevelWarning()
+
+    modes = [('event', True)]
+    if not options.skip_timed:
+        modes.append(('timed', False))
+
+    print "%-14s %-6s %8s %10s %10s" % ('class', 'mode', 'number', 'total (s)', 'per cmd (ms)')
+    for klass in [RunLoop, RunAsyncLoop]:
+        for name, loop_event in modes:
+            total = bench(klass, options.cmd, options.number, loop_event)
+            print "%-14s %-6s %8d %10.3f %10.3f" % (klass.__name__, name, options.number, total,
+                                                    1000.0 * total / options.number)
+
+
+if __name__ == '__main__':
+    main()
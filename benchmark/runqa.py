@@ -0,0 +1,86 @@
+#!/usr/bin/env python
+##
+# Copyright 2012 Ghent University
+# Copyright 2012 Stijn De Weirdt
+#
+# This file is part of VSC-tools,
+# originally created by the HPC team of Ghent University (http://ugent.be/hpc/en),
+# with support of Ghent University (http://ugent.be/hpc),
+# the Flemish Supercomputer Centre (VSC) (https://vscentrum.be/nl/en),
+# the Hercules foundation (http://www.herculesstichting.be/in_English)
+# and the Department of Economy, Science and Innovation (EWI) (http://www.ewi-vlaanderen.be/en).
+#
+# http://github.com/hpcugent/VSC-tools
+#
+# VSC-tools is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation v2.
+#
+# VSC-tools is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with VSC-tools. If not, see <http://www.gnu.org/licenses/>.
+##
+"""
+Benchmark the incremental question matching of RunQA.
+
+A command prints a number of MB of output, with a question after every MB,
+and RunQA has to answer them with many (default 10k) known questions.
+The time per MB should be constant (linear behaviour), independent of the total output size.
+
+usage: python benchmark/runqa.py [-q questions] [-s sizes]
+"""
+from optparse import OptionParser
+import time
+
+from vsc import fancylogger
+from vsc.utils.run import RunQA
+
+
+def make_qa(number):
+    """Return qa dict with number questions"""
+    qa = {}
+    for idx in xrange(number):
+        qa["Question number %s of %s, enter value for item_%s?" % (idx, number, idx)] = "answer_%s" % idx
+    return {'qa': qa}
+
+
+def make_cmd(size, number):
+    """Command that prints size MB, with a question after each MB"""
+    parts = []
+    for mb in xrange(size):
+        idx = (mb * 7919) % number
+        parts.append("yes 'some filler output line' | head -c %s" % (1024 * 1024))
+        parts.append("echo -n 'Question number %s of %s, enter value for item_%s? '" % (idx, number, idx))
+        parts.append("read answer; echo \"got $answer\"")
+    return "; ".join(parts)
+
+
+def main():
+    parser = OptionParser()
+    parser.add_option("-q", "--questions", type="int", default=10000, help="Number of questions [default: %default]")
+    parser.add_option("-s", "--sizes", default="1,2,4,8", help="Comma separated output sizes in MB [default: %default]")
+    (options, _) = parser.parse_args()
+
+    fancylogger.setLogLevelWarning()
+
+    qa = make_qa(options.questions)
+    start = time.time()
+    RunQA('true', qa=qa)
+    print "init with %s questions: %.3f s" % (options.questions, time.time() - start)
+
+    print "%8s %10s %10s %8s" % ('size MB', 'total (s)', 's per MB', 'answers')
+    for size in [int(x) for x in options.sizes.split(',')]:
+        start = time.time()
+        ec, out = RunQA.run(make_cmd(size, options.questions), qa=qa)
+        total = time.time() - start
+        if ec != 0:
+            raise Exception("RunQA failed with exitcode %s" % ec)
+        print "%8d %10.3f %10.3f %8d" % (size, total, total / size, out.count('got answer_'))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,90 @@
+#!/usr/bin/env python
+##
+# Copyright 2012 Ghent University
+# Copyright 2012 Stijn De Weirdt
+#
+# This file is part of VSC-tools,
+# originally created by the HPC team of Ghent University (http://ugent.be/hpc/en),
+# with support of Ghent University (http://ugent.be/hpc),
+# the Flemish Supercomputer Centre (VSC) (https://vscentrum.be/nl/en),
+# the Hercules foundation (http://www.herculesstichting.be/in_English)
+# and the Department of Economy, Science and Innovation (EWI) (http://www.ewi-vlaanderen.be/en).
+#
+# http://github.com/hpcugent/VSC-tools
+#
+# VSC-tools is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation v2.
+#
+# VSC-tools is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with VSC-tools. If not, see <http://www.gnu.org/licenses/>.
+##
+"""
+Benchmark spawning processes from a parent with a large RSS:
+the shell mode (subprocess, /bin/bash, close_fds=True) against the
+shell-free argv mode (posix_spawn from vsc.utils.spawn).
+
+usage: python benchmark/spawn.py [-n number] [-r rss in MB] [-c cmd]
+
+fork() copies the page tables of the parent, so its cost grows with the RSS;
+posix_spawn (vfork semantics) does not.
+"""
+from optparse import OptionParser
+import subprocess
+import time
+
+from vsc import fancylogger
+from vsc.utils.run import Run
+
+
+def bench(cmd, number, **kwargs):
+    """Run cmd number times, return spawns per second"""
+    start = time.time()
+    for _ in xrange(number):
+        ec, _ = Run.run(cmd, **kwargs)
+        if ec != 0:
+            raise Exception("cmd %s failed with exitcode %s" % (cmd, ec))
+    return number / (time.time() - start)
+
+
+def bench_subprocess(cmd, number):
+    """Plain subprocess argv without close_fds as reference"""
+    start = time.time()
+    for _ in xrange(number):
+        subprocess.call(cmd.split())
+    return number / (time.time() - start)
+
+
+def main():
+    parser = OptionParser()
+    parser.add_option("-n", "--number", type="int", default=500, help="Number of commands [default: %default]")
+    parser.add_option("-r", "--rss", type="int", default=2048, help="RSS of the parent in MB [default: %default]")
+    parser.add_option("-c", "--cmd", default="true", help="Command to run [default: %default]")
+    (options, _) = parser.parse_args()
+
+    fancylogger.setLogLevelWarning()
+
+    ## touch every page, so it is really resident
+    ballast = bytearray(options.rss * 1024 * 1024)
+    for idx in xrange(0, len(ballast), 4096):
+        ballast[idx] = 1
+
+    modes = [
+        ('Run shell (fork)', lambda: bench(options.cmd, options.number, disable_log=True)),
+        ('Run argv (posix_spawn)', lambda: bench(options.cmd, options.number, shell=False, disable_log=True)),
+        ('subprocess.call (fork)', lambda: bench_subprocess(options.cmd, options.number)),
+    ]
+
+    print "parent RSS %s MB" % options.rss
+    print "%-24s %8s %12s" % ('mode', 'number', 'spawns/s')
+    for name, func in modes:
+        print "%-24s %8d %12.1f" % (name, options.number, func())
+
+
+if __name__ == '__main__':
+    main()
@@ -32,14 +32,24 @@ with it's pidfile written to $TMPDIR/logdaemon.pid
 
 For an example of how to use this, see startlogdaemon.sh
 
+With --fast, the records are received in batches and written buffered by a separate thread
+(see vsc.utils.logserver); --split writes one file per source host or MPI rank.
+Send SIGUSR1 to the daemon to write its counters to logging_error.log.
+
+With --tcp or --unix, the daemon listens for the connections of fancylogger.logToTCP or
+logToUnixSocket (set FANCYLOG_SERVER_TRANSPORT as printed for the clients): nothing is lost
+when the daemon falls behind, the clients wait instead.
+
 then use mpi to get these environment variables to the clients.
 """
 from optparse import OptionParser
 from vsc import fancylogger
+from vsc.fancylogger import BatchedDatagramDecoder
 from vsc.utils.daemon import Daemon
+from vsc.utils.logserver import LogServer, StreamLogServer
 import logging
 import os
-import pickle
+import signal
 import socket
 import sys
 import traceback
@@ -49,10 +59,16 @@ class LogDaemon(Daemon):
     This is the logging daemon, it get a logger and can log to a local file.
     It can start running in the background and log incoming udp packets
     to the created logger.
+
+    The packets are records of a DatagramHandler, or batches of records of
+    a BatchedDatagramHandler (fancylogger.logToUDP with batched=True).
     """
+    ## maximum size of an UDP datagram
+    MAX_DATAGRAM = 65535
 
 
-    def __init__(self, hostname, port, log_dir, filename, pidfile):
+    def __init__(self, hostname, port, log_dir, filename, pidfile, fast=False, split=None, tcp=False,
+                 unix=None):
         """Constructor"""
         stdin = '/dev/null'
         stdout = os.path.join(log_dir, 'logging_error.log')
@@ -60,6 +76,11 @@ class LogDaemon(Daemon):
         Daemon.__init__(self, pidfile, stdin, stdout, stderr)
         self.hostname = hostname
         self.port = port
+        ## a split output needs the LogServer, the stream transports have their own
+        self.fast = fast or split is not None
+        self.split = split
+        self.tcp = tcp
+        self.unix = unix
         ##Set up logging
         #get logger, we will log to file
         fancylogger.logToScreen(False)
@@ -68,7 +89,13 @@ class LogDaemon(Daemon):
         self.logfile = os.path.join(log_dir, filename)
         fancylogger.logToFile(self.logfile)
         self.logger = fancylogger.getLogger()
-        self.socket_ = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        if unix:
+            self.socket_ = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        elif tcp:
+            self.socket_ = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            self.socket_.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        else:
+            self.socket_ = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
 
     def start(self):
         """
@@ -88,9 +115,16 @@ class LogDaemon(Daemon):
             sys.exit(1)
 
         #get socket
-        self.socket_.bind((self.hostname, self.port))
         print "FANCYLOG_SERVER_PID=%s" % self.pidfile
-        print "FANCYLOG_SERVER=%s:%d" % (socket.gethostname(), self.socket_.getsockname()[-1])
+        if self.unix:
+            self.socket_.bind(self.unix)
+            print "FANCYLOG_SERVER=%s" % self.unix
+            print "FANCYLOG_SERVER_TRANSPORT=unix"
+        else:
+            self.socket_.bind((self.hostname, self.port))
+            print "FANCYLOG_SERVER=%s:%d" % (socket.gethostname(), self.socket_.getsockname()[-1])
+            if self.tcp:
+                print "FANCYLOG_SERVER_TRANSPORT=tcp"
         print "FANCYLOG_SERVER_LOGFILE=%s" % self.logfile
         sys.stdout.flush()
 
@@ -103,18 +137,49 @@ class LogDaemon(Daemon):
         """
         Main server loop
         """
+        if self.fast or self.tcp or self.unix:
+            self.run_fast()
+            return
+
+        decoder = BatchedDatagramDecoder()
         while True:
             try:
-                # receive the message, unpickle it, make a record from it and handle the record
-                message, _ = self.socket_.recvfrom(8192)
-                unpickled = pickle.loads(message[4:])
-                logrecord = logging.makeLogRecord(unpickled)
-                self.logger.handle(logrecord)
+                # receive the message, unpickle the record(s), make a record from each and handle the record
+                message, address = self.socket_.recvfrom(self.MAX_DATAGRAM)
+                lost = decoder.lost
+                for unpickled in decoder.decode(message, address):
+                    logrecord = logging.makeLogRecord(unpickled)
+                    self.logger.handle(logrecord)
+                if decoder.lost > lost:
+                    self.logger.warning("Lost %s log datagrams from %s (%s in total)" %
+                                        (decoder.lost - lost, address, decoder.lost))
             except (KeyboardInterrupt, SystemExit):
                 raise
             except:
                 traceback.print_exc()
 
+    def run_fast(self):
+        """
+        High-throughput server loop: batched receive, decoding and buffered writing in a separate thread
+        """
+        if self.tcp or self.unix:
+            server = StreamLogServer(self.socket_, self.logfile, split=self.split)
+        else:
+            server = LogServer(self.socket_, self.logfile, split=self.split)
+
+        def report(signum, frame):
+            sys.stderr.write("%s\n" % server.stats_line())
+            sys.stderr.flush()
+
+        ## Daemon.stop sends SIGTERM: stop serving so the buffered records are written
+        signal.signal(signal.SIGTERM, lambda signum, frame: server.stop())
+        signal.signal(signal.SIGUSR1, report)
+        try:
+            server.serve()
+        finally:
+            if self.unix:
+                os.remove(self.unix)
+
 
 def main(args):
     """
@@ -134,6 +199,15 @@ def main(args):
                        )
     parser.add_option("-f", "--file", help="File to log to", default="log.log",
                       type="string")
+    parser.add_option("--fast", help="High-throughput mode: receive in batches, write buffered",
+                      action="store_true", default=False)
+    parser.add_option("--split", help="Write one file per source (implies --fast): %s" %
+                      '|'.join([x for x in LogServer.SPLITS if x]),
+                      choices=[x for x in LogServer.SPLITS if x], default=None)
+    parser.add_option("--tcp", help="Listen for tcp connections (fancylogger.logToTCP) instead of udp",
+                      action="store_true", default=False)
+    parser.add_option("--unix", help="Listen for connections (fancylogger.logToUnixSocket) on this unix socket",
+                      default=None, type="string")
     parser.add_option("--pid", help="The location of a .pid file. "\
                       "When not specified, a temporary location will be used ($TMPDIR/logdaemon.pid). "\
                       "The daemon uses this file to make sure no two instances are running "\
@@ -146,9 +220,14 @@ def main(args):
     else:
         pidfile = os.path.expanduser(options.pid)
     logdir = os.path.expanduser(options.logdir)
+    unix = None
+    if options.unix:
+        ## the daemon changes its working directory
+        unix = os.path.abspath(os.path.expanduser(options.unix))
     ##start daemon
     daemon = LogDaemon(options.host, options.port,
-                       logdir, options.file, pidfile)
+                       logdir, options.file, pidfile, fast=options.fast, split=options.split,
+                       tcp=options.tcp, unix=unix)
     if len(args) == 2:
         if 'stop' == args[1]:
             #save state before stopping?
@@ -0,0 +1,126 @@
+#!/usr/bin/env python
+##
+# Copyright 2012 Ghent University
+# Copyright 2012 Andy Georges
+#
+# This file is part of VSC-tools,
+# originally created by the HPC team of Ghent University (http://ugent.be/hpc/en),
+# with support of Ghent University (http://ugent.be/hpc),
+# the Flemish Supercomputer Centre (VSC) (https://vscentrum.be/nl/en),
+# the Hercules foundation (http://www.herculesstichting.be/in_English)
+# and the Department of Economy, Science and Innovation (EWI) (http://www.ewi-vlaanderen.be/en).
+#
+# http://github.com/hpcugent/VSC-tools
+#
+# VSC-tools is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation v2.
+#
+# VSC-tools is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with VSC-tools. If not, see <http://www.gnu.org/licenses/>.
+##
+"""
+Resident server for the results of NagiosReporters, and its client.
+
+The server keeps the cached results in memory and serves them on a Unix socket:
+
+    nagiosdaemon.py start|stop|restart -s socket -r name:filename:threshold [-r ...]
+
+The client is what nagios runs as the check; it only uses the standard library (no vsc imports),
+prints the result and exits with its exit code:
+
+    nagiosdaemon.py check name [socket]
+"""
+import socket
+import sys
+
+DEFAULT_SOCKET = '/var/run/vsc-nagios.sock'
+CLIENT_TIMEOUT = 10
+NAGIOS_EXIT_UNKNOWN = 3
+
+
+def check(name, socket_path):
+    """Ask the server for the result of name, print it and exit accordingly"""
+    try:
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(CLIENT_TIMEOUT)
+        sock.connect(socket_path)
+        sock.sendall("%s\n" % name)
+        answer = ''
+        while True:
+            data = sock.recv(4096)
+            if not data:
+                break
+            answer += data
+        sock.close()
+        (code, line) = answer.rstrip('\n').split(' ', 1)
+        code = int(code)
+    except (socket.error, ValueError), err:
+        (code, line) = (NAGIOS_EXIT_UNKNOWN, "UNKNOWN nagios result server unavailable on %s (%s)" %
+                        (socket_path, err))
+    print line
+    sys.exit(code)
+
+
+def main(args):
+    """Start or stop the server"""
+    import os
+    from optparse import OptionParser
+    from vsc import fancylogger
+    from vsc.utils.nagios import NagiosReporter, NagiosResultServer
+
+    parser = OptionParser(usage="usage: %s start|stop|restart [options]\n       %s check name [socket]" %
+                          (args[0], args[0]))
+    parser.add_option("-s", "--socket", help="Unix socket to serve on [default: %default]", default=DEFAULT_SOCKET)
+    parser.add_option("-r", "--reporter", action="append", default=[],
+                      help="Reporter to serve, as name:filename:threshold (can be repeated)")
+    parser.add_option("-m", "--mode", help="Permissions of the socket, in octal [default: %s]" %
+                      ("%o" % NagiosResultServer.SOCKET_MODE), default=None)
+    parser.add_option("-l", "--logfile", help="File to log to [default: no logging]", default=None)
+    parser.add_option("--pid", help="The location of the .pid file [default: $TMPDIR/nagiosdaemon.pid]",
+                      default=None)
+    (options, args) = parser.parse_args(args)
+
+    if options.pid:
+        pidfile = os.path.expanduser(options.pid)
+    else:
+        pidfile = os.path.join(os.getenv("TMPDIR", "/tmp"), 'nagiosdaemon.pid')
+
+    reporters = {}
+    for reporter in options.reporter:
+        try:
+            (name, filename, threshold) = reporter.rsplit(':', 2)
+            reporters[name] = NagiosReporter(name, os.path.abspath(filename), int(threshold))
+        except ValueError:
+            parser.error("Invalid reporter %s, use name:filename:threshold" % reporter)
+
+    socket_mode = None
+    if options.mode:
+        try:
+            socket_mode = int(options.mode, 8)
+        except ValueError:
+            parser.error("Invalid mode %s, use octal (eg 660)" % options.mode)
+
+    fancylogger.logToScreen(False)
+    if options.logfile:
+        fancylogger.logToFile(os.path.abspath(options.logfile))
+
+    server = NagiosResultServer(os.path.abspath(options.socket), reporters, pidfile, socket_mode=socket_mode)
+    if len(args) == 2 and args[1] in ('start', 'stop', 'restart'):
+        if args[1] == 'start' and not reporters:
+            parser.error("No reporters to serve")
+        getattr(server, args[1])()
+    else:
+        parser.error("Unknown command")
+
+
+if __name__ == '__main__':
+    if len(sys.argv) in (3, 4) and sys.argv[1] == 'check':
+        check(sys.argv[2], (sys.argv[3:] or [DEFAULT_SOCKET])[0])
+    else:
+        main(sys.argv)
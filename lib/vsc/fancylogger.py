@@ -36,8 +36,10 @@ It adds:
 - custom specifier for always showing the calling function's name
 - rotating file handler
 - a default formatter.
-- logging to an UDP server (vsc.logging.logdaemon.py f.ex.)
+- logging to an UDP server (vsc.logging.logdaemon.py f.ex.), optionally with many records per datagram
+- lossless logging over a tcp connection or a unix socket, with backpressure (logToTCP, logToUnixSocket)
 - easily setting loglevel
+- asynchronous logging: the handlers do their I/O in a background thread (logAsync)
 
 f.ex the threadname specifier which will insert the name of the thread
 
@@ -68,16 +70,32 @@ handler.setFormatter(logging.Formatter(formatstring))
 >>> logger.debug("warning")
 2012-01-05 14:03:46,222 DEBUG      <stdin>.test    MainThread  warning
 
+#do the I/O of all handlers in a background thread, the callers only queue the records
+fancylogger.logAsync()
+
 ## logging to a udp server:
 # set an environment variable FANCYLOG_SERVER and FANCYLOG_SERVER_PORT (optionally)
 # this will make fancylogger log to that that server and port instead of the screen.
+# with FANCYLOG_SERVER_TRANSPORT tcp (or unix, FANCYLOG_SERVER is then the path of the socket),
+# the records are sent over a connection instead (as printed by logdaemon.py --tcp or --unix)
+
+## logging to a log daemon started with --tcp or --unix (nothing is lost when it falls behind):
+fancylogger.logToTCP(hostname, port)
+fancylogger.logToUnixSocket('/path/to/socket')
 """
-import inspect
+import copy
+import cPickle
 import logging.handlers
 import os
+import socket
+import struct
 import sys
 import threading
+import time
 import traceback
+import weakref
+import zlib
+from collections import deque
 
 #constants
 LOGGER_NAME = "fancylogger"
@@ -179,6 +197,9 @@ class NamedLogger(logging.getLoggerClass()):
 
         def write_and_flush_stream(hdlr, data=None):
             """Write to stream and flush the handler"""
+            if isinstance(hdlr, AsyncHandler):
+                hdlr.queue_stream(levelno, data)
+                return
             if (not hasattr(hdlr, 'stream')) or hdlr.stream is None:
                 ## no stream or not initialised.
                 raise("write_and_flush_stream failed. No active stream attribute.")
@@ -237,19 +258,32 @@ def _getCallingFunctionName():
     (for internal use only)
     """
     try:
-        return inspect.stack()[2][3]
+        return sys._getframe(2).f_code.co_name
     except Exception:
         return None
 
+_root_module_name = None
 def _getRootModuleName():
     """
     returns the name of the root module
     this is the module that is actually running everything and so doing the logging
+
+    it is determined once per process: the script of __main__, or else (eg python -c)
+    the file of the outermost frame
     """
-    try:
-        return inspect.stack()[-1][1].split('/')[-1].split('.')[0]
-    except Exception:
-        return None
+    global _root_module_name
+    if _root_module_name is None:
+        try:
+            filename = getattr(sys.modules.get('__main__'), '__file__', None)
+            if filename is None:
+                frame = sys._getframe()
+                while frame.f_back is not None:
+                    frame = frame.f_back
+                filename = frame.f_code.co_filename
+            _root_module_name = filename.split('/')[-1].split('.')[0]
+        except Exception:
+            return None
+    return _root_module_name
 
 
 def logToScreen(enable=True, handler=None, name=None):
@@ -296,18 +330,25 @@ def logToFile(filename, enable=True, filehandler=None, name=None, max_bytes=MAX_
                            handler=filehandler,
                            )
 
-def logToUDP(hostname, port=5005, enable=True, datagramhandler=None, name=None):
+def logToUDP(hostname, port=5005, enable=True, datagramhandler=None, name=None, batched=False, compress=False):
     """
     enable (or disable) logging to udp
     given hostname and port.
 
+    with batched, many records are sent per datagram (see BatchedDatagramHandler),
+    compressed with compress
+
     returns the filehandler (this can be used to later disable logging to udp)
 
     if you want to disable logging to udp, pass the earlier obtained filehandler,
     and set boolean = False
     """
-    handleropts = {'hostname': hostname, 'port': port}
-    return _logToSomething(logging.handlers.DatagramHandler,
+    handleropts = {'host': hostname, 'port': port}
+    handlerclass = logging.handlers.DatagramHandler
+    if batched:
+        handlerclass = BatchedDatagramHandler
+        handleropts['compress'] = compress
+    return _logToSomething(handlerclass,
                            handleropts,
                            loggeroption='logtoudp',
                            name=name,
@@ -316,6 +357,541 @@ def logToUDP(hostname, port=5005, enable=True, datagramhandler=None, name=None):
                            )
 
 
+def logToTCP(hostname, port, enable=True, streamhandler=None, name=None, compress=False):
+    """
+    enable (or disable) logging to a tcp connection to
+    given hostname and port (see BatchedStreamHandler).
+
+    returns the streamhandler (this can be used to later disable logging to tcp)
+
+    if you want to disable logging to tcp, pass the earlier obtained streamhandler,
+    and set boolean = False
+    """
+    return _logToSomething(BatchedStreamHandler,
+                           {'host': hostname, 'port': port, 'compress': compress},
+                           loggeroption='logtotcp',
+                           name=name,
+                           enable=enable,
+                           handler=streamhandler,
+                           )
+
+
+def logToUnixSocket(path, enable=True, streamhandler=None, name=None, compress=False):
+    """
+    enable (or disable) logging to the unix socket path (see BatchedStreamHandler).
+
+    returns the streamhandler (this can be used to later disable logging to the unix socket)
+
+    if you want to disable logging to the unix socket, pass the earlier obtained streamhandler,
+    and set boolean = False
+    """
+    return _logToSomething(BatchedStreamHandler,
+                           {'host': path, 'port': None, 'compress': compress},
+                           loggeroption='logtounixsocket',
+                           name=name,
+                           enable=enable,
+                           handler=streamhandler,
+                           )
+
+
+def _pickleRecord(handler, record):
+    """Pickle the record dictionary, with the message and the exception of record formatted by handler"""
+    if record.exc_info:
+        ## the traceback can not be pickled, send the formatted text
+        handler.format(record)
+    d = dict(record.__dict__)
+    d['msg'] = record.getMessage()
+    d['args'] = None
+    d['exc_info'] = None
+    return cPickle.dumps(d, cPickle.HIGHEST_PROTOCOL)
+
+
+def _unpickleRecords(payload):
+    """Return the record dictionaries in the payload of a batch (each pickle prefixed with its length)"""
+    records = []
+    offset = 0
+    record_header = BatchedDatagramHandler.RECORD_HEADER
+    while offset < len(payload):
+        (length,) = record_header.unpack(payload[offset:offset + record_header.size])
+        offset += record_header.size
+        records.append(cPickle.loads(payload[offset:offset + length]))
+        offset += length
+    return records
+
+
+class _BatchFlusher(object):
+    """
+    Mixin for the batching handlers: one background thread per handler (and per process, it is started
+    again after a fork) sends the batch once its first record is interval seconds old.
+
+    The handler calls _init_flusher() in __init__, _check_fork() first in emit, _batch_started() when it
+    adds the first record of a batch, sets _batch_start to None when it sends the batch, and implements _forked().
+    """
+    FLUSHER_THREAD_NAME = 'fancylogger-flush'
+
+    def _init_flusher(self):
+        self._flusher_pid = None
+        self._wakeup = None
+        self._batch_start = None  # the time of the first record of the batch
+        self._closing = False
+
+    def _check_fork(self):
+        """Start the flusher thread (again, in a forked child, after resetting the state of the parent)"""
+        if self._flusher_pid == os.getpid():
+            return
+        if self._flusher_pid is not None:
+            self._forked()
+        self._flusher_pid = os.getpid()
+        self._wakeup = threading.Event()
+        thread = threading.Thread(target=self._run_flusher, args=(self._wakeup,), name=self.FLUSHER_THREAD_NAME)
+        thread.setDaemon(True)
+        thread.start()
+
+    def _forked(self):
+        """Reset the state inherited from the parent: its batch is sent by the parent"""
+        self.records = []
+        self.size = 0
+        self._batch_start = None
+
+    def _batch_started(self):
+        """The first record was added to the batch (with the handler lock held)"""
+        self._batch_start = time.time()
+        self._wakeup.set()
+
+    def _run_flusher(self, wakeup):
+        """Main loop of the flusher thread"""
+        while not self._closing:
+            wakeup.wait()
+            wakeup.clear()
+            while not self._closing:
+                start = self._batch_start
+                if start is None:
+                    break
+                delay = start + self.interval - time.time()
+                if delay > 0:
+                    time.sleep(delay)
+                else:
+                    self.flush()
+
+    def _stop_flusher(self):
+        """Stop the flusher thread"""
+        self._closing = True
+        if self._wakeup is not None:
+            self._wakeup.set()
+
+
+def _stream_id():
+    """Return a random 32 bit stream id (also different in forked processes, unlike the random module)"""
+    return struct.unpack('!I', os.urandom(4))[0]
+
+
+class BatchedDatagramHandler(_BatchFlusher, logging.handlers.DatagramHandler):
+    """
+    DatagramHandler that sends many records per datagram
+
+    The pickled records are collected until there are max_size bytes of them, or until the first one is
+    interval seconds old, and sent together (zlib compressed with compress). A batch that does not fit in
+    one datagram is split in several. After a fork, the child has its own stream (and sends only its own records).
+
+    Each datagram has a header (see DATAGRAM_HEADER) with
+        - the magic (the 4 bytes length of a plain DatagramHandler record can never be the magic)
+        - the version and flags (compressed)
+        - a random stream id of this handler, and the sequence number of the datagram
+        - the index of the datagram in the batch and the number of datagrams of the batch
+    so the receiver (see BatchedDatagramDecoder) can detect lost datagrams.
+    """
+    MAGIC = 'VSCL'
+    VERSION = 1
+    FLAG_ZLIB = 1
+    DATAGRAM_HEADER = struct.Struct('!4sBBIIHH')
+    RECORD_HEADER = struct.Struct('!I')
+
+    MAX_SIZE = 8192
+    INTERVAL = 1.0
+
+    def __init__(self, host, port, compress=False, max_size=MAX_SIZE, interval=INTERVAL):
+        """
+        compress: compress the batches with zlib
+        max_size: maximum number of bytes of the pickled records per batch (and of a datagram)
+        interval: seconds a record may wait for the batch to be sent
+        """
+        logging.handlers.DatagramHandler.__init__(self, host, port)
+        self.compress = compress
+        self.max_size = max_size
+        self.interval = interval
+
+        self.stream_id = _stream_id()
+        self.sequence = 0
+        self.records = []  # the pickled records of the batch
+        self.size = 0
+        self._init_flusher()
+
+    def makePickle(self, record):
+        """Pickle the record (like DatagramHandler, without the length)"""
+        return _pickleRecord(self, record)
+
+    def emit(self, record):
+        """Add the record to the batch, send the batch if it is full"""
+        try:
+            self._check_fork()
+            pickled = self.makePickle(record)
+            if self.records and self.size + self.RECORD_HEADER.size + len(pickled) > self.max_size:
+                self._send_batch()
+            if not self.records:
+                self._batch_started()
+            self.records.append(self.RECORD_HEADER.pack(len(pickled)) + pickled)
+            self.size += self.RECORD_HEADER.size + len(pickled)
+            if self.size >= self.max_size:
+                self._send_batch()
+        except (KeyboardInterrupt, SystemExit):
+            raise
+        except:
+            self.handleError(record)
+
+    def _forked(self):
+        """Start a new stream in the forked child"""
+        _BatchFlusher._forked(self)
+        self.stream_id = _stream_id()
+        self.sequence = 0
+
+    def datagrams(self, payload):
+        """Return the datagrams for the batch payload, and update the sequence number"""
+        flags = 0
+        if self.compress:
+            payload = zlib.compress(payload)
+            flags |= self.FLAG_ZLIB
+        chunk = self.max_size
+        parts = max(1, (len(payload) + chunk - 1) // chunk)
+        datagrams = []
+        for part in xrange(parts):
+            header = self.DATAGRAM_HEADER.pack(self.MAGIC, self.VERSION, flags, self.stream_id, self.sequence,
+                                               part, parts)
+            datagrams.append(header + payload[part * chunk:(part + 1) * chunk])
+            self.sequence = (self.sequence + 1) & 0xffffffff
+        return datagrams
+
+    def _send_batch(self):
+        """Send the batch (with the handler lock held)"""
+        self._batch_start = None
+        if not self.records:
+            return
+        payload = ''.join(self.records)
+        self.records = []
+        self.size = 0
+        for datagram in self.datagrams(payload):
+            self.send(datagram)
+
+    def flush(self):
+        """Send the batch"""
+        self.acquire()
+        try:
+            try:
+                if self._flusher_pid not in (None, os.getpid()):
+                    ## not the batch of the parent
+                    self._check_fork()
+                self._send_batch()
+            except (KeyboardInterrupt, SystemExit):
+                raise
+            except:
+                _printHandlerError()
+        finally:
+            self.release()
+
+    def close(self):
+        """Send the batch, stop the flusher and close the socket"""
+        self._stop_flusher()
+        self.flush()
+        logging.handlers.DatagramHandler.close(self)
+
+
+class BatchedDatagramDecoder(object):
+    """
+    Decode the datagrams of BatchedDatagramHandlers (and of plain DatagramHandlers) to record dictionaries
+
+    The datagrams are tracked per sender (address and stream id): lost datagrams (a gap in the sequence numbers)
+    are counted in lost, and the batches of which a datagram was lost are dropped.
+    """
+    ## batches with datagrams missing for this many sequence numbers are dropped
+    REASSEMBLY_WINDOW = 64
+
+    def __init__(self):
+        self.expected = {}  # next sequence number per sender
+        self.partial = {}  # per (sender, first sequence number), the received datagrams of a batch
+        self.lost = 0
+        self.reordered = 0
+        self.datagrams = 0
+
+    def decode(self, datagram, address=None):
+        """Return the record dictionaries in datagram, received from address"""
+        self.datagrams += 1
+        if not datagram.startswith(BatchedDatagramHandler.MAGIC):
+            ## a plain DatagramHandler record: 4 bytes length and the pickle
+            return [cPickle.loads(datagram[4:])]
+
+        header = BatchedDatagramHandler.DATAGRAM_HEADER
+        (_, version, flags, stream_id, sequence, part, parts) = header.unpack(datagram[:header.size])
+        if version != BatchedDatagramHandler.VERSION:
+            raise ValueError("Unsupported batched datagram version %s" % version)
+
+        sender = (address, stream_id)
+        expected = self.expected.get(sender, sequence)
+        gap = (sequence - expected) & 0xffffffff
+        if gap < 0x80000000:
+            self.lost += gap
+            self.expected[sender] = (sequence + 1) & 0xffffffff
+        else:
+            self.reordered += 1
+
+        payload = datagram[header.size:]
+        if parts > 1:
+            key = (sender, (sequence - part) & 0xffffffff)
+            received = self.partial.setdefault(key, {})
+            received[part] = payload
+            self._expire(sender, sequence)
+            if len(received) < parts:
+                return []
+            del self.partial[key]
+            payload = ''.join([received[idx] for idx in xrange(parts)])
+
+        if flags & BatchedDatagramHandler.FLAG_ZLIB:
+            payload = zlib.decompress(payload)
+
+        return _unpickleRecords(payload)
+
+    def _expire(self, sender, sequence):
+        """Drop the incomplete batches of sender that are too old to be completed"""
+        for key in [key for key in self.partial if key[0] == sender]:
+            if (sequence - key[1]) & 0xffffffff > self.REASSEMBLY_WINDOW:
+                del self.partial[key]
+
+
+class BatchedStreamHandler(_BatchFlusher, logging.handlers.SocketHandler):
+    """
+    SocketHandler that sends batches of records over a persistent TCP connection, or a Unix socket (port None)
+
+    The records are batched like in BatchedDatagramHandler; each batch is sent as a frame with a header
+    (see FRAME_HEADER: magic, version, flags and length of the payload) over the connection.
+
+    The frames wait for the connection in a queue of at most max_queue bytes:
+        - while the daemon is slow, sending blocks (backpressure, nothing is lost); use logAsync to keep
+          the logging threads going
+        - while there is no connection (it is retried with backoff, like SocketHandler), the oldest frames
+          are dropped when the queue is full; the dropped records are counted in dropped, and reported with
+          a warning once the connection is back
+    After a fork, the child has its own connection (and sends only its own records).
+    """
+    MAGIC = 'VSCS'
+    VERSION = 1
+    FLAG_ZLIB = 1
+    FRAME_HEADER = struct.Struct('!4sBBI')
+    RECORD_HEADER = BatchedDatagramHandler.RECORD_HEADER
+
+    MAX_SIZE = 64 * 1024
+    INTERVAL = 1.0
+    MAX_QUEUE = 16 * 1024 * 1024
+
+    def __init__(self, host, port=None, compress=False, max_size=MAX_SIZE, interval=INTERVAL, max_queue=MAX_QUEUE):
+        """
+        host, port: the daemon to connect to; with port None, host is the path of a Unix socket
+        compress: compress the batches with zlib
+        max_size: maximum number of bytes of the pickled records per batch
+        interval: seconds a record may wait for the batch to be sent
+        max_queue: maximum number of bytes of the frames waiting for the connection
+        """
+        logging.handlers.SocketHandler.__init__(self, host, port)
+        self.compress = compress
+        self.max_size = max_size
+        self.interval = interval
+        self.max_queue = max_queue
+
+        self.records = []  # the pickled records of the batch
+        self.size = 0
+        self.queue = deque()  # the (frame, number of records) waiting for the connection
+        self.queued = 0
+        self.dropped = 0
+        self._dropped_reported = 0
+        self._init_flusher()
+
+    def makeSocket(self, timeout=1):
+        """Connect to the daemon (in blocking mode once connected)"""
+        if self.port is None:
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            address = self.host
+        else:
+            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            address = (self.host, self.port)
+        sock.settimeout(timeout)
+        try:
+            sock.connect(address)
+        except socket.error:
+            sock.close()
+            raise
+        ## sending blocks while the daemon is behind
+        sock.settimeout(None)
+        return sock
+
+    def makePickle(self, record):
+        """Pickle the record (like SocketHandler, without the length)"""
+        return _pickleRecord(self, record)
+
+    def frame(self, records):
+        """Return the frame for the pickled records (each prefixed with its length)"""
+        flags = 0
+        payload = ''.join(records)
+        if self.compress:
+            payload = zlib.compress(payload)
+            flags |= self.FLAG_ZLIB
+        return self.FRAME_HEADER.pack(self.MAGIC, self.VERSION, flags, len(payload)) + payload
+
+    def emit(self, record):
+        """Add the record to the batch, send the batch if it is full"""
+        try:
+            self._check_fork()
+            pickled = self.makePickle(record)
+            if not self.records:
+                self._batch_started()
+            self.records.append(self.RECORD_HEADER.pack(len(pickled)) + pickled)
+            self.size += self.RECORD_HEADER.size + len(pickled)
+            if self.size >= self.max_size:
+                self._send_batch()
+        except (KeyboardInterrupt, SystemExit):
+            raise
+        except:
+            self.handleError(record)
+
+    def _send_batch(self):
+        """Queue the batch and send the queue (with the handler lock held)"""
+        self._batch_start = None
+        if self.records:
+            frame = self.frame(self.records)
+            self.queue.append((frame, len(self.records)))
+            self.queued += len(frame)
+            self.records = []
+            self.size = 0
+        self._send_queue()
+        while self.queued > self.max_queue:
+            (frame, records) = self.queue.popleft()
+            self.queued -= len(frame)
+            self.dropped += records
+
+    def _forked(self):
+        """Drop the connection and the queue of the parent in the forked child"""
+        _BatchFlusher._forked(self)
+        self.queue = deque()
+        self.queued = 0
+        self.dropped = 0
+        self._dropped_reported = 0
+        if self.sock is not None:
+            ## only closes the descriptor of the child, the connection of the parent stays up
+            self.sock.close()
+            self.sock = None
+        self.retryTime = None
+
+    def _send_queue(self):
+        """Send the queued frames, if there is a connection (with the handler lock held)"""
+        if self.sock is None:
+            self.createSocket()
+            if self.sock is None:
+                return
+        if self.dropped > self._dropped_reported:
+            warning = logging.makeLogRecord({
+                'name': LOGGER_NAME, 'levelno': logging.WARNING, 'levelname': 'WARNING',
+                'msg': "BatchedStreamHandler dropped %s records (no connection)" % self.dropped,
+                'threadname': thread_name(), 'mpirank': _MPIRANK,
+            })
+            pickled = self.makePickle(warning)
+            frame = self.frame([self.RECORD_HEADER.pack(len(pickled)) + pickled])
+            self.queue.appendleft((frame, 1))
+            self.queued += len(frame)
+            self._dropped_reported = self.dropped
+        while self.queue:
+            frame = self.queue[0][0]
+            try:
+                self.sock.sendall(frame)
+            except socket.error:
+                ## the frame is sent again on the next connection (the daemon drops an incomplete frame)
+                self.sock.close()
+                self.sock = None
+                return
+            self.queue.popleft()
+            self.queued -= len(frame)
+
+    def flush(self):
+        """Send the batch and the queue"""
+        self.acquire()
+        try:
+            try:
+                if self._flusher_pid not in (None, os.getpid()):
+                    ## not the batch and the connection of the parent
+                    self._check_fork()
+                self._send_batch()
+            except (KeyboardInterrupt, SystemExit):
+                raise
+            except:
+                _printHandlerError()
+        finally:
+            self.release()
+
+    def close(self):
+        """Send the batch and the queue, stop the flusher and close the connection"""
+        self._stop_flusher()
+        self.flush()
+        logging.handlers.SocketHandler.close(self)
+
+
+class BatchedStreamDecoder(object):
+    """
+    Decode the stream of a BatchedStreamHandler (or of a plain SocketHandler) to record dictionaries
+
+    The data of one connection is fed in the order it is received; the incomplete frame at the end
+    is kept (in pending bytes) until the rest is fed.
+    """
+    PLAIN_HEADER = struct.Struct('!L')
+
+    def __init__(self):
+        self.buffer = ''
+        self.frames = 0
+
+    def pending(self):
+        """Return the number of bytes of the incomplete frame"""
+        return len(self.buffer)
+
+    def feed(self, data):
+        """Return the record dictionaries in the frames completed by data"""
+        buf = self.buffer + data
+        records = []
+        offset = 0
+        frame_header = BatchedStreamHandler.FRAME_HEADER
+        plain_header = self.PLAIN_HEADER
+        while True:
+            if buf.startswith(BatchedStreamHandler.MAGIC, offset):
+                if len(buf) - offset < frame_header.size:
+                    break
+                (_, version, flags, length) = frame_header.unpack(buf[offset:offset + frame_header.size])
+                if version != BatchedStreamHandler.VERSION:
+                    raise ValueError("Unsupported batched stream version %s" % version)
+                start = offset + frame_header.size
+                if len(buf) - start < length:
+                    break
+                payload = buf[start:start + length]
+                if flags & BatchedStreamHandler.FLAG_ZLIB:
+                    payload = zlib.decompress(payload)
+                records.extend(_unpickleRecords(payload))
+            elif len(buf) - offset >= plain_header.size:
+                ## a plain SocketHandler record: 4 bytes length and the pickle
+                (length,) = plain_header.unpack(buf[offset:offset + plain_header.size])
+                start = offset + plain_header.size
+                if len(buf) - start < length:
+                    break
+                records.append(cPickle.loads(buf[start:start + length]))
+            else:
+                break
+            offset = start + length
+            self.frames += 1
+        self.buffer = buf[offset:]
+        return records
+
+
 def _logToSomething(handlerclass, handleropts, loggeroption, enable=True, name=None, handler=None):
     """
     internal function to enable (or disable) logging to handler named handlername
@@ -326,6 +902,8 @@ def _logToSomething(handlerclass, handleropts, loggeroption, enable=True, name=N
     if you want to disable logging to the handler, pass the earlier obtained handler
     """
     logger = getLogger(name)
+    ## with logAsync, the handlers are the targets of the AsyncHandler
+    asynchandler = getattr(logger, 'asynchandler', None)
 
     if not hasattr(logger, loggeroption):
         ## not set.
@@ -336,21 +914,317 @@ def _logToSomething(handlerclass, handleropts, loggeroption, enable=True, name=N
             formatter = logging.Formatter(DEFAULT_LOGGING_FORMAT)
             handler = handlerclass(**handleropts)
             handler.setFormatter(formatter)
-        logger.addHandler(handler)
+        if asynchandler is None:
+            logger.addHandler(handler)
+        else:
+            asynchandler.addTarget(handler)
         setattr(logger, loggeroption, True)
     elif not enable:
         #stop logging to X (needs the handler, so fail if it's not specified)
-        if handler is None and len(logger.handlers) == 1:
+        if asynchandler is None:
+            handlers = logger.handlers
+        else:
+            handlers = asynchandler.targets
+        if handler is None and len(handlers) == 1:
             # removing the last logger doesn't work
             # it will be re-added if only one handler is present
             # so we will just make it quiet by setting the loglevel extremely high
-            zerohandler = logger.handlers[0]
+            zerohandler = handlers[0]
             zerohandler.setLevel(101) # 50 is critical, so 101 should be nothing
-        else:
+        elif asynchandler is None:
             logger.removeHandler(handler)
+        else:
+            asynchandler.removeTarget(handler)
         setattr(logger, loggeroption, False)
     return handler
 
+
+def _printHandlerError():
+    """Report the current exception like logging.Handler.handleError, for errors not related to a record"""
+    if logging.raiseExceptions and sys.stderr:
+        try:
+            traceback.print_exc()
+        except IOError:
+            pass
+
+
+def _unregisterShutdown(handler):
+    """Remove handler from the handlers that logging.shutdown closes"""
+    logging._acquireLock()
+    try:
+        ## weak references (python 2.7) or the handlers
+        for ref in logging._handlerList[:]:
+            if ref is handler or (isinstance(ref, weakref.ref) and ref() is handler):
+                logging._handlerList.remove(ref)
+    finally:
+        logging._releaseLock()
+
+
+def _registerShutdown(handler):
+    """Add handler (again) to the handlers that logging.shutdown closes"""
+    _unregisterShutdown(handler)
+    if hasattr(logging, '_addHandlerRef'):
+        logging._addHandlerRef(handler)
+    else:
+        logging._acquireLock()
+        try:
+            logging._handlerList.append(handler)
+        finally:
+            logging._releaseLock()
+
+
+class AsyncHandler(logging.Handler):
+    """
+    Handler that puts the records in a bounded in-memory queue; a background thread hands them
+    in batches to the target handlers, so the I/O is not done by the thread that logs.
+
+    When the queue is full, the overflow policy decides:
+        - OVERFLOW_BLOCK: wait until there is room in the queue
+        - OVERFLOW_DROP_OLDEST: drop the oldest record in the queue
+        - OVERFLOW_DROP: drop the new record
+    The dropped records are counted (in dropped), and reported to the targets with a warning.
+
+    flush() waits until the queue is empty; logging.shutdown (at exit) flushes and closes the handler.
+    The targets are owned by the AsyncHandler: they are closed by its close(), after the queue is handled
+    (and not before by logging.shutdown); detach() gives them back.
+    """
+    OVERFLOW_BLOCK = 'block'
+    OVERFLOW_DROP_OLDEST = 'drop_oldest'
+    OVERFLOW_DROP = 'drop'
+    OVERFLOWS = (OVERFLOW_BLOCK, OVERFLOW_DROP_OLDEST, OVERFLOW_DROP)
+
+    MAXSIZE = 10000
+    BATCH_SIZE = 512
+    THREAD_NAME = 'fancylogger-async'
+
+    def __init__(self, targets=None, maxsize=MAXSIZE, overflow=OVERFLOW_BLOCK, batch_size=BATCH_SIZE):
+        """
+        targets: the handlers to hand the records to
+        maxsize: maximum number of queued records
+        overflow: the policy when the queue is full (one of OVERFLOWS)
+        batch_size: maximum number of records handled per batch
+        """
+        logging.Handler.__init__(self)
+        if overflow not in self.OVERFLOWS:
+            raise ValueError("Unknown overflow policy %s (use one of %s)" % (overflow, self.OVERFLOWS))
+        self.targets = list(targets or [])
+        for target in self.targets:
+            _unregisterShutdown(target)
+        self.maxsize = maxsize
+        self.overflow = overflow
+        self.batch_size = batch_size
+
+        self.dropped = 0
+        self._start()
+
+    def _start(self):
+        """Start the background thread (again, in a forked child)"""
+        self._pid = os.getpid()
+        self._queue = deque()
+        self._cond = threading.Condition(threading.Lock())
+        self._busy = False  # the thread is handling a batch
+        self._stopping = False
+        self._dropped_reported = self.dropped
+
+        self._thread = threading.Thread(target=self._run, name=self.THREAD_NAME)
+        self._thread.setDaemon(True)
+        self._thread.start()
+
+    def addTarget(self, handler):
+        """Add a target handler"""
+        self._cond.acquire()
+        try:
+            if handler not in self.targets:
+                self.targets.append(handler)
+                _unregisterShutdown(handler)
+        finally:
+            self._cond.release()
+
+    def removeTarget(self, handler):
+        """Remove a target handler"""
+        self._cond.acquire()
+        try:
+            if handler in self.targets:
+                self.targets.remove(handler)
+                _registerShutdown(handler)
+        finally:
+            self._cond.release()
+
+    def _prepare(self, record):
+        """Return a copy of the record (the other handlers share it) with the message and the exception
+        formatted now: the arguments may change before the record is handled
+        """
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging._defaultFormatter.formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def _put(self, item):
+        """Add item to the queue, according to the overflow policy"""
+        if self._pid != os.getpid():
+            self._start()
+
+        self._cond.acquire()
+        try:
+            ## the thread itself never waits for room (eg a target that logs)
+            if len(self._queue) >= self.maxsize and threading.currentThread() is not self._thread:
+                if self.overflow == self.OVERFLOW_BLOCK:
+                    while len(self._queue) >= self.maxsize and not self._stopping:
+                        self._cond.wait()
+                elif self.overflow == self.OVERFLOW_DROP_OLDEST:
+                    self._queue.popleft()
+                    self.dropped += 1
+                else:
+                    self.dropped += 1
+                    return
+            self._queue.append(item)
+            self._cond.notifyAll()
+        finally:
+            self._cond.release()
+
+    def emit(self, record):
+        """Queue the record"""
+        try:
+            self._put(self._prepare(record))
+        except (KeyboardInterrupt, SystemExit):
+            raise
+        except:
+            self.handleError(record)
+
+    def queue_stream(self, levelno, data):
+        """Queue stream data (see NamedLogger.streamLog)"""
+        self._put((levelno, data))
+
+    def _handle(self, targets, item):
+        """Hand item (a record or stream data) to the targets"""
+        if isinstance(item, tuple):
+            (levelno, data) = item
+            for hdlr in targets:
+                if levelno >= hdlr.level and getattr(hdlr, 'stream', None) is not None:
+                    hdlr.stream.write(data)
+        else:
+            for hdlr in targets:
+                if item.levelno >= hdlr.level:
+                    hdlr.handle(item)
+
+    def _run(self):
+        """Main loop of the background thread"""
+        while True:
+            self._cond.acquire()
+            try:
+                while not self._queue and not self._stopping:
+                    self._cond.wait()
+                if not self._queue:
+                    return
+                batch = [self._queue.popleft() for _ in xrange(min(self.batch_size, len(self._queue)))]
+                dropped = self.dropped - self._dropped_reported
+                self._dropped_reported = self.dropped
+                targets = self.targets[:]
+                self._busy = True
+                self._cond.notifyAll()
+            finally:
+                self._cond.release()
+
+            try:
+                if dropped:
+                    batch.insert(0, logging.makeLogRecord({
+                        'name': LOGGER_NAME, 'levelno': logging.WARNING, 'levelname': 'WARNING',
+                        'msg': "AsyncHandler dropped %s records (queue full)" % dropped,
+                        'threadname': self.THREAD_NAME, 'mpirank': _MPIRANK,
+                    }))
+                for item in batch:
+                    self._handle(targets, item)
+                for hdlr in targets:
+                    hdlr.flush()
+            except:
+                ## never let the thread die
+                _printHandlerError()
+
+            self._cond.acquire()
+            try:
+                self._busy = False
+                self._cond.notifyAll()
+            finally:
+                self._cond.release()
+
+    def flush(self):
+        """Wait until all queued records are handled"""
+        if self._pid != os.getpid() or not self._thread.isAlive():
+            return
+        self._cond.acquire()
+        try:
+            while self._queue or self._busy:
+                self._cond.wait()
+        finally:
+            self._cond.release()
+
+    def _stop(self):
+        """Handle the queued records, and stop the thread"""
+        self.flush()
+        self._cond.acquire()
+        try:
+            self._stopping = True
+            self._cond.notifyAll()
+        finally:
+            self._cond.release()
+        if self._pid == os.getpid():
+            self._thread.join()
+
+    def detach(self):
+        """Handle the queued records, stop the thread and return the targets (they are not closed)"""
+        self._stop()
+        targets = self.targets
+        self.targets = []
+        for target in targets:
+            _registerShutdown(target)
+        logging.Handler.close(self)
+        return targets
+
+    def close(self):
+        """Handle the queued records, stop the thread and close the targets"""
+        self._stop()
+        for target in self.targets:
+            ## closing a handler that is not registered fails with python 2.6
+            _registerShutdown(target)
+            try:
+                target.flush()
+                target.close()
+            except (KeyboardInterrupt, SystemExit):
+                raise
+            except:
+                _printHandlerError()
+        logging.Handler.close(self)
+
+
+def logAsync(enable=True, name=None, maxsize=AsyncHandler.MAXSIZE, overflow=AsyncHandler.OVERFLOW_BLOCK):
+    """
+    enable (or disable) asynchronous logging
+    the current handlers of the logger (and the ones added later with logToScreen, logToFile, ...)
+    are handled by a background thread, see AsyncHandler for the overflow policies
+
+    returns the AsyncHandler
+
+    disabling flushes the queue and puts the handlers back on the logger
+    """
+    logger = getLogger(name)
+    handler = getattr(logger, 'asynchandler', None)
+
+    if enable and handler is None:
+        handler = AsyncHandler(logger.handlers, maxsize=maxsize, overflow=overflow)
+        for target in handler.targets:
+            logger.removeHandler(target)
+        logger.addHandler(handler)
+        logger.asynchandler = handler
+    elif not enable and handler is not None:
+        logger.removeHandler(handler)
+        for target in handler.detach():
+            logger.addHandler(target)
+        logger.asynchandler = None
+    return handler
+
 """
 syslog
     /dev/log
@@ -459,7 +1333,11 @@ logging.setLoggerClass(NamedLogger)
 
 #log to a server if FANCYLOG_SERVER is set.
 _default_logTo = None
-if 'FANCYLOG_SERVER' in os.environ:
+if os.environ.get('FANCYLOG_SERVER_TRANSPORT') == 'unix':
+    #FANCYLOG_SERVER is the path of the unix socket
+    logToUnixSocket(os.environ['FANCYLOG_SERVER'])
+    _default_logTo = logToUnixSocket
+elif 'FANCYLOG_SERVER' in os.environ:
     server = os.environ['FANCYLOG_SERVER']
     port = DEFAULT_UDP_PORT
     if ':' in server:
@@ -470,8 +1348,13 @@ if 'FANCYLOG_SERVER' in os.environ:
         port = int(os.environ['FANCYLOG_SERVER_PORT'])
     port = int(port)
 
-    logToUDP(server, port)
-    _default_logTo = logToUDP
+    #FANCYLOG_SERVER_TRANSPORT tcp logs over a tcp connection (to a logdaemon started with --tcp)
+    if os.environ.get('FANCYLOG_SERVER_TRANSPORT') == 'tcp':
+        logToTCP(server, port)
+        _default_logTo = logToTCP
+    else:
+        logToUDP(server, port)
+        _default_logTo = logToUDP
 else:
     #log to screen by default
     logToScreen(enable=True)
@@ -144,6 +144,9 @@ class MPI(object):
 
     DEFAULT_RSH = None
 
+    # seconds the output of the probe commands (mpirun -info, ip addr, vsmpctl) is reused, shared between mympirun runs
+    PROBE_CACHE_TTL = 600
+
     HYDRA = None
     HYDRA_LAUNCHER_NAME = "launcher"
     # to be set in Sched subclasses, not here
@@ -323,7 +326,7 @@ class MPI(object):
         for idx, hn in enumerate(self.uniquenodes):
             ip = socket.gethostbyname(hn)
             cmd = "/sbin/ip -4 -o addr show to %s/32" % ip  # TODO ipv6
-            ec, out = run_simple(cmd)
+            ec, out = run_simple(cmd, cache_ttl=self.PROBE_CACHE_TTL)
             if ec == 0:
                 r = reg_iface.search(out)
                 if r:
@@ -402,7 +405,7 @@ class MPI(object):
         setattr(self.options, 'scalemp_vsmp', None)
 
         vsmpctl = "vsmpctl --status"
-        ec, out = run_simple_noworries(vsmpctl)
+        ec, out = run_simple_noworries(vsmpctl, cache_ttl=self.PROBE_CACHE_TTL)
         if ec > 0:
             self.log.debug("scalemp_vsmp: vSMP not found (cmd %s ec %s output %s)" % (vsmpctl, ec, out))
             return
@@ -502,7 +505,7 @@ class MPI(object):
                                     (self.netmasktype, device_ip_reg_map))
 
         cmd = "/sbin/ip addr show"
-        ec, out = run_simple(cmd)
+        ec, out = run_simple(cmd, cache_ttl=self.PROBE_CACHE_TTL)
         if ec > 0:
             self.log.raiseException("set_netmask: failed to run cmd %s: %s" % (cmd, out))
 
@@ -893,7 +896,7 @@ class MPI(object):
         reg_hydra_info = re.compile(r"^\s+(?P<key>\S[^:\n]*)\s*:(?P<value>.*?)\s*$", re.M)
 
         cmd = "mpirun -info"
-        ec, out = run_simple(cmd)
+        ec, out = run_simple(cmd, cache_ttl=self.PROBE_CACHE_TTL)
         if ec > 0:
             self.log.raiseException("get_hydra_info: failed to run cmd %s: %s" % (cmd, out))
 
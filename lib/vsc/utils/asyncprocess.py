@@ -58,12 +58,17 @@ and the methods will return None.
   - modified
     - added STDOUT handle
     - added maxread to recv_some (2012-08-30)
+    - pipes are set non-blocking once, waiting uses poll with a real timeout,
+      reads go into a preallocated buffer (recv_into) and writes use memoryview slices
+    - recv_some and recv_all read straight into one growing bytearray, the tr argument of recv_some is deprecated
 """
 
 import errno
+import io
 import os
 import subprocess
-import time
+
+from vsc.fancylogger import getLogger
 
 PIPE = subprocess.PIPE
 STDOUT = subprocess.STDOUT
@@ -72,7 +77,46 @@ import select  #@UnresolvedImport
 import fcntl  #@UnresolvedImport
 
 
+READSIZE = 64 * 1024  ## size of the preallocated read buffer
+_ZEROS = '\0' * READSIZE  ## to grow the bytearray of recv_some and recv_all
+
+_logger = getLogger("asyncprocess")
+_tr_deprecation_logged = False
+
+
+def set_nonblocking(conn):
+    """Set O_NONBLOCK on the file(handle)"""
+    flags = fcntl.fcntl(conn, fcntl.F_GETFL)
+    fcntl.fcntl(conn, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+
+
+def wait_fd(conn, event, timeout):
+    """Wait at most timeout seconds (None blocks) for event on the file(handle), return True if it happened"""
+    poller = select.poll()
+    poller.register(conn, event | select.POLLERR | select.POLLHUP)
+    if timeout is None:
+        timeout_ms = -1
+    else:
+        timeout_ms = int(timeout * 1000)
+    try:
+        return len(poller.poll(timeout_ms)) > 0
+    except select.error, why:
+        if why[0] == errno.EINTR:
+            return False
+        raise
+
+
 class Popen(subprocess.Popen):
+    def __init__(self, *args, **kwargs):
+        subprocess.Popen.__init__(self, *args, **kwargs)
+        ## set the pipes non-blocking once
+        for which in ['stdin', 'stdout', 'stderr']:
+            conn = getattr(self, which)
+            if conn is not None:
+                set_nonblocking(conn)
+        self._readers = {}
+        self.recv_buffer = bytearray(READSIZE)
+
     def recv(self, maxsize=None):
         return self._recv('stdout', maxsize)
 
@@ -92,12 +136,16 @@ class Popen(subprocess.Popen):
     def _close(self, which):
         getattr(self, which).close()
         setattr(self, which, None)
+        self._readers.pop(which, None)
 
-    def send(self, inp):
+    def send(self, inp, timeout=0):
+        """Write (part of) inp (string or memoryview) when stdin is writable within timeout seconds (None blocks)
+            return number of bytes written, None when stdin is closed
+        """
         if not self.stdin:
             return None
 
-        if not select.select([], [self.stdin], [], 0)[1]:
+        if not wait_fd(self.stdin, select.POLLOUT, timeout):
             return 0
 
         try:
@@ -105,68 +153,125 @@ class Popen(subprocess.Popen):
         except OSError, why:
             if why[0] == errno.EPIPE: #broken pipe
                 return self._close('stdin')
+            elif why[0] in (errno.EAGAIN, errno.EINTR):
+                return 0
             raise
 
         return written
 
-    def _recv(self, which, maxsize):
-        conn, maxsize = self.get_conn_maxsize(which, maxsize)
+    def recv_into(self, buf, which='stdout', timeout=0):
+        """Read into buf (bytearray or memoryview) when data is available within timeout seconds (None blocks)
+            return number of bytes read, 0 if there is nothing to read, None when the pipe is closed
+        """
+        conn = getattr(self, which)
         if conn is None:
             return None
 
-        flags = fcntl.fcntl(conn, fcntl.F_GETFL)
-        if not conn.closed:
-            fcntl.fcntl(conn, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+        if not wait_fd(conn, select.POLLIN | select.POLLPRI, timeout):
+            return 0
+
+        reader = self._readers.get(which)
+        if reader is None:
+            reader = io.FileIO(conn.fileno(), 'rb', closefd=False)
+            self._readers[which] = reader
 
         try:
-            if not select.select([conn], [], [], 0)[0]:
-                return ''
+            nbytes = reader.readinto(buf)
+        except IOError, why:
+            if why[0] in (errno.EAGAIN, errno.EINTR):
+                return 0
+            raise
 
-            r = conn.read(maxsize)
-            if not r:
-                return self._close(which)  ## SDW: close when nothing left to read
+        if nbytes is None:
+            ## EAGAIN
+            return 0
+        elif nbytes == 0:
+            self._close(which)
+            return None
+        return nbytes
+
+    def _recv(self, which, maxsize):
+        conn, maxsize = self.get_conn_maxsize(which, maxsize)
+        if conn is None:
+            return None
+
+        if maxsize < 0 or maxsize > READSIZE:
+            maxsize = READSIZE
+        nbytes = self.recv_into(memoryview(self.recv_buffer)[:maxsize], which)
+        if nbytes is None:
+            return None  ## SDW: close when nothing left to read
 
-            if self.universal_newlines:
-                r = self._translate_newlines(r)
-            return r
-        finally:
-            if not conn.closed:
-                fcntl.fcntl(conn, fcntl.F_SETFL, flags)
+        r = str(self.recv_buffer[:nbytes])
+        if self.universal_newlines:
+            r = self._translate_newlines(r)
+        return r
 
 message = "Other end disconnected!"
 
-def recv_some(p, t=.1, e=False, tr=5, stderr=False, maxread= -1):
+def _recv_bytes(p, which, maxread, timeout, timeout_next, eof=False):
+    """Read straight into one growing bytearray, return (the data, True if the pipe is closed)
+        - at most maxread bytes (maxread < 0: no limit)
+        - wait at most timeout seconds (None blocks) for the first read, timeout_next for the next reads
+        - stop when nothing is read (with eof, only at the end of the file) or the pipe is closed
+    """
+    buf = bytearray()
+    nread = 0
+    closed = False
+    while maxread < 0 or nread < maxread:
+        size = READSIZE
+        if maxread >= 0:
+            size = min(size, maxread - nread)
+        if len(buf) < nread + size:
+            ## grow, there is no memoryview of buf left
+            buf += buffer(_ZEROS, 0, nread + size - len(buf))
+        nbytes = p.recv_into(memoryview(buf)[nread:nread + size], which, timeout)
+        if nbytes is None:
+            closed = True
+            break
+        elif nbytes == 0 and not eof:
+            break
+        nread += nbytes
+        timeout = timeout_next
+    del buf[nread:]
+    return str(buf), closed
+
+def recv_some(p, t=.1, e=False, tr=None, stderr=False, maxread= -1):
     """
     Changes made:
       - add maxread here
       - set e to False
+      - wait at most t seconds for data (poll), then return all data that is available
+      - tr is deprecated and ignored
     """
-    if tr < 1:
-        tr = 1
-    x = time.time() + t
-    y = []
-    len_y = 0
-    r = ''
-    pr = p.recv
+    global _tr_deprecation_logged
+    if tr is not None and not _tr_deprecation_logged:
+        _logger.warning("recv_some: the tr argument is deprecated and ignored")
+        _tr_deprecation_logged = True
+
+    which = 'stdout'
     if stderr:
-        pr = p.recv_err
-    while (maxread < 0 or len_y <= maxread) and (time.time() < x or r):
-        r = pr(maxread)
-        if r is None:
-            if e:
-                raise Exception(message)
-            else:
-                break
-        elif r:
-            y.append(r)
-            len_y += len(r)
-        else:
-            time.sleep(max((x - time.time()) / tr, 0))
-    return ''.join(y)
+        which = 'stderr'
+
+    data, closed = _recv_bytes(p, which, maxread, t, 0)
+    if closed and e:
+        raise Exception(message)
+    return data
+
+def recv_all(p, stderr=False):
+    """Read until EOF (blocking)"""
+    which = 'stdout'
+    if stderr:
+        which = 'stderr'
+
+    return _recv_bytes(p, which, -1, None, None, eof=True)[0]
 
 def send_all(p, data):
-    while len(data):
-        sent = p.send(data)
+    if isinstance(data, unicode):
+        ## memoryview needs the buffer interface
+        data = data.encode('utf-8')
+    view = memoryview(data)
+    while len(view):
+        sent = p.send(view, timeout=None)
         if sent is None:
             raise Exception(message)
-        data = buffer(data, sent)
+        view = view[sent:]
@@ -33,11 +33,237 @@ try:
 except:
     import pickle
 
+import errno
+import fcntl
+import json
+import marshal
+import mmap
+import os
+import struct
+import tempfile
 import time
+import zlib
+from abc import ABCMeta, abstractmethod
 
 from vsc import fancylogger
 
 
+class FileLock(object):
+    """Advisory lock (fcntl.flock) on a lock file, shared or exclusive.
+
+    If the lock file can not be created or opened (eg a reader without write permission in the directory),
+    the lock is not taken and acquire() returns False.
+    """
+    POLL_MIN = 0.01
+    POLL_MAX = 0.5
+
+    def __init__(self, filename):
+        self.log = fancylogger.getLogger(self.__class__.__name__)
+        self.filename = filename
+        self.fd = None
+
+    def _open(self):
+        """Open the lock file, return True on success"""
+        for flags in [os.O_RDWR | os.O_CREAT, os.O_RDONLY]:
+            try:
+                self.fd = os.open(self.filename, flags, 0666)
+                return True
+            except OSError, err:
+                self.log.debug("Could not open lock file %s with flags %s: %s" % (self.filename, flags, err))
+        return False
+
+    def acquire(self, shared=False, timeout=None):
+        """Acquire the lock, shared or exclusive.
+
+        @param timeout: seconds to wait for the lock, None waits forever
+
+        @returns: True if the lock is held, False if there is no lock file
+        """
+        if self.fd is None and not self._open():
+            return False
+
+        operation = (shared and fcntl.LOCK_SH) or fcntl.LOCK_EX
+        deadline = None
+        if timeout is not None:
+            operation |= fcntl.LOCK_NB
+            deadline = time.time() + timeout
+        poll = self.POLL_MIN
+        while True:
+            try:
+                fcntl.flock(self.fd, operation)
+                return True
+            except IOError, err:
+                if err.errno == errno.EINTR:
+                    continue
+                elif deadline is None or err.errno not in (errno.EAGAIN, errno.EACCES) or time.time() >= deadline:
+                    os.close(self.fd)
+                    self.fd = None
+                    self.log.raiseException("Could not acquire %s lock on %s within %s seconds" %
+                                            ((shared and 'shared') or 'exclusive', self.filename, timeout),
+                                            IOError)
+            time.sleep(min(poll, max(deadline - time.time(), 0)))
+            poll = min(2 * poll, self.POLL_MAX)
+
+    def release(self):
+        """Release the lock"""
+        if self.fd is not None:
+            fcntl.flock(self.fd, fcntl.LOCK_UN)
+            os.close(self.fd)
+            self.fd = None
+
+
+class Serializer(object):
+    """Serializer of the FileCache data (FileCache: a list of (key, timestamp, data) tuples, FileCacheIndexed:
+    the data of one entry).
+
+    The file starts with HEADER_PREFIX and the TAG of the serializer, so the format is detected when reading.
+    Subclasses set TAG and implement dumps and loads.
+    """
+    __metaclass__ = ABCMeta
+
+    HEADER_PREFIX = 'VSCFCS\x00\x01'
+    TAG = None
+
+    def header(self):
+        return self.HEADER_PREFIX + self.TAG
+
+    @abstractmethod
+    def dumps(self, obj):
+        """Return the serialized obj (a str)"""
+
+    @abstractmethod
+    def loads(self, data):
+        """Return the object serialized in data"""
+
+
+class PickleSerializer(Serializer):
+    """pickle with the highest protocol: any data that can be pickled"""
+    TAG = 'pckl'
+
+    def dumps(self, obj):
+        return pickle.dumps(obj, pickle.HIGHEST_PROTOCOL)
+
+    def loads(self, data):
+        return pickle.loads(data)
+
+
+class MarshalSerializer(Serializer):
+    """marshal: fast and compact, only for builtin types (no datetime, no instances)"""
+    TAG = 'mrsh'
+    VERSION = 2
+
+    def dumps(self, obj):
+        return marshal.dumps(obj, self.VERSION)
+
+    def loads(self, data):
+        return marshal.loads(data)
+
+
+def _tuples(obj):
+    """Convert the lists in obj to tuples (recursively)"""
+    if isinstance(obj, list):
+        return tuple([_tuples(x) for x in obj])
+    return obj
+
+
+class JsonSerializer(Serializer):
+    """JSON: readable by other tools, only for str, int, float, list and dict data
+        tuples become lists (keys are converted back into tuples), and str becomes unicode
+    """
+    TAG = 'json'
+
+    def dumps(self, obj):
+        return json.dumps(obj, separators=(',', ':'))
+
+    def loads(self, data):
+        return json.loads(data)
+
+
+SERIALIZERS = dict([(klass.TAG, klass) for klass in [PickleSerializer, MarshalSerializer, JsonSerializer]])
+SERIALIZER_NAMES = {
+    'pickle': PickleSerializer,
+    'marshal': MarshalSerializer,
+    'json': JsonSerializer,
+}
+
+
+def get_serializer(serializer):
+    """Return the Serializer instance for serializer (an instance, a name or None)"""
+    if serializer is None or isinstance(serializer, Serializer):
+        return serializer
+    return SERIALIZER_NAMES[serializer]()
+
+
+class CacheEviction(object):
+    """Eviction policy for a FileCache.
+
+    An entry is evicted when it is older than ttl seconds (based on its stored timestamp), or when there are
+    more than max_entries entries or more than max_bytes (pickled) bytes of data: then the least recently
+    used entries (with lru, last access by load() or update() in this session, else the stored timestamp)
+    or the oldest entries (without lru) are evicted first.
+
+    The policy is applied incrementally by update(), once the limits are exceeded by more than
+    INCREMENTAL_SLACK (fraction of the limit), and fully on close.
+    """
+    INCREMENTAL_SLACK = 0.1
+
+    def __init__(self, max_entries=None, max_bytes=None, ttl=None, lru=True):
+        """
+        @type max_entries: int
+        @type max_bytes: int
+        @type ttl: int
+        @type lru: boolean
+        """
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.lru = lru
+
+    def expired(self, ts, now=None):
+        """Is data with timestamp ts expired"""
+        if self.ttl is None:
+            return False
+        if now is None:
+            now = time.time()
+        return now - ts > self.ttl
+
+    def exceeded(self, entries, size):
+        """Are the limits exceeded by more than INCREMENTAL_SLACK"""
+        slack = 1 + self.INCREMENTAL_SLACK
+        return ((self.max_entries is not None and entries > self.max_entries * slack) or
+                (self.max_bytes is not None and size > self.max_bytes * slack))
+
+    def select(self, entries, now=None):
+        """Return the set of keys to evict.
+
+        @param entries: list of (key, timestamp, last access, size); the size is only used with max_bytes
+        """
+        evict = set()
+        keep = []
+        for (key, ts, atime, size) in entries:
+            if self.expired(ts, now):
+                evict.add(key)
+            elif self.lru:
+                keep.append((atime, key, size))
+            else:
+                keep.append((ts, key, size))
+
+        count = len(keep)
+        size = 0
+        if self.max_bytes is not None:
+            size = sum([entry[2] for entry in keep])
+
+        keep.sort()
+        for (_, key, entry_size) in keep:
+            if not ((self.max_entries is not None and count > self.max_entries) or
+                    (self.max_bytes is not None and size > self.max_bytes)):
+                break
+            evict.add(key)
+            count -= 1
+            size -= entry_size
+        return evict
+
+
 class FileCache(object):
     """File cache with a timestamp safety.
 
@@ -54,9 +280,22 @@ class FileCache(object):
     Note that the cache is persistent only when it is closed correctly.
     During a crash of your application ar runtime, the information is
     _not_ written to the file.
+
+    With lock=True, several processes can use the same cache file: the file is read with a shared lock
+    on filename.lock, and close() takes an exclusive lock, reads the file again and merges it with the
+    updates. Per key, the data with the most recent timestamp wins; data that was stored by another
+    process after this cache was read is kept, also when the non-updated data is discarded.
+
+    With an eviction policy (see CacheEviction), the number of entries, the size of the data and the age
+    of the entries can be limited. The hits, misses and evictions are counted in the stats dictionary.
+
+    The file is a pickled dictionary, unless a serializer (see SERIALIZER_NAMES) is set: then the file
+    starts with a header with the format. Both kinds of files are read, whatever the serializer is.
     """
+    LOCK_SUFFIX = '.lock'
+    OPEN_LOCK_SHARED = True
 
-    def __init__(self, filename, retain_old=False):
+    def __init__(self, filename, retain_old=False, lock=False, lock_timeout=None, eviction=None, serializer=None):
         """Initializer.
 
         Checks if the file can be accessed and load the data therein if any. If the file does not yet exist, start
@@ -64,18 +303,62 @@ class FileCache(object):
         The file is closed after reading the data.
 
         @type filename: string
+        @type lock: boolean
+        @type lock_timeout: int
 
         @param filename: (absolute) path to the cache file.
+        @param lock: use a lock file, and merge the updates with the current file on close
+        @param lock_timeout: seconds to wait for the lock (None waits forever), IOError after the timeout
+        @param eviction: CacheEviction instance
+        @param serializer: Serializer instance or name to write the file with
         """
 
         self.log = fancylogger.getLogger(self.__class__.__name__)
         self.filename = filename
         self.retain_old = retain_old
+        self.serializer = get_serializer(serializer)
+
+        self.lock_timeout = lock_timeout
+        self._lock = None
+        if lock:
+            self._lock = FileLock(self.filename + self.LOCK_SUFFIX)
+        self._open_time = time.time()
 
+        self._acquire(shared=self.OPEN_LOCK_SHARED)
+        try:
+            self.shelf = self._read()
+        finally:
+            self._release()
+
+        if not self.shelf:
+            self.log.info("Cache in %s starts with an empty shelf" % (self.filename))
+
+        self.new_shelf = {}
+
+        self.eviction = eviction
+        self.stats = {'hits': 0, 'misses': 0, 'evictions': 0}
+        self._access = {}  # last access time per key
+        self._evicted = {}  # timestamp of the data per key evicted
+        self._sizes = {}  # pickled size per key
+        self._count = len(self.shelf)  # number of entries, for the incremental eviction
+        self._size_total = None  # size of all entries, computed on first use
+
+    def _acquire(self, shared):
+        """Acquire the lock, if any"""
+        if self._lock is not None:
+            self._lock.acquire(shared=shared, timeout=self.lock_timeout)
+
+    def _release(self):
+        """Release the lock, if any"""
+        if self._lock is not None:
+            self._lock.release()
+
+    def _read(self):
+        """Return the data in the file, an empty dictionary if there is no file."""
         try:
             f = open(self.filename, 'rb')
             try:
-                self.shelf = pickle.load(f)
+                return self._loads(f.read())
             except:
                 self.log.raiseException("Could not load pickle data from %s" % (self.filename))
             finally:
@@ -83,12 +366,120 @@ class FileCache(object):
 
         except (OSError, IOError), err:
             self.log.error("Could not access the file cache at %s [%s]" % (self.filename, err))
-            self.shelf = {}
+            return {}
 
-        if not self.shelf:
-            self.log.info("Cache in %s starts with an empty shelf" % (self.filename))
+    def _loads(self, data):
+        """Return the dictionary with the data, detect the serializer from the header"""
+        prefix = Serializer.HEADER_PREFIX
+        if data.startswith(prefix):
+            tag = data[len(prefix):len(prefix) + 4]
+            if tag not in SERIALIZERS:
+                self.log.raiseException("Unknown serializer %s in %s" % (tag, self.filename))
+            entries = SERIALIZERS[tag]().loads(data[len(prefix) + 4:])
+            return dict([(_tuples(key), (ts, value)) for (key, ts, value) in entries])
+        return pickle.loads(data)
 
-        self.new_shelf = {}
+    def _dumps(self, shelf):
+        """Return the shelf serialized with the serializer (as a pickled dictionary without serializer)"""
+        if self.serializer is None:
+            return pickle.dumps(shelf, pickle.HIGHEST_PROTOCOL)
+        entries = [(key, value[0], value[1]) for (key, value) in shelf.items()]
+        try:
+            return self.serializer.header() + self.serializer.dumps(entries)
+        except (ValueError, TypeError):
+            self.log.raiseException("Could not serialize the data for %s with %s" %
+                                    (self.filename, self.serializer.__class__.__name__))
+
+    def _keep(self, key, ts):
+        """Keep the data of key with timestamp ts that was not updated: with retain_old (unless it was evicted),
+        or (with lock) when it was stored by another process after this cache was opened
+        """
+        if self._lock is not None and (key not in self.shelf or _timestamp(self.shelf, key) != ts):
+            return True
+        return self.retain_old and key not in self._evicted
+
+    def _merge(self, current):
+        """Return the data to write: the data to keep from current, and the updates if they are more recent"""
+        merged = {}
+        for (key, value) in current.items():
+            if self._keep(key, value[0]):
+                merged[key] = value
+        for (key, value) in self.new_shelf.items():
+            if key not in merged or value[0] >= merged[key][0]:
+                merged[key] = value
+
+        for key in self._select_evict([(key, value[0], self._size(key, value)) for (key, value) in merged.items()]):
+            del merged[key]
+        return merged
+
+    def _size(self, key, value=None):
+        """Return the pickled size of value of key (default the value in the shelf), only needed with max_bytes"""
+        if self.eviction is None or self.eviction.max_bytes is None:
+            return 0
+        if key not in self._sizes:
+            if value is None:
+                value = self.shelf[key]
+            self._sizes[key] = len(pickle.dumps(value, pickle.HIGHEST_PROTOCOL))
+        return self._sizes[key]
+
+    def _entries(self):
+        """Generator of (key, timestamp, size) of the entries in memory"""
+        for (key, value) in self.new_shelf.items():
+            yield (key, value[0], self._size(key, value))
+        for key in self.shelf:
+            if key not in self.new_shelf and key not in self._evicted:
+                yield (key, _timestamp(self.shelf, key), self._size(key))
+
+    def _select_evict(self, entries):
+        """Return the keys to evict from entries (key, timestamp, size) according to the eviction policy"""
+        if self.eviction is None:
+            return set()
+        now = time.time()
+        keys = self.eviction.select([(key, ts, self._access.get(key, ts), size) for (key, ts, size) in entries],
+                                    now=now)
+        self.stats['evictions'] += len(keys)
+        return keys
+
+    def _evict(self, keys):
+        """Evict keys from the data in memory"""
+        for key in keys:
+            if key in self.new_shelf:
+                ts = self.new_shelf[key][0]
+                size = self._size(key, self.new_shelf[key])
+                del self.new_shelf[key]
+            elif key in self.shelf and key not in self._evicted:
+                ts = _timestamp(self.shelf, key)
+                size = self._size(key)
+            else:
+                continue
+            self._evicted[key] = ts
+            self._count -= 1
+            if self._size_total is not None:
+                self._size_total -= size
+
+    def _evict_incremental(self):
+        """Apply the eviction policy if the limits are exceeded"""
+        if self.eviction is None:
+            return
+        if self._size_total is None and self.eviction.max_bytes is not None:
+            self._size_total = sum([size for (_, _, size) in self._entries()])
+        if self.eviction.exceeded(self._count, self._size_total or 0):
+            self._evict(self._select_evict(self._entries()))
+
+    def _get(self, key):
+        """Return the data for key (None if there is none, or it expired)"""
+        if key in self.new_shelf:
+            value = self.new_shelf[key]
+        elif key in self._evicted:
+            return None
+        else:
+            value = self.shelf.get(key, None)
+
+        if value is not None and self.eviction is not None and self.eviction.expired(value[0]):
+            self._evict([key])
+            self.stats['evictions'] += 1
+            return None
+        return value
 
     def update(self, key, data, threshold):
         """Update the given data if the existing data is older than the given threshold.
@@ -102,7 +493,7 @@ class FileCache(object):
         @param threshold: time in seconds
         """
         now = time.time()
-        old = self.load(key)
+        old = self._get(key)
         if old:
             (ts, _) = old
             if now - ts > threshold:
@@ -112,6 +503,19 @@ class FileCache(object):
         else:
             self.new_shelf[key] = (now, data)
 
+        if old is None:
+            self._count += 1
+            self._evicted.pop(key, None)
+        if self.eviction is not None:
+            self._access[key] = now
+            if old is not self.new_shelf[key]:
+                if self._size_total is not None:
+                    self._size_total -= self._sizes.pop(key, 0)
+                    self._size_total += self._size(key, self.new_shelf[key])
+                else:
+                    self._sizes.pop(key, None)
+            self._evict_incremental()
+
     def load(self, key):
         """Load the stored data for the given key along with the timestamp it was stored.
 
@@ -119,7 +523,14 @@ class FileCache(object):
 
         @returns: (timestamp, data) if there is data for the given key, None otherwise.
         """
-        return self.shelf.get(key, None) or self.new_shelf.get(key, None)
+        value = self._get(key)
+        if value is None:
+            self.stats['misses'] += 1
+        else:
+            self.stats['hits'] += 1
+            if self.eviction is not None:
+                self._access[key] = time.time()
+        return value
 
     def retain(self):
         """Retain non-updated data on close."""
@@ -131,15 +542,694 @@ class FileCache(object):
 
     def close(self):
         """Close the cache."""
+        self._acquire(shared=False)
+        try:
+            current = self.shelf
+            if self._lock is not None:
+                ## include the data stored by others since the cache was opened
+                current = self._read()
+
+            self.new_shelf = self._merge(current)
+            data = self._dumps(self.new_shelf)
+            f = open(self.filename, 'wb')
+            if not f:
+                self.log.error('cannot open the file cache at %s for writing' % (self.filename))
+            else:
+                f.write(data)
+                f.close()
+                self.log.info('closing the file cache at %s' % (self.filename))
+        finally:
+            self._release()
+
+
+def _timestamp(shelf, key):
+    """Return the timestamp of the data of key in shelf"""
+    if isinstance(shelf, IndexedShelf):
+        return shelf.timestamp(key)
+    return shelf[key][0]
+
+
+def write_atomic(filename, data):
+    """Replace filename with data, so readers see either the old or the new content, also after a crash.
+
+    The data (a string or an iterable of strings) is written to a temporary file in the same directory,
+    which is fsync'ed and renamed over filename. The mode of an existing filename is kept.
+    """
+    if isinstance(data, basestring):
+        data = [data]
+    dirname = os.path.dirname(os.path.abspath(filename))
+    (fd, tmpname) = tempfile.mkstemp(dir=dirname, prefix='.%s.' % os.path.basename(filename))
+    try:
+        try:
+            os.fchmod(fd, os.stat(filename).st_mode & 07777)
+        except OSError:
+            os.fchmod(fd, 0666 & ~_umask())
+        for chunk in data:
+            while chunk:
+                written = os.write(fd, chunk)
+                chunk = chunk[written:]
+        os.fsync(fd)
+    except:
+        os.close(fd)
+        os.unlink(tmpname)
+        raise
+    os.close(fd)
+    os.rename(tmpname, filename)
+    try:
+        dirfd = os.open(dirname, os.O_RDONLY)
+        try:
+            os.fsync(dirfd)
+        finally:
+            os.close(dirfd)
+    except OSError:
+        pass
+
+
+def _umask():
+    """Return the current umask"""
+    mask = os.umask(0)
+    os.umask(mask)
+    return mask
+
+
+class FileCacheJournal(FileCache):
+    """File cache that appends every update to a journal, instead of rewriting everything on close.
+
+    The data is kept in two files:
+        - the snapshot filename, a pickled dictionary like the FileCache file (a FileCache file can be used
+          as a snapshot, and the snapshot can be read by FileCache after compact())
+        - the journal filename.journal, with one record per update(), appended and flushed to the OS immediately;
+          with sync=True, every record is also fsync'ed
+
+    A crash of the application loses nothing that was updated; a partially written record is detected with
+    its checksum and skipped (the records appended after it are still replayed).
+
+    Opening the cache loads the snapshot and replays the journal. With lock=True, a partial record at the end
+    is truncated, and when the journal is larger than COMPACT_RATIO times the snapshot (and at least
+    COMPACT_MIN_SIZE bytes), the cache is compacted on open: the snapshot is rewritten atomically (temporary
+    file, fsync and rename) and the journal is removed. Without lock, opening the cache never changes the files
+    (the partial record can be a record another process is writing). compact() can also be called explicitly,
+    eg from a cron job.
+
+    close() only appends a record with the updated keys when the non-updated data is discarded
+    (retain_old=False, as in FileCache); the other keys with data older than the opening of the cache
+    are dropped on replay. The evicted keys are also recorded on close.
+
+    With lock=True, the cache is opened (and compacted) with an exclusive lock, the records are appended
+    with a shared lock: several processes can append to the journal at the same time. Using the cache from
+    several processes without lock is not safe: compact() removes the records other processes append meanwhile.
+    """
+    JOURNAL_SUFFIX = '.journal'
+    COMPACT_RATIO = 1.0
+    COMPACT_MIN_SIZE = 1024 * 1024
+    OPEN_LOCK_SHARED = False
+
+    RECORD_HEADER = struct.Struct('!II')  # length and crc32 of the pickled record
+    RECORD_SET = 's'
+    RECORD_KEEP = 'k'
+    RECORD_DELETE = 'd'
+
+    def __init__(self, filename, retain_old=False, sync=False, **kwargs):
+        """Initializer.
+
+        Loads the snapshot and replays the journal, compacting it if it has grown too large.
+
+        @type filename: string
+        @type sync: boolean
+
+        @param filename: (absolute) path to the snapshot file, the journal is filename.journal
+        @param sync: fsync the journal after each update
+        """
+        self.journal_filename = filename + self.JOURNAL_SUFFIX
+        self.sync = sync
+        self._journal_fd = None
+
+        super(FileCacheJournal, self).__init__(filename, retain_old, **kwargs)
+
+    def _read(self):
+        """Return the data of the snapshot and the journal, compact if the journal is too large."""
+        shelf = super(FileCacheJournal, self)._read()
+        journal_size = self._replay(shelf)
+        if journal_size > max(self.COMPACT_MIN_SIZE, self.COMPACT_RATIO * self._snapshot_size()):
+            if self._lock is None:
+                ## other processes may be appending
+                self.log.debug("Not compacting the file cache at %s on open without lock" % (self.filename))
+            else:
+                self._compact(shelf)
+        return shelf
 
-        f = open(self.filename, 'wb')
-        if not f:
-            self.log.error('cannot open the file cache at %s for writing' % (self.filename))
+    def _snapshot_size(self):
+        """Return the size of the snapshot file"""
+        try:
+            return os.path.getsize(self.filename)
+        except OSError:
+            return 0
+
+    def _replay(self, shelf):
+        """Apply the records of the journal to shelf, return the size of the journal up to the last valid record
+
+        A partial record is skipped; at the end of the journal, it is truncated when the lock is held.
+        """
+        try:
+            f = open(self.journal_filename, 'rb')
+            try:
+                journal = f.read()
+            finally:
+                f.close()
+        except (OSError, IOError), err:
+            if err.errno != errno.ENOENT:
+                self.log.raiseException("Could not read the journal %s" % (self.journal_filename))
+            return 0
+
+        offset = 0
+        records = 0
+        while offset < len(journal):
+            end = self._record_end(journal, offset)
+            if end is None:
+                ## partial record (crash during an append): continue with the next valid record, if any
+                start = offset + 1
+                while start < len(journal) and self._record_end(journal, start) is None:
+                    start += 1
+                if start == len(journal):
+                    break
+                self.log.warning("Skipping %s bytes of incomplete journal record in %s" %
+                                 (start - offset, self.journal_filename))
+                offset = start
+                continue
+            self._apply(shelf, pickle.loads(journal[offset + self.RECORD_HEADER.size:end]))
+            offset = end
+            records += 1
+
+        if offset < len(journal):
+            if self._lock is None:
+                self.log.warning("Skipping %s bytes of incomplete journal record at the end of %s" %
+                                 (len(journal) - offset, self.journal_filename))
+            else:
+                self.log.warning("Dropping %s bytes of incomplete journal record in %s" %
+                                 (len(journal) - offset, self.journal_filename))
+                f = open(self.journal_filename, 'r+b')
+                try:
+                    f.truncate(offset)
+                finally:
+                    f.close()
+
+        self.log.debug("Replayed %s records from journal %s" % (records, self.journal_filename))
+        return offset
+
+    def _record_end(self, journal, offset):
+        """Return the end of the valid record at offset in journal, None if there is none"""
+        header_size = self.RECORD_HEADER.size
+        if offset + header_size > len(journal):
+            return None
+        (length, crc) = self.RECORD_HEADER.unpack_from(journal, offset)
+        end = offset + header_size + length
+        if end > len(journal) or zlib.crc32(journal[offset + header_size:end]) & 0xffffffff != crc:
+            return None
+        return end
+
+    def _apply(self, shelf, record):
+        """Apply a journal record to shelf"""
+        if record[0] == self.RECORD_SET:
+            (_, key, value) = record
+            shelf[key] = value
+        elif record[0] == self.RECORD_KEEP:
+            (_, keep, since) = record
+            keep = set(keep)
+            for key in shelf.keys():
+                if key not in keep and shelf[key][0] < since:
+                    del shelf[key]
+        elif record[0] == self.RECORD_DELETE:
+            ## only if the data was not updated since
+            for (key, ts) in record[1]:
+                if key in shelf and shelf[key][0] == ts:
+                    del shelf[key]
         else:
-            if self.retain_old:
-                self.shelf.update(self.new_shelf)
-                self.new_shelf = self.shelf
+            self.log.raiseException("Unknown record type %s in journal %s" % (record[0], self.journal_filename))
+
+    def _append(self, record):
+        """Append a record to the journal"""
+        payload = pickle.dumps(record, pickle.HIGHEST_PROTOCOL)
+        data = self.RECORD_HEADER.pack(len(payload), zlib.crc32(payload) & 0xffffffff) + payload
+
+        self._acquire(shared=True)
+        try:
+            if self._journal_fd is None:
+                self._journal_fd = os.open(self.journal_filename, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0666)
+            ## single write with O_APPEND, a crash leaves at most one partial record at the end
+            while data:
+                written = os.write(self._journal_fd, data)
+                data = data[written:]
+            if self.sync:
+                os.fsync(self._journal_fd)
+        finally:
+            if self._lock is not None:
+                ## a compaction can remove the journal once the lock is released
+                self._close_journal()
+            self._release()
+
+    def update(self, key, data, threshold):
+        """Update the given data if the existing data is older than the given threshold.
+
+        The new data is appended to the journal.
+        """
+        old = self._get(key)
+        super(FileCacheJournal, self).update(key, data, threshold)
+        if self.new_shelf[key] is not old:
+            self._append((self.RECORD_SET, key, self.new_shelf[key]))
+
+    def _compact(self, shelf):
+        """Write shelf as the snapshot and remove the journal."""
+        write_atomic(self.filename, self._dumps(shelf))
+        ## the journal records are in the snapshot now; replaying them again after a crash right here is harmless
+        self._close_journal()
+        try:
+            os.unlink(self.journal_filename)
+        except OSError, err:
+            if err.errno != errno.ENOENT:
+                raise
+        self.log.info("Compacted the file cache at %s" % (self.filename))
+
+    def compact(self):
+        """Rewrite the snapshot with the current data and remove the journal."""
+        self._acquire(shared=False)
+        try:
+            shelf = super(FileCacheJournal, self)._read()
+            self._replay(shelf)
+            self._compact(shelf)
+            self.shelf = shelf
+        finally:
+            self._release()
+
+    def _close_journal(self):
+        if self._journal_fd is not None:
+            os.close(self._journal_fd)
+            self._journal_fd = None
+
+    def close(self):
+        """Close the cache.
+
+        The updates are in the journal already; if the non-updated data is discarded, record which keys to keep.
+        """
+        if self.eviction is not None:
+            self._evict(self._select_evict(self._entries()))
+        if self._evicted:
+            self._append((self.RECORD_DELETE, self._evicted.items()))
+        if not self.retain_old:
+            self._append((self.RECORD_KEEP, self.new_shelf.keys(), self._open_time))
+            self.shelf = dict(self.new_shelf)
+        self._close_journal()
+        self.log.info('closing the file cache at %s' % (self.filename))
 
-            pickle.dump(self.new_shelf, f)
+
+class IndexedShelf(object):
+    """Read-only dictionary view on a FileCacheIndexed file, the values are deserialized on first access"""
+
+    def __init__(self, mm, index, serializer):
+        """
+        @param mm: mmap of the file
+        @param index: dictionary key -> (offset, length, timestamp) of the serialized data
+        @param serializer: Serializer of the data
+        """
+        self.mm = mm
+        self.index = index
+        self.serializer = serializer
+        self.values = {}  # the deserialized (timestamp, data)
+
+    def __len__(self):
+        return len(self.index)
+
+    def __contains__(self, key):
+        return key in self.index
+
+    def __iter__(self):
+        return iter(self.index)
+
+    def keys(self):
+        return self.index.keys()
+
+    def __getitem__(self, key):
+        if key not in self.values:
+            self.values[key] = (self.index[key][2], self.serializer.loads(self.raw(key)))
+        return self.values[key]
+
+    def get(self, key, default=None):
+        if key in self.index:
+            return self[key]
+        return default
+
+    def raw(self, key):
+        """Return the serialized data of key"""
+        (offset, length, _) = self.index[key]
+        return self.mm[offset:offset + length]
+
+    def timestamp(self, key):
+        """Return the timestamp of the data of key, without deserializing it"""
+        return self.index[key][2]
+
+    def close(self):
+        if self.mm is not None:
+            self.mm.close()
+            self.mm = None
+
+
+class FileCacheIndexed(FileCache):
+    """File cache that only deserializes the entries that are used.
+
+    The file has a fixed size header (magic, serializer, offset and length of the index), the serialized data
+    (pickle by default) and the pickled index (key -> offset, length and timestamp of the data). Opening
+    the cache maps the file and only unpickles the index; load(key) deserializes the data of key.
+    Retained entries are copied to the new file without deserializing them (if the serializer is the same).
+
+    A file in the FileCache format is read as a whole, and converted on close.
+    """
+    MAGIC = 'VSCFCI\x00\x03'
+    HEADER = struct.Struct('!8s4sQQ')
+
+    def _serializer(self):
+        """Return the serializer of the data"""
+        return self.serializer or PickleSerializer()
+
+    def _read(self):
+        """Map the file and return the IndexedShelf (or the dictionary of a FileCache file)."""
+        try:
+            f = open(self.filename, 'rb')
+        except (OSError, IOError), err:
+            self.log.error("Could not access the file cache at %s [%s]" % (self.filename, err))
+            return {}
+
+        try:
+            try:
+                size = os.fstat(f.fileno()).st_size
+                header = f.read(self.HEADER.size)
+                if len(header) == self.HEADER.size and header.startswith(self.MAGIC):
+                    (_, tag, offset, length) = self.HEADER.unpack(header)
+                    mm = mmap.mmap(f.fileno(), size, access=mmap.ACCESS_READ)
+                    return IndexedShelf(mm, pickle.loads(mm[offset:offset + length]), SERIALIZERS[tag]())
+                elif size == 0:
+                    return {}
+                else:
+                    f.seek(0)
+                    return self._loads(f.read())
+            except:
+                self.log.raiseException("Could not load the data from %s" % (self.filename))
+        finally:
             f.close()
-            self.log.info('closing the file cache at %s' % (self.filename))
+
+    def _size(self, key, value=None):
+        """Return the pickled size of value of key, from the index for the data in the file"""
+        if value is None and isinstance(self.shelf, IndexedShelf) and key not in self._sizes:
+            return self.shelf.index[key][1]
+        return super(FileCacheIndexed, self)._size(key, value)
+
+    def _chunks(self, current):
+        """Generator of the chunks of the file with the data to keep from current and the updates"""
+        serializer = self._serializer()
+        ## (key, timestamp, serialized data), and the keys of the data copied as is from the current file
+        copy = isinstance(current, IndexedShelf) and current.serializer.TAG == serializer.TAG
+        new = dict(self.new_shelf)
+        entries = []
+        copied = []
+        for key in current:
+            ts = _timestamp(current, key)
+            if key in new:
+                if new[key][0] >= ts:
+                    continue
+                del new[key]
+            elif not self._keep(key, ts):
+                continue
+
+            if copy:
+                copied.append((key, ts))
+            else:
+                entries.append((key, ts, serializer.dumps(current[key][1])))
+        for (key, value) in new.items():
+            entries.append((key, value[0], serializer.dumps(value[1])))
+
+        if self.eviction is not None:
+            evict = self._select_evict([(key, ts, len(value)) for (key, ts, value) in entries] +
+                                       [(key, ts, current.index[key][1]) for (key, ts) in copied])
+            entries = [entry for entry in entries if entry[0] not in evict]
+            copied = [entry for entry in copied if entry[0] not in evict]
+
+        index = {}
+        offset = self.HEADER.size
+        for (key, ts, value) in entries:
+            index[key] = (offset, len(value), ts)
+            offset += len(value)
+        for (key, ts) in copied:
+            length = current.index[key][1]
+            index[key] = (offset, length, ts)
+            offset += length
+        index_pickled = pickle.dumps(index, pickle.HIGHEST_PROTOCOL)
+
+        yield self.HEADER.pack(self.MAGIC, serializer.TAG, offset, len(index_pickled))
+        for (_, _, value) in entries:
+            yield value
+        for (key, _) in copied:
+            yield current.raw(key)
+        yield index_pickled
+
+    def close(self):
+        """Close the cache, write the new file.
+
+        Like with FileCache, load() still works after close(): it uses the new file (mapped again).
+        """
+        self._acquire(shared=False)
+        try:
+            current = self.shelf
+            if self._lock is not None:
+                ## include the data stored by others since the cache was opened
+                current = self._read()
+            try:
+                write_atomic(self.filename, self._chunks(current))
+            except (ValueError, TypeError):
+                self.log.raiseException("Could not serialize the data for %s with %s" %
+                                        (self.filename, self._serializer().__class__.__name__))
+            written = self._read()
+            for shelf in [current, self.shelf]:
+                if isinstance(shelf, IndexedShelf):
+                    shelf.close()
+            self.shelf = written
+        finally:
+            self._release()
+        self.log.info('closing the file cache at %s' % (self.filename))
+
+
+def _canonical_key(key):
+    """Return a str for key that is the same for keys that are equal, eg 'a' and u'a', or 1, 1L and 1.0
+    (for str, int and tuples of those, it is their repr)
+    """
+    if isinstance(key, unicode):
+        return repr(key.encode('utf-8'))
+    elif isinstance(key, (bool, int, long)):
+        return str(int(key))
+    elif isinstance(key, float) and key.is_integer():
+        return str(int(key))
+    elif isinstance(key, tuple):
+        items = [_canonical_key(x) for x in key]
+        if len(items) == 1:
+            return "(%s,)" % items[0]
+        return "(%s)" % ", ".join(items)
+    return repr(key)
+
+
+class FileCacheSharded(object):
+    """File cache in a directory, with the keys spread over a fixed number of shards (files) by a hash of the key.
+
+    Same interface as FileCache (update, load, retain, discard, close): only the shards of the keys that are used
+    are read, and only those are written on close. Each shard is a shard_class (default FileCache) instance,
+    the other arguments (lock, lock_timeout, eviction, serializer, ...) are passed to it. The limits of
+    an eviction policy apply per shard.
+
+    With retain_old=False, the shards that were not used are removed on close (without reading them), unless
+    (with lock) they were written by another process after this cache was opened.
+
+    The number of shards is stored in the directory, an existing directory keeps its number of shards.
+    compact() rewrites all shards (applying the eviction policy), in several processes with processes > 1;
+    the shards are locked, so several compact() can run at the same time, also on different hosts.
+    """
+    DEFAULT_SHARDS = 64
+    SHARDS_FILENAME = 'shards'
+    SHARD_PREFIX = 'shard.'
+
+    def __init__(self, dirname, retain_old=False, shards=None, shard_class=FileCache, **kwargs):
+        """Initializer.
+
+        Creates the directory if needed, the shards are only opened when a key in them is used.
+
+        @type dirname: string
+        @type shards: int
+
+        @param dirname: (absolute) path to the cache directory
+        @param shards: number of shards for a new directory (default DEFAULT_SHARDS)
+        @param shard_class: FileCache class of the shards
+        """
+        self.log = fancylogger.getLogger(self.__class__.__name__)
+        self.dirname = dirname
+        self.retain_old = retain_old
+        self.shard_class = shard_class
+        self.kwargs = kwargs
+        self._open_time = time.time()
+        self._shards = {}  # the opened shards
+
+        if not os.path.isdir(self.dirname):
+            try:
+                os.makedirs(self.dirname)
+            except OSError, err:
+                if err.errno != errno.EEXIST:
+                    self.log.raiseException("Could not create the cache directory %s [%s]" % (self.dirname, err))
+        self.shards = self._read_shards(shards)
+
+    def _read_shards(self, shards):
+        """Return the number of shards of the directory, store shards (default DEFAULT_SHARDS) if it is new"""
+        filename = os.path.join(self.dirname, self.SHARDS_FILENAME)
+        if not os.path.exists(filename):
+            ## link fails if the file exists: the first one wins if several processes create the directory
+            (fd, tmpname) = tempfile.mkstemp(dir=self.dirname, prefix='.%s.' % self.SHARDS_FILENAME)
+            try:
+                try:
+                    os.write(fd, "%d\n" % (shards or self.DEFAULT_SHARDS))
+                    os.close(fd)
+                    os.chmod(tmpname, 0666 & ~_umask())
+                    os.link(tmpname, filename)
+                except OSError, err:
+                    if err.errno != errno.EEXIST:
+                        self.log.raiseException("Could not store the number of shards in %s [%s]" % (filename, err))
+            finally:
+                os.unlink(tmpname)
+
+        try:
+            stored = int(open(filename).read())
+        except (IOError, ValueError):
+            self.log.raiseException("Invalid number of shards in %s" % (filename))
+        if shards is not None and stored != shards:
+            self.log.warning("Cache %s has %s shards, not %s" % (self.dirname, stored, shards))
+        return stored
+
+    def shard_index(self, key):
+        """Return the index of the shard of key (the same in all processes, unlike hash(), and for equal keys)"""
+        return (zlib.crc32(_canonical_key(key)) & 0xffffffff) % self.shards
+
+    def shard_filename(self, index):
+        """Return the filename of the shard with index"""
+        return os.path.join(self.dirname, "%s%04d" % (self.SHARD_PREFIX, index))
+
+    def _shard_files(self, index):
+        """Return the files with the data of the shard with index"""
+        filename = self.shard_filename(index)
+        if issubclass(self.shard_class, FileCacheJournal):
+            return [filename, filename + FileCacheJournal.JOURNAL_SUFFIX]
+        return [filename]
+
+    def _shard(self, key):
+        """Return the shard of key, open it if needed"""
+        index = self.shard_index(key)
+        if index not in self._shards:
+            self._shards[index] = self.shard_class(self.shard_filename(index), retain_old=self.retain_old,
+                                                   **self.kwargs)
+        return self._shards[index]
+
+    @property
+    def stats(self):
+        """The hits, misses and evictions of all opened shards"""
+        stats = {'hits': 0, 'misses': 0, 'evictions': 0}
+        for shard in self._shards.values():
+            for (name, value) in shard.stats.items():
+                stats[name] += value
+        return stats
+
+    def update(self, key, data, threshold):
+        """Update the given data if the existing data is older than the given threshold (see FileCache.update)."""
+        self._shard(key).update(key, data, threshold)
+
+    def load(self, key):
+        """Load the stored data for the given key along with the timestamp it was stored (see FileCache.load)."""
+        return self._shard(key).load(key)
+
+    def retain(self):
+        """Retain non-updated data on close."""
+        self.retain_old = True
+        for shard in self._shards.values():
+            shard.retain()
+
+    def discard(self):
+        """Discard non-updated data on close."""
+        self.retain_old = False
+        for shard in self._shards.values():
+            shard.discard()
+
+    def _remove_shard(self, index):
+        """Remove the shard with index, unless (with lock) it was written after this cache was opened"""
+        lock = None
+        if self.kwargs.get('lock', False):
+            lock = FileLock(self.shard_filename(index) + FileCache.LOCK_SUFFIX)
+            lock.acquire(shared=False, timeout=self.kwargs.get('lock_timeout', None))
+        try:
+            for filename in self._shard_files(index):
+                try:
+                    if lock is None or os.stat(filename).st_mtime < self._open_time:
+                        os.unlink(filename)
+                except OSError, err:
+                    if err.errno != errno.ENOENT:
+                        raise
+        finally:
+            if lock is not None:
+                lock.release()
+
+    def close(self):
+        """Close the cache: write the opened shards, and remove the unused ones if non-updated data is discarded."""
+        for shard in self._shards.values():
+            shard.close()
+        if not self.retain_old:
+            for index in range(self.shards):
+                if index not in self._shards:
+                    self._remove_shard(index)
+        self.log.info('closing the file cache at %s' % (self.dirname))
+        self._shards = {}
+
+    def _compact_shard(self, index):
+        """Rewrite the shard with index, under its lock"""
+        kwargs = dict(self.kwargs)
+        kwargs['lock'] = True
+        shard = self.shard_class(self.shard_filename(index), retain_old=True, **kwargs)
+        shard.close()
+        if isinstance(shard, FileCacheJournal):
+            shard.compact()
+
+    def compact(self, processes=1):
+        """Rewrite all existing shards, with processes processes.
+
+        @type processes: int
+
+        @param processes: number of (forked) processes that compact the shards
+        """
+        indices = [index for index in range(self.shards)
+                   if [f for f in self._shard_files(index) if os.path.exists(f)]]
+        if processes <= 1:
+            for index in indices:
+                self._compact_shard(index)
+            return
+
+        pids = []
+        for worker in range(processes):
+            pid = os.fork()
+            if pid == 0:
+                ec = 0
+                try:
+                    try:
+                        for index in indices[worker::processes]:
+                            self._compact_shard(index)
+                    except:
+                        self.log.exception("Compacting shards of %s failed" % (self.dirname))
+                        ec = 1
+                finally:
+                    os._exit(ec)
+            pids.append(pid)
+
+        failed = 0
+        for pid in pids:
+            (_, status) = os.waitpid(pid, 0)
+            if status != 0:
+                failed += 1
+        if failed:
+            self.log.raiseException("Compacting %s failed in %s of %s processes" % (self.dirname, failed, processes))
@@ -0,0 +1,396 @@
+#!/usr/bin/env python
+##
+# Copyright 2012 Ghent University
+# Copyright 2012 Jens Timmerman
+#
+# This file is part of VSC-tools,
+# originally created by the HPC team of Ghent University (http://ugent.be/hpc/en),
+# with support of Ghent University (http://ugent.be/hpc),
+# the Flemish Supercomputer Centre (VSC) (https://vscentrum.be/nl/en),
+# the Hercules foundation (http://www.herculesstichting.be/in_English)
+# and the Department of Economy, Science and Innovation (EWI) (http://www.ewi-vlaanderen.be/en).
+#
+# http://github.com/hpcugent/VSC-tools
+#
+# VSC-tools is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation v2.
+#
+# VSC-tools is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with VSC-tools. If not, see <http://www.gnu.org/licenses/>.
+##
+"""
+High-throughput receiver for the records of fancylogger.logToUDP (plain or batched).
+
+The socket is drained in batches (non-blocking, with a large receive buffer) by the receiving thread;
+a writer thread decodes the records, formats them and writes them to buffered files, flushed every
+FLUSH_INTERVAL seconds. The output can be split in one file per source host or per MPI rank.
+
+StreamLogServer does the same for the connections of fancylogger.logToTCP and logToUnixSocket: all
+connections are multiplexed (with epoll, or select) by the receiving thread. When the writer falls behind,
+the connections are not read, so the senders wait (and nothing is lost).
+
+usage:
+    server = LogServer(sock, '/path/to/log.log', split=LogServer.SPLIT_HOST)
+    server.serve()  # until stop() is called (eg from a signal handler)
+"""
+import errno
+import logging
+import os
+import itertools
+import Queue
+import select
+import socket
+import threading
+import time
+
+from vsc import fancylogger
+from vsc.fancylogger import BatchedDatagramDecoder, BatchedStreamDecoder
+
+
+class LogServer(object):
+    """Receive the log datagrams on a socket and write the records to (per source) files.
+
+    The counters are in stats:
+        - received, bytes_received: the datagrams (and their bytes) read from the socket
+        - dropped: datagrams dropped because the writer could not keep up
+        - lost: datagrams lost on the way (gaps in the sequence numbers of batched datagrams)
+        - records, bytes_written: the records (and their bytes) written
+        - errors: datagrams that could not be decoded, or records that could not be formatted
+    """
+    SPLIT_HOST = 'host'
+    SPLIT_RANK = 'rank'
+    SPLITS = (None, SPLIT_HOST, SPLIT_RANK)
+
+    RCVBUF = 32 * 1024 * 1024
+    MAX_DATAGRAM = 65535
+    MAX_BATCH = 1024  # datagrams read per batch
+    MAX_QUEUED_BATCHES = 1024  # batches waiting for the writer
+    POLL_TIMEOUT = 0.5
+    FLUSH_INTERVAL = 1.0
+    FILE_BUFFER = 256 * 1024
+    MAX_OPEN_FILES = 256
+
+    def __init__(self, sock, logfile, split=None, logformat=fancylogger.DEFAULT_LOGGING_FORMAT):
+        """
+        @param sock: the bound UDP socket
+        @param logfile: the file to write to (the prefix of the files with split)
+        @param split: one file per source host (SPLIT_HOST) or MPI rank (SPLIT_RANK)
+        @param logformat: the format of the lines
+        """
+        self.log = fancylogger.getLogger(self.__class__.__name__)
+        if split not in self.SPLITS:
+            self.log.raiseException("Unknown split %s (use one of %s)" % (split, self.SPLITS), ValueError)
+
+        self.sock = sock
+        self.sock.setblocking(0)
+        try:
+            self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, self.RCVBUF)
+        except socket.error, err:
+            self.log.warning("Could not set the receive buffer to %s: %s" % (self.RCVBUF, err))
+
+        self.logfile = logfile
+        self.split = split
+        self.formatter = logging.Formatter(logformat)
+        self.decoder = BatchedDatagramDecoder()
+
+        self.queue = Queue.Queue(self.MAX_QUEUED_BATCHES)
+        self.files = {}  # the open files, by filename
+        self.last_use = {}  # the last use of the open files
+        self.stopping = threading.Event()
+        self.stats = {
+            'received': 0,
+            'bytes_received': 0,
+            'dropped': 0,
+            'lost': 0,
+            'records': 0,
+            'bytes_written': 0,
+            'errors': 0,
+        }
+
+    def stats_line(self):
+        """Return the counters as a line of text"""
+        return ' '.join(["%s=%s" % item for item in sorted(self.stats.items())])
+
+    def _receive_batch(self):
+        """Return the datagrams that can be read without blocking (at most MAX_BATCH)"""
+        batch = []
+        while len(batch) < self.MAX_BATCH:
+            try:
+                batch.append(self.sock.recvfrom(self.MAX_DATAGRAM))
+            except socket.error, err:
+                if err.args[0] == errno.EINTR:
+                    continue
+                elif err.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    break
+                raise
+        return batch
+
+    def receive(self):
+        """Read batches of datagrams until stop(), and hand them to the writer"""
+        while not self.stopping.isSet():
+            try:
+                (readable, _, _) = select.select([self.sock], [], [], self.POLL_TIMEOUT)
+            except select.error, err:
+                if err.args[0] == errno.EINTR:
+                    continue
+                raise
+            if not readable:
+                continue
+
+            batch = self._receive_batch()
+            self.stats['received'] += len(batch)
+            self.stats['bytes_received'] += sum([len(data) for (data, _) in batch])
+            try:
+                self.queue.put_nowait(batch)
+            except Queue.Full:
+                self.stats['dropped'] += len(batch)
+
+    def _filename(self, record, address):
+        """Return the filename for the record from address"""
+        if self.split == self.SPLIT_HOST and address is not None:
+            key = address[0]
+        elif self.split == self.SPLIT_RANK:
+            key = "rank%s" % record.get('mpirank', 'N/A')
+        else:
+            return self.logfile
+        return "%s.%s" % (self.logfile, key.replace(os.sep, '_'))
+
+    def _file(self, filename):
+        """Return the open file filename, close the least recently used if there are too many"""
+        if filename not in self.files:
+            if len(self.files) >= self.MAX_OPEN_FILES:
+                oldest = min(self.last_use, key=self.last_use.get)
+                self.files.pop(oldest).close()
+                del self.last_use[oldest]
+            self.files[filename] = open(filename, 'a', self.FILE_BUFFER)
+        self.last_use[filename] = time.time()
+        return self.files[filename]
+
+    def _decode(self, item):
+        """Return the record dictionaries of a received item (a datagram and its address)"""
+        (data, address) = item
+        return self.decoder.decode(data, address)
+
+    def _write_batch(self, batch):
+        """Decode, format and write the records in the received items of batch"""
+        for item in batch:
+            address = item[1]
+            try:
+                records = self._decode(item)
+            except (KeyboardInterrupt, SystemExit):
+                raise
+            except:
+                self.stats['errors'] += 1
+                continue
+
+            for record in records:
+                ## records of a plain logging.Logger do not have the fancylogger fields
+                record.setdefault('threadname', record.get('threadName', ''))
+                record.setdefault('mpirank', 'N/A')
+                try:
+                    line = "%s\n" % self.formatter.format(logging.makeLogRecord(record))
+                except (KeyboardInterrupt, SystemExit):
+                    raise
+                except:
+                    self.stats['errors'] += 1
+                    continue
+                self._file(self._filename(record, address)).write(line)
+                self.stats['records'] += 1
+                self.stats['bytes_written'] += len(line)
+        self.stats['lost'] = self.decoder.lost
+
+    def flush(self):
+        """Flush the open files"""
+        for f in self.files.values():
+            f.flush()
+
+    def write(self):
+        """Write the received batches until the receiver is done (a None batch)"""
+        last_flush = time.time()
+        while True:
+            try:
+                batch = self.queue.get(timeout=self.FLUSH_INTERVAL)
+            except Queue.Empty:
+                batch = []
+            if batch is None:
+                break
+            self._write_batch(batch)
+            if time.time() - last_flush >= self.FLUSH_INTERVAL:
+                self.flush()
+                last_flush = time.time()
+
+    def serve(self):
+        """Receive and write the records until stop()"""
+        writer = threading.Thread(target=self.write, name='logserver-writer')
+        writer.setDaemon(True)
+        writer.start()
+        try:
+            self.receive()
+        finally:
+            ## the writer handles what was received
+            self.queue.put(None)
+            writer.join()
+            for f in self.files.values():
+                f.close()
+            self.files = {}
+            self.last_use = {}
+            self.log.info("Log server stopped: %s" % self.stats_line())
+
+    def stop(self):
+        """Stop serving (can be called from a signal handler or another thread)"""
+        self.stopping.set()
+
+
+class StreamLogServer(LogServer):
+    """Receive the log streams of the connections to a listening (TCP or Unix) socket.
+
+    Besides the LogServer counters, stats has
+        - accepted: the number of accepted connections
+        - connections: the number of open connections
+    received counts the data read from the connections; dropped remains 0: the connections are not read
+    while the writer is behind. An incomplete frame at the end of a connection is counted in errors.
+    """
+    LISTEN_BACKLOG = 128
+    RECV_SIZE = 256 * 1024
+
+    def __init__(self, sock, logfile, split=None, logformat=fancylogger.DEFAULT_LOGGING_FORMAT):
+        """
+        @param sock: the bound TCP or Unix stream socket
+        @param logfile: the file to write to (the prefix of the files with split)
+        @param split: one file per source host (SPLIT_HOST) or MPI rank (SPLIT_RANK)
+        @param logformat: the format of the lines
+        """
+        LogServer.__init__(self, sock, logfile, split=split, logformat=logformat)
+        self.sock.listen(self.LISTEN_BACKLOG)
+
+        self.connections = {}  # the (socket, address, id) of the connections, by file descriptor
+        self.ids = itertools.count()
+        self.decoders = {}  # the decoder per connection id (used by the writer)
+        self.broken = set()  # the ids of the connections with undecodable data (used by the writer)
+        self.epoll = None
+        if hasattr(select, 'epoll'):
+            self.epoll = select.epoll()
+            self.epoll.register(self.sock.fileno(), select.EPOLLIN)
+        self.stats['accepted'] = 0
+        self.stats['connections'] = 0
+
+    def _poll(self):
+        """Return the file descriptors that are ready to be read"""
+        if self.epoll is None:
+            fds = [self.sock.fileno()] + self.connections.keys()
+            return select.select(fds, [], [], self.POLL_TIMEOUT)[0]
+        else:
+            return [fd for (fd, _) in self.epoll.poll(self.POLL_TIMEOUT)]
+
+    def _accept(self):
+        """Accept the new connections"""
+        while True:
+            try:
+                (conn, address) = self.sock.accept()
+            except socket.error, err:
+                if err.args[0] == errno.EINTR:
+                    continue
+                elif err.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    return
+                raise
+            conn.setblocking(0)
+            if not address:
+                ## a unix socket peer
+                address = ('local', None)
+            self.connections[conn.fileno()] = (conn, address, self.ids.next())
+            if self.epoll is not None:
+                self.epoll.register(conn.fileno(), select.EPOLLIN)
+            self.stats['accepted'] += 1
+            self.stats['connections'] = len(self.connections)
+
+    def _close(self, fd):
+        """Close the connection fd, return the end of stream item for the writer"""
+        (conn, address, connid) = self.connections.pop(fd)
+        if self.epoll is not None:
+            self.epoll.unregister(fd)
+        conn.close()
+        self.stats['connections'] = len(self.connections)
+        return (None, address, connid)
+
+    def _receive_batch(self, fds):
+        """Return the data read from the connections fds, as (data, address, connection id) items"""
+        batch = []
+        for fd in fds:
+            if fd == self.sock.fileno():
+                self._accept()
+                continue
+            elif fd not in self.connections:
+                continue
+
+            (conn, address, connid) = self.connections[fd]
+            try:
+                data = conn.recv(self.RECV_SIZE)
+            except socket.error, err:
+                if err.args[0] in (errno.EINTR, errno.EAGAIN, errno.EWOULDBLOCK):
+                    continue
+                ## eg reset by the peer
+                data = ''
+            if data:
+                batch.append((data, address, connid))
+            else:
+                batch.append(self._close(fd))
+        return batch
+
+    def receive(self):
+        """Read the connections until stop(), and hand the data to the writer"""
+        try:
+            while not self.stopping.isSet():
+                try:
+                    fds = self._poll()
+                except (select.error, IOError), err:
+                    if err.args[0] == errno.EINTR:
+                        continue
+                    raise
+
+                batch = self._receive_batch(fds)
+                if not batch:
+                    continue
+                self.stats['received'] += len([data for (data, _, _) in batch if data is not None])
+                self.stats['bytes_received'] += sum([len(data) for (data, _, _) in batch if data is not None])
+                ## backpressure: wait for the writer (the connections are not read meanwhile)
+                while not self.stopping.isSet():
+                    try:
+                        self.queue.put(batch, timeout=self.POLL_TIMEOUT)
+                        break
+                    except Queue.Full:
+                        continue
+                else:
+                    self.queue.put(batch)
+        finally:
+            self.queue.put([self._close(fd) for fd in self.connections.keys()])
+            if self.epoll is not None:
+                self.epoll.close()
+
+    def _decode(self, item):
+        """Return the record dictionaries of a received item (data of a connection, None at its end)"""
+        (data, _, connid) = item
+        if data is None:
+            decoder = self.decoders.pop(connid, None)
+            if connid in self.broken:
+                self.broken.remove(connid)
+            elif decoder is not None and decoder.pending():
+                raise ValueError("Connection %s closed with an incomplete frame" % connid)
+            return []
+        elif connid in self.broken:
+            return []
+
+        if connid not in self.decoders:
+            self.decoders[connid] = BatchedStreamDecoder()
+        try:
+            return self.decoders[connid].feed(data)
+        except:
+            ## the rest of the stream can not be decoded
+            self.broken.add(connid)
+            self.decoders.pop(connid)
+            raise
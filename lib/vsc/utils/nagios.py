@@ -36,16 +36,34 @@ interpreted by nagios/icinga.
     - unknown
  - NagiosReporter class that provides cache functionality, writing and reading the nagios/icinga result string to a
   pickle file.
+ - NagiosMultiReporter class that does the same for many named checks in a single cache file.
+ - NagiosResultServer daemon that serves the NagiosReporter results over a Unix socket, so a check does not
+   have to start a Python interpreter with all vsc imports (see bin/nagiosdaemon.py for the client).
+ - NagiosPassiveSpooler class that submits many passive check results at once, to the external command file
+   or to the check result spool directory.
+ - NagiosRange and batch_perfdata to evaluate the thresholds of many metrics at once (with NumPy if available)
+   and render their performance data.
 """
 
+import errno
+import fcntl
 import os
 import pwd
+import select
+import socket
 import stat
 import sys
+import tempfile
 import time
 
 from vsc import fancylogger
-from vsc.utils.cache import FileCache
+from vsc.utils.cache import FileCache, FileCacheIndexed
+from vsc.utils.daemon import Daemon
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 log = fancylogger.getLogger(__name__)
 
@@ -119,26 +137,41 @@ class NagiosReporter(object):
 
         self.log = fancylogger.getLogger(self.__class__.__name__)
 
+    def load(self):
+        """Return the cached (timestamp, (nagios_exit, nagios_message)), None if there is none."""
+        ## not closed: closing would write the cache file again
+        return FileCache(self.filename).load(0)
+
+    def result(self, value):
+        """Return the nagios exit code and message to report for the cached value.
+
+        @param value: (timestamp, (nagios_exit, nagios_message)) as returned by load(), or None
+
+        @returns: (nagios_exit, nagios_message), unknown if there is no value or it is too old
+        """
+        if value is None:
+            return (NAGIOS_EXIT_UNKNOWN, "%s nagios pickled file unavailable (%s)" % (self.header, self.filename))
+
+        (timestamp, ((nagios_exit_code, nagios_exit_string), nagios_message)) = value
+        if self.threshold < 0 or time.time() - timestamp < self.threshold:
+            return ((nagios_exit_code, nagios_exit_string), nagios_message)
+        else:
+            return (NAGIOS_EXIT_UNKNOWN, "%s pickled file too old (timestamp = %s)" % (self.header, time.ctime(timestamp)))
+
     def report_and_exit(self):
         """Unpickles the cache file, prints the data and exits accordingly.
 
         If the cache data is too old (now - cache timestamp > self.threshold), a critical exit is produced.
         """
         try:
-            nagios_cache = FileCache(self.filename)
+            value = self.load()
         except:
             self.log.critical("Error opening file %s for reading" % (self.filename))
-            unknown_exit("%s nagios pickled file unavailable (%s)" % (self.header, self.filename))
+            value = None
 
-        (timestamp, ((nagios_exit_code, nagios_exit_string), nagios_message)) = nagios_cache.load(0)
-        nagios_cache.close()
-
-        if self.threshold < 0 or time.time() - timestamp < self.threshold:
-            self.log.info("Nagios check cache file %s contents delivered: %s" % (self.filename, nagios_message))
-            print "%s %s" % (nagios_exit_string, nagios_message)
-            sys.exit(nagios_exit_code)
-        else:
-            unknown_exit("%s pickled file too old (timestamp = %s)" % (self.header, time.ctime(timestamp)))
+        (nagios_exit, nagios_message) = self.result(value)
+        self.log.info("Nagios check cache file %s contents delivered: %s" % (self.filename, nagios_message))
+        _real_exit(nagios_message, nagios_exit)
 
     def cache(self, nagios_exit, nagios_message):
         """Store the result in the cache file with a timestamp.
@@ -168,6 +201,624 @@ class NagiosReporter(object):
         return True
 
 
+class NagiosMultiReporter(object):
+    """Reporting class for the results of many Nagios/Icinga checks, stored in a single cache file.
+
+    The checks are identified by a name. The results are collected with add() and written with cache(),
+    in one update of the file (which is locked, so several scripts can write their checks to the same file).
+    The reader opens the file once, and only unpickles the results that are asked for: report_and_exit()
+    reports one check, report_all_and_exit() reports all of them.
+    """
+    ## order of the exit codes, from best to worst, to report all checks
+    EXIT_ORDER = [NAGIOS_EXIT_OK, NAGIOS_EXIT_UNKNOWN, NAGIOS_EXIT_WARNING, NAGIOS_EXIT_CRITICAL]
+
+    def __init__(self, header, filename, threshold, nagios_username="nagios"):
+        """Initialisation.
+
+        @type header: string
+        @type filename: string
+        @type threshold: positive integer
+
+        @param header: application specific part of the message, used to denote what program/script is using the
+                       reporter.
+        @param filename: the filename of the cache file
+        @param threshold: Seconds to determines how old the result of a check may be before reporting an unknown
+                          result for it. If the threshold <= 0, this feature is not used.
+        """
+        self.header = header
+        self.filename = filename
+        self.threshold = threshold
+
+        self.nagios_username = nagios_username
+
+        self.log = fancylogger.getLogger(self.__class__.__name__)
+
+        self.results = {}  # the results to cache
+        self._cache = None  # the cache being read
+
+    def add(self, check, nagios_exit, nagios_message):
+        """Add the result of check, to store with cache().
+
+        @type check: string
+        @type nagios_exit: one of NAGIOS_EXIT_OK, NAGIOS_EXIT_WARNING, NAGIOS_EXIT_CRTITCAL or NAGIOS_EXIT_UNKNOWN
+        @type nagios_message: string
+
+        @param check: the name of the check
+        @param nagios_exit: a valid nagios exit code.
+        @param nagios_message: the message to print out when the actual check runs.
+        """
+        self.results[check] = (nagios_exit, nagios_message)
+
+    def cache(self):
+        """Store the added results in the cache file with a timestamp, keep the results of the other checks."""
+        try:
+            nagios_cache = FileCacheIndexed(self.filename, retain_old=True, lock=True)
+            for (check, result) in self.results.items():
+                nagios_cache.update(check, result, 0)  # always update
+            nagios_cache.close()
+            self.log.info("Wrote %s nagios check results to cache file %s at about %s" %
+                          (len(self.results), self.filename, time.ctime(time.time())))
+        except:
+            # raising an error is ok, since we usually do this as the very last thing in the script
+            self.log.raiseException("Cannot save to the nagios cache file (%s)" % (self.filename))
+        self.results = {}
+
+        try:
+            p = pwd.getpwnam(self.nagios_username)
+            for filename in [self.filename, self.filename + FileCacheIndexed.LOCK_SUFFIX]:
+                os.chmod(filename, stat.S_IRUSR | stat.S_IWUSR | stat.S_IRGRP | stat.S_IWGRP)
+                os.chown(filename, p.pw_uid, p.pw_gid)
+        except:
+            self.log.raiseException("Cannot chown the nagios check file %s to the nagios user" % (self.filename))
+
+        return True
+
+    def _read(self):
+        """Return the cache, it is opened only once."""
+        if self._cache is None:
+            try:
+                ## not closed: the cache is only read
+                self._cache = FileCacheIndexed(self.filename, retain_old=True, lock=True)
+            except:
+                self.log.critical("Error opening file %s for reading" % (self.filename))
+                unknown_exit("%s nagios cache file unavailable (%s)" % (self.header, self.filename))
+        return self._cache
+
+    def checks(self):
+        """Return the names of the checks in the cache file."""
+        return sorted(self._read().shelf.keys())
+
+    def result(self, check):
+        """Return the exit code and message of check, unknown if there is no recent result.
+
+        @returns: (nagios_exit, nagios_message)
+        """
+        value = self._read().load(check)
+        if value is None:
+            return (NAGIOS_EXIT_UNKNOWN, "%s no result for check %s" % (self.header, check))
+
+        (timestamp, (nagios_exit, nagios_message)) = value
+        if self.threshold <= 0 or time.time() - timestamp < self.threshold:
+            return (tuple(nagios_exit), nagios_message)
+        else:
+            return (NAGIOS_EXIT_UNKNOWN, "%s result of check %s too old (timestamp = %s)" %
+                    (self.header, check, time.ctime(timestamp)))
+
+    def report_and_exit(self, check):
+        """Print the result of check and exit accordingly."""
+        (nagios_exit, nagios_message) = self.result(check)
+        self.log.info("Nagios check %s in cache file %s delivered: %s" % (check, self.filename, nagios_message))
+        _real_exit(nagios_message, nagios_exit)
+
+    def report_all_and_exit(self):
+        """Print the results of all checks, one per line, and exit with the worst exit code."""
+        results = [(check, self.result(check)) for check in self.checks()]
+        if not results:
+            unknown_exit("%s no check results in %s" % (self.header, self.filename))
+
+        worst = max([self.EXIT_ORDER.index(nagios_exit) for (_, (nagios_exit, _)) in results])
+        lines = ["%s: %s %s" % (check, nagios_exit[1], nagios_message)
+                 for (check, (nagios_exit, nagios_message)) in results]
+        _real_exit("%s %s checks\n%s" % (self.header, len(results), "\n".join(lines)), self.EXIT_ORDER[worst])
+
+
+class NagiosResultServer(Daemon):
+    """Daemon that serves the results of NagiosReporters over a Unix socket.
+
+    A client sends the name of a reporter and a newline, the server answers with the exit code, a space and
+    the line to print, and closes the connection. The connections are multiplexed with poll, so a client that
+    stalls does not delay the others; it is disconnected after CLIENT_TIMEOUT seconds. The cache file of a reporter is only read again when it
+    changed (its mtime, size or inode), the threshold is checked on every request.
+
+    Anyone who can write to the socket can ask for the results, so by default only the owner and the group
+    (eg the nagios group) can use it.
+    """
+    SOCKET_MODE = 0660
+    BACKLOG = 128
+    CLIENT_TIMEOUT = 1  # seconds to wait for the request of a client
+    MAX_REQUEST = 1024
+
+    def __init__(self, socket_path, reporters, pidfile, stdout='/dev/null', stderr='/dev/null', socket_mode=None):
+        """Initialisation.
+
+        @type socket_path: string
+        @type reporters: dictionary
+        @type socket_mode: int
+
+        @param socket_path: (absolute) path of the Unix socket
+        @param reporters: NagiosReporter instances, by the name the clients use
+        @param pidfile: the pidfile of the daemon
+        @param socket_mode: the permissions of the socket (default SOCKET_MODE)
+        """
+        Daemon.__init__(self, pidfile, stdout=stdout, stderr=stderr)
+        self.socket_path = socket_path
+        if socket_mode is None:
+            socket_mode = self.SOCKET_MODE
+        self.socket_mode = socket_mode
+        self.reporters = reporters
+        self.log = fancylogger.getLogger(self.__class__.__name__)
+
+        self.socket_ = None
+        self._cached = {}  # per name, the stat signature of the cache file and the cached value
+        self.stats = {'requests': 0, 'reloads': 0}
+
+    def bind(self):
+        """Create the socket, replacing a stale socket file."""
+        try:
+            os.unlink(self.socket_path)
+        except OSError, err:
+            if err.errno != errno.ENOENT:
+                self.log.raiseException("Cannot remove the old socket %s" % (self.socket_path))
+        self.socket_ = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.socket_.bind(self.socket_path)
+        os.chmod(self.socket_path, self.socket_mode)
+        self.socket_.listen(self.BACKLOG)
+        self.log.info("Serving %s nagios results on %s" % (len(self.reporters), self.socket_path))
+
+    def _value(self, reporter):
+        """Return the cached value of reporter, read the cache file if it changed"""
+        try:
+            st = os.stat(reporter.filename)
+            signature = (st.st_mtime, st.st_size, st.st_ino)
+        except OSError:
+            signature = None
+
+        cached = self._cached.get(reporter.filename)
+        if cached is None or cached[0] != signature:
+            value = None
+            if signature is not None:
+                try:
+                    value = reporter.load()
+                except:
+                    self.log.exception("Error reading the nagios cache file %s" % (reporter.filename))
+            cached = (signature, value)
+            self._cached[reporter.filename] = cached
+            self.stats['reloads'] += 1
+        return cached[1]
+
+    def result(self, name):
+        """Return the exit code and the line to print for the reporter name"""
+        reporter = self.reporters.get(name, None)
+        if reporter is None:
+            (nagios_exit, nagios_message) = (NAGIOS_EXIT_UNKNOWN, "no nagios reporter %s" % (name))
+        else:
+            (nagios_exit, nagios_message) = reporter.result(self._value(reporter))
+        return (nagios_exit[0], "%s %s" % (nagios_exit[1], nagios_message))
+
+    def serve(self, conn, request):
+        """Answer the request on the connection conn"""
+        self.stats['requests'] += 1
+        (code, line) = self.result(request.strip())
+        conn.settimeout(self.CLIENT_TIMEOUT)
+        conn.sendall("%d %s\n" % (code, line))
+
+    def _accept(self, poller, clients):
+        """Accept the new connections"""
+        while True:
+            try:
+                (conn, _) = self.socket_.accept()
+            except socket.error, err:
+                if err.args[0] in (errno.EAGAIN, errno.EINTR):
+                    return
+                raise
+            conn.setblocking(0)
+            poller.register(conn.fileno(), select.POLLIN)
+            clients[conn.fileno()] = {
+                'conn': conn,
+                'request': '',
+                'deadline': time.time() + self.CLIENT_TIMEOUT,
+            }
+
+    def _receive(self, poller, clients, fd):
+        """Read the request of the client fd, answer it when it is complete"""
+        client = clients[fd]
+        try:
+            data = client['conn'].recv(self.MAX_REQUEST)
+        except socket.error, err:
+            if err.args[0] in (errno.EAGAIN, errno.EINTR):
+                return
+            raise
+        client['request'] += data
+        request = client['request']
+        if data and not request.endswith('\n') and len(request) < self.MAX_REQUEST:
+            return
+        try:
+            self.serve(client['conn'], request)
+        finally:
+            self._close(poller, clients, fd)
+
+    def _close(self, poller, clients, fd):
+        """Close the connection of the client fd"""
+        poller.unregister(fd)
+        clients.pop(fd)['conn'].close()
+
+    def run(self):
+        """Main server loop"""
+        if self.socket_ is None:
+            self.bind()
+        self.socket_.setblocking(0)
+        poller = select.poll()
+        poller.register(self.socket_.fileno(), select.POLLIN)
+        clients = {}  # per fd, the connection, the request read so far and the deadline of the client
+
+        while True:
+            timeout = -1
+            if clients:
+                timeout = max(min([client['deadline'] for client in clients.values()]) - time.time(), 0) * 1000
+            try:
+                events = poller.poll(timeout)
+            except select.error, err:
+                if err.args[0] == errno.EINTR:
+                    continue
+                raise
+
+            for (fd, _) in events:
+                try:
+                    if fd == self.socket_.fileno():
+                        self._accept(poller, clients)
+                    elif fd in clients:
+                        self._receive(poller, clients, fd)
+                except (KeyboardInterrupt, SystemExit):
+                    raise
+                except:
+                    self.log.exception("Error serving a nagios result")
+                    if fd in clients:
+                        self._close(poller, clients, fd)
+
+            now = time.time()
+            for fd in [fd for (fd, client) in clients.items() if client['deadline'] <= now]:
+                self.log.debug("Closing the connection of a client without a complete request")
+                self._close(poller, clients, fd)
+
+
+class NagiosPassiveSpooler(object):
+    """Collect passive check results and submit them in batches.
+
+    The results are written either to the external command file (the command FIFO of nagios/icinga,
+    as PROCESS_SERVICE_CHECK_RESULT or PROCESS_HOST_CHECK_RESULT commands), or to the check result
+    directory (one spool file with all results of the batch, and its .ok file).
+
+    The results are submitted when max_results are queued, or on add() when the previous submission is
+    longer than interval seconds ago, and on flush() and close(). When the submission fails, the results
+    stay queued for the next flush().
+    """
+    MAX_RESULTS = 1000
+    INTERVAL = 60
+    ## writes to a pipe up to PIPE_BUF bytes are atomic, so results of other writers are not interleaved
+    PIPE_BUF = 4096
+    SPOOL_FILE_PREFIX = 'c'
+    SPOOL_FILE_MODE = 0644
+    CHECK_TYPE_PASSIVE = 1
+
+    def __init__(self, command_file=None, checkresult_dir=None, max_results=None, interval=None):
+        """Initialisation.
+
+        @type command_file: string
+        @type checkresult_dir: string
+        @type max_results: int
+        @type interval: int
+
+        @param command_file: path of the external command file (or FIFO)
+        @param checkresult_dir: path of the check result directory, used when there is no command_file
+        @param max_results: submit when this number of results is queued (default MAX_RESULTS)
+        @param interval: submit when the last submission is longer than interval seconds ago (default INTERVAL)
+        """
+        self.log = fancylogger.getLogger(self.__class__.__name__)
+        if command_file is None and checkresult_dir is None:
+            self.log.raiseException("NagiosPassiveSpooler needs a command_file or a checkresult_dir", ValueError)
+
+        self.command_file = command_file
+        self.checkresult_dir = checkresult_dir
+        self.max_results = max_results or self.MAX_RESULTS
+        if interval is None:
+            interval = self.INTERVAL
+        self.interval = interval
+
+        self.results = []  # the queued (timestamp, host, service, exit code, output)
+        self.last_flush = time.time()
+        self.stats = {'results': 0, 'flushes': 0}
+
+    def add(self, host, service, nagios_exit, result):
+        """Queue the result of a check, submit the queue if it is full or the interval passed.
+
+        @type host: string
+        @type service: string
+        @type nagios_exit: one of NAGIOS_EXIT_OK, NAGIOS_EXIT_WARNING, NAGIOS_EXIT_CRTITCAL or NAGIOS_EXIT_UNKNOWN
+        @type result: NagiosResult or string
+
+        @param host: the host name of the check
+        @param service: the service description, None for a host check
+        @param nagios_exit: a valid nagios exit code.
+        @param result: the output of the check
+        """
+        self.results.append((time.time(), host, service, nagios_exit[0], str(result)))
+        if len(self.results) >= self.max_results or time.time() - self.last_flush >= self.interval:
+            self.flush()
+
+    def _commands(self):
+        """Generator of the external command lines of the queued results"""
+        for (timestamp, host, service, code, output) in self.results:
+            output = output.replace('\n', '\\n')
+            if service is None:
+                yield "[%d] PROCESS_HOST_CHECK_RESULT;%s;%d;%s\n" % (timestamp, host, code, output)
+            else:
+                yield "[%d] PROCESS_SERVICE_CHECK_RESULT;%s;%s;%d;%s\n" % (timestamp, host, service, code, output)
+
+    def _write_commands(self):
+        """Write the queued results to the command file, in chunks of whole lines of at most PIPE_BUF bytes"""
+        ## non-blocking open fails if nobody reads the FIFO, instead of hanging
+        fd = os.open(self.command_file, os.O_WRONLY | os.O_APPEND | os.O_NONBLOCK)
+        try:
+            flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+            fcntl.fcntl(fd, fcntl.F_SETFL, flags & ~os.O_NONBLOCK)
+            chunks = ['']
+            for line in self._commands():
+                if chunks[-1] and len(chunks[-1]) + len(line) > self.PIPE_BUF:
+                    chunks.append('')
+                chunks[-1] += line
+            for chunk in chunks:
+                while chunk:
+                    chunk = chunk[os.write(fd, chunk):]
+        finally:
+            os.close(fd)
+
+    def _spool(self):
+        """Return the contents of the check result file with the queued results"""
+        lines = ["### Passive Check Result File ###", "file_time=%d" % time.time(), ""]
+        for (timestamp, host, service, code, output) in self.results:
+            if service is None:
+                lines.append("### Nagios Host Check Result ###")
+            else:
+                lines.append("### Nagios Service Check Result ###")
+            lines.append("# Time: %s" % time.ctime(timestamp))
+            lines.append("host_name=%s" % host)
+            if service is not None:
+                lines.append("service_description=%s" % service)
+            lines.extend([
+                "check_type=%d" % self.CHECK_TYPE_PASSIVE,
+                "check_options=0",
+                "scheduled_check=0",
+                "reschedule_check=0",
+                "latency=0.0",
+                "start_time=%f" % timestamp,
+                "finish_time=%f" % timestamp,
+                "early_timeout=0",
+                "exited_ok=1",
+                "return_code=%d" % code,
+                "output=%s" % output.replace('\n', '\\n'),
+                "",
+            ])
+        return "\n".join(lines)
+
+    def _write_spool(self):
+        """Write the queued results to a file in the check result directory, and create its .ok file"""
+        (fd, filename) = tempfile.mkstemp(prefix=self.SPOOL_FILE_PREFIX, dir=self.checkresult_dir)
+        try:
+            data = self._spool()
+            while data:
+                data = data[os.write(fd, data):]
+            os.fchmod(fd, self.SPOOL_FILE_MODE)
+        finally:
+            os.close(fd)
+        ## nagios only reads the file once the .ok file exists
+        os.close(os.open(filename + '.ok', os.O_WRONLY | os.O_CREAT, self.SPOOL_FILE_MODE))
+
+    def flush(self):
+        """Submit the queued results."""
+        self.last_flush = time.time()
+        if not self.results:
+            return
+        try:
+            if self.command_file is not None:
+                self._write_commands()
+                target = self.command_file
+            else:
+                self._write_spool()
+                target = self.checkresult_dir
+        except (OSError, IOError), err:
+            self.log.raiseException("Cannot submit %s passive check results: %s" % (len(self.results), err))
+
+        self.log.debug("Submitted %s passive check results to %s" % (len(self.results), target))
+        self.stats['results'] += len(self.results)
+        self.stats['flushes'] += 1
+        self.results = []
+
+    def close(self):
+        """Submit the remaining results."""
+        self.flush()
+
+
+class NagiosRange(object):
+    """A nagios threshold range, see U{http://nagiosplug.sourceforge.net/developer-guidelines.html#THRESHOLDFORMAT}
+
+    [@]start:end, alert when the value is outside start and end (inclusive), or inside with @.
+    start defaults to 0, ~ is -infinity; end defaults to +infinity. For example:
+        - 10: alert when < 0 or > 10
+        - 10: (with colon) alert when < 10
+        - ~:20 alert when > 20
+        - @5:10 alert when >= 5 and <= 10
+    """
+
+    def __init__(self, nrange):
+        """Parse the range string nrange"""
+        self.log = fancylogger.getLogger(self.__class__.__name__)
+        self.nrange = str(nrange)
+
+        spec = self.nrange
+        self.inside = spec.startswith('@')
+        if self.inside:
+            spec = spec[1:]
+        if ':' in spec:
+            (start, end) = spec.split(':', 1)
+        else:
+            (start, end) = ('', spec)
+
+        try:
+            if start == '~':
+                self.start = float('-inf')
+            else:
+                self.start = float(start or 0)
+            self.end = float(end or 'inf')
+        except ValueError:
+            self.log.raiseException("Invalid nagios range %s" % (self.nrange), ValueError)
+        if self.start > self.end:
+            self.log.raiseException("Invalid nagios range %s: start > end" % (self.nrange), ValueError)
+
+    def alert(self, value):
+        """Return if value (a number, or a NumPy array) is in the alert range"""
+        outside = (value < self.start) | (value > self.end)
+        return outside != self.inside
+
+    def __str__(self):
+        return self.nrange
+
+
+def _alerts(values, ranges, use_numpy):
+    """Return the alert flags of the values for ranges (a single range or a range per value)"""
+    if ranges is None:
+        return None
+    if isinstance(ranges, (basestring, NagiosRange)):
+        nrange = (isinstance(ranges, NagiosRange) and ranges) or NagiosRange(ranges)
+        if use_numpy:
+            return nrange.alert(values)
+        return [nrange.alert(value) for value in values]
+
+    ## a range per value: evaluate the values with the same range together
+    parsed = {}
+    for nrange in ranges:
+        if nrange is not None and str(nrange) not in parsed:
+            parsed[str(nrange)] = NagiosRange(nrange)
+    if use_numpy:
+        ranges = numpy.array([str(nrange) for nrange in ranges])
+        alerts = numpy.zeros(len(values), dtype=bool)
+        for (name, nrange) in parsed.items():
+            selected = ranges == name
+            alerts[selected] = nrange.alert(values[selected])
+        return alerts
+    return [nrange is not None and parsed[str(nrange)].alert(value) for (value, nrange) in zip(values, ranges)]
+
+
+def evaluate_ranges(values, warning=None, critical=None, use_numpy=None):
+    """Return the state of each value: 0 (ok), 1 (warning) or 2 (critical).
+
+    @type values: list or NumPy array of numbers
+    @type warning: string, NagiosRange or a list of them
+
+    @param values: the values of the metrics
+    @param warning: the warning range, for all values or per value (None for no range)
+    @param critical: the critical range, for all values or per value (None for no range)
+    @param use_numpy: evaluate with NumPy (default: if it is available)
+
+    @returns: list (or NumPy array) of states
+    """
+    if use_numpy is None:
+        use_numpy = numpy is not None
+    if use_numpy:
+        values = numpy.asarray(values, dtype=float)
+
+    warnings = _alerts(values, warning, use_numpy)
+    criticals = _alerts(values, critical, use_numpy)
+
+    if use_numpy:
+        states = numpy.zeros(len(values), dtype=numpy.int8)
+        if warnings is not None:
+            states[warnings] = 1
+        if criticals is not None:
+            states[criticals] = 2
+        return states
+
+    states = [0] * len(values)
+    for (level, alerts) in [(1, warnings), (2, criticals)]:
+        if alerts is not None:
+            for idx in [idx for (idx, alert) in enumerate(alerts) if alert]:
+                states[idx] = level
+    return states
+
+
+def _perf_label(label):
+    """Return the label, quoted if needed"""
+    label = str(label)
+    if ' ' in label or '=' in label or "'" in label:
+        return "'%s'" % label.replace("'", "''")
+    return label
+
+
+def batch_perfdata(labels, values, warning=None, critical=None, uom='', use_numpy=None):
+    """Evaluate the thresholds of many metrics at once, and render their performance data.
+
+    For example:
+
+    >>> batch_perfdata(['home', 'data'], [80, 95], warning='~:90', critical='~:99')
+    ((1, 'WARNING'), 'home=80;~:90;~:99; data=95;~:90;~:99;')
+
+    @type labels: list of strings
+    @type values: list or NumPy array of numbers
+    @type uom: string
+
+    @param labels: the names of the metrics
+    @param values: the values of the metrics
+    @param warning: the warning range, for all values or per value (see evaluate_ranges)
+    @param critical: the critical range, for all values or per value (see evaluate_ranges)
+    @param uom: the unit of the values
+    @param use_numpy: evaluate with NumPy (default: if it is available)
+
+    @returns: (the worst nagios exit, the performance data string)
+    """
+    if len(labels) != len(values):
+        log.raiseException("batch_perfdata: %s labels for %s values" % (len(labels), len(values)), ValueError)
+    if not len(values):
+        return (NAGIOS_EXIT_OK, '')
+
+    states = evaluate_ranges(values, warning, critical, use_numpy)
+    worst = [NAGIOS_EXIT_OK, NAGIOS_EXIT_WARNING, NAGIOS_EXIT_CRITICAL][int(max(states))]
+
+    labels = [_perf_label(label) for label in labels]
+    if isinstance(values, list):
+        pass
+    elif numpy is not None and isinstance(values, numpy.ndarray):
+        values = values.tolist()
+    else:
+        values = list(values)
+
+    per_value = [nrange for nrange in [warning, critical]
+                 if nrange is not None and not isinstance(nrange, (basestring, NagiosRange))]
+    if not per_value:
+        ## the same thresholds for all: a single template
+        suffix = "%s;%s;%s;" % (uom, warning or '', critical or '')
+        template = "%s=%s" + suffix.replace('%', '%%')
+        perfdata = ' '.join([template % item for item in zip(labels, values)])
+    else:
+        warnings = warning
+        if warning is None or isinstance(warning, (basestring, NagiosRange)):
+            warnings = [warning] * len(values)
+        criticals = critical
+        if critical is None or isinstance(critical, (basestring, NagiosRange)):
+            criticals = [critical] * len(values)
+        perfdata = ' '.join(["%s=%s%s;%s;%s;" % (label, value, uom, w or '', c or '')
+                             for (label, value, w, c) in zip(labels, values, warnings, criticals)])
+    return (worst, perfdata)
+
+
 class NagiosResult(object):
     """Class representing the results of an Icinga/Nagios check.
 
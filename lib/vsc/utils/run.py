@@ -60,17 +60,37 @@ Historical overview of existing equivalent code
     - C{run} method
         - fake pty support
 """
+from collections import deque
 from vsc.fancylogger import getLogger, getAllExistingLoggers
+import errno
+import fcntl
 import pty
+import select
+import tempfile
 import time
 import logging
 import re
+import shlex
 import signal
+import socket
 import os
+import stat
 import sys
+import threading
+try:
+    import cPickle as pickle
+except:
+    import pickle
+try:
+    from hashlib import sha1
+except ImportError:
+    from sha import new as sha1
 
 PROCESS_MODULE_ASYNCPROCESS_PATH = 'vsc.utils.asyncprocess'
 PROCESS_MODULE_SUBPROCESS_PATH = 'subprocess'
+PROCESS_MODULE_SPAWN_PATH = 'vsc.utils.spawn'
+
+READSIZE_ALL = 1024 * 1024  ## size of the reads when reading all output
 
 class DummyFunction(object):
     def __getattr__(self, name):
@@ -78,8 +98,413 @@ class DummyFunction(object):
             pass
         return dummy
 
+
+## the SIGCHLD handler shared by the started SigChldPipes
+_SIGCHLD = {
+    'write_fds': [],  ## write ends of the pipes of the started SigChldPipes
+    'handler_orig': None,  ## the handler before the first start
+}
+
+
+def _sigchld_handler(signum, frame):
+    """Wake up all started SigChldPipes"""
+    for write_fd in _SIGCHLD['write_fds'][:]:
+        try:
+            os.write(write_fd, '.')
+        except OSError:
+            pass  ## pipe full: there is already a wakeup pending
+
+
+class SigChldPipe(object):
+    """SIGCHLD self-pipe: the SIGCHLD handler writes to the pipe, so the exit of a child
+        wakes up a poll on the read end (fileno).
+        Signal handlers can only be set in the main thread: start returns False otherwise.
+
+        All started pipes share one SIGCHLD handler: the first start installs it, the last stop restores the
+        original handler, so several pipes (eg interleaved RunPool iterators) can be stopped in any order.
+        While the handler is installed, syscalls interrupted by SIGCHLD are restarted (siginterrupt False);
+        the last stop sets siginterrupt True again, the state signal.signal gives to every handler (python can
+        not query the flag, so a False set by the application for its own handler is not restored).
+        Limitation: the handlers are not restored in LIFO order; a SIGCHLD handler installed by someone else
+        while pipes are started is replaced by the original handler on the last stop.
+    """
+    def __init__(self):
+        self.pipe = None
+
+    def start(self):
+        """Create the pipe and install the SIGCHLD handler (if not installed yet), return True on success"""
+        if not isinstance(threading.currentThread(), threading._MainThread):
+            return False
+        self.pipe = os.pipe()
+        for pfd in self.pipe:
+            fcntl.fcntl(pfd, fcntl.F_SETFL, fcntl.fcntl(pfd, fcntl.F_GETFL) | os.O_NONBLOCK)
+
+        if not _SIGCHLD['write_fds']:
+            try:
+                _SIGCHLD['handler_orig'] = signal.signal(signal.SIGCHLD, _sigchld_handler)
+            except ValueError:
+                self._close()
+                return False
+            ## restart the interrupted syscalls (in all threads), only poll returns early
+            signal.siginterrupt(signal.SIGCHLD, False)
+        _SIGCHLD['write_fds'].append(self.pipe[1])
+        return True
+
+    def fileno(self):
+        return self.pipe[0]
+
+    def drain(self):
+        """Empty the pipe"""
+        try:
+            while os.read(self.pipe[0], 1024):
+                pass
+        except OSError:
+            pass
+
+    def stop(self):
+        """Close the pipe, the last stop restores the original SIGCHLD handler"""
+        if self.pipe is None:
+            return
+        _SIGCHLD['write_fds'].remove(self.pipe[1])
+        if not _SIGCHLD['write_fds']:
+            orig = _SIGCHLD['handler_orig']
+            if orig is None:
+                orig = signal.SIG_DFL
+            signal.signal(signal.SIGCHLD, orig)
+            signal.siginterrupt(signal.SIGCHLD, True)
+            _SIGCHLD['handler_orig'] = None
+        self._close()
+
+    def _close(self):
+        for pfd in self.pipe:
+            os.close(pfd)
+        self.pipe = None
+
+
+def write_eintr(fd, data):
+    """Write all data to fd, retry when interrupted (eg SIGCHLD)"""
+    while data:
+        try:
+            written = os.write(fd, data)
+        except OSError, err:
+            if err.errno == errno.EINTR:
+                continue
+            raise
+        data = data[written:]
+
+
+def poll_eintr(poller, timeout):
+    """Poll with timeout in seconds (None blocks), return the list of (fd, event)
+        an interrupt (eg SIGCHLD) returns no events
+    """
+    if timeout is None:
+        timeout_ms = -1
+    else:
+        timeout_ms = int(timeout * 1000)
+    try:
+        return poller.poll(timeout_ms)
+    except select.error, err:
+        if err[0] == errno.EINTR:
+            return []
+        raise
+
+class OutputBuffer(object):
+    """Collect output as a list of chunks (no quadratic string concatenation)
+        - size: total number of bytes written
+        - filename: file with the output (only for buffers that write to file)
+    """
+    def __init__(self):
+        self._chunks = deque()
+        self._length = 0  ## bytes in chunks
+        self.size = 0
+        self.filename = None
+
+    def write(self, data):
+        if data:
+            self._chunks.append(data)
+            self._length += len(data)
+            self.size += len(data)
+
+    def getvalue(self):
+        """Return all output as a single string"""
+        if len(self._chunks) > 1:
+            self._chunks = deque([''.join(self._chunks)])
+        return ''.join(self._chunks)
+
+    def close(self):
+        """No more output"""
+        pass
+
+
+class OutputBufferTail(OutputBuffer):
+    """Keep only the tail of the output in memory: the last maxbytes bytes and/or the last maxlines lines"""
+    def __init__(self, maxbytes=None, maxlines=None):
+        super(OutputBufferTail, self).__init__()
+        self.maxbytes = maxbytes
+        self.maxlines = maxlines
+        self._newlines = 0  ## newlines in chunks
+
+    def write(self, data):
+        super(OutputBufferTail, self).write(data)
+        self._newlines += data.count('\n')
+
+        ## drop the chunks that are not needed anymore (getvalue makes the exact cut)
+        while len(self._chunks) > 1:
+            first = self._chunks[0]
+            first_newlines = first.count('\n')
+            enough_bytes = self.maxbytes is not None and self._length - len(first) >= self.maxbytes
+            enough_lines = self.maxlines is not None and self._newlines - first_newlines > self.maxlines
+            if not (enough_bytes or enough_lines):
+                break
+            self._chunks.popleft()
+            self._length -= len(first)
+            self._newlines -= first_newlines
+
+    def getvalue(self):
+        """Return the tail"""
+        value = super(OutputBufferTail, self).getvalue()
+        if self.maxlines is not None:
+            value = ''.join(value.splitlines(True)[-self.maxlines:])
+        if self.maxbytes is not None:
+            value = value[-self.maxbytes:]
+        return value
+
+
+class OutputBufferSpill(OutputBuffer):
+    """Keep the output in memory up to threshold bytes, then write all output to a temporary file in dirname
+        (default dirname is the tempfile default, eg $TMPDIR)
+        - tail: OutputBufferTail that keeps the tail in memory, getvalue returns the tail once spilled
+    """
+    def __init__(self, threshold, dirname=None, tail=None):
+        super(OutputBufferSpill, self).__init__()
+        self.threshold = threshold
+        self.dirname = dirname
+        self.tail = tail
+        self._filehandle = None
+
+    def write(self, data):
+        if not data:
+            return
+        if self.tail is not None:
+            self.tail.write(data)
+        if self._filehandle is None:
+            super(OutputBufferSpill, self).write(data)
+            if self._length > self.threshold:
+                self._spill()
+        else:
+            self._filehandle.write(data)
+            self.size += len(data)
+
+    def _spill(self):
+        """Move the output in memory to the file"""
+        fd, self.filename = tempfile.mkstemp(prefix='vsc_run_', suffix='.out', dir=self.dirname)
+        self._filehandle = os.fdopen(fd, 'wb')
+        while self._chunks:
+            self._filehandle.write(self._chunks.popleft())
+        self._length = 0
+
+    def getvalue(self):
+        """Return the output when not spilled, the tail (if any) otherwise"""
+        if self.filename is None:
+            return super(OutputBufferSpill, self).getvalue()
+        elif self.tail is not None:
+            return self.tail.getvalue()
+        else:
+            return ''
+
+    def close(self):
+        if self._filehandle is not None:
+            self._filehandle.close()
+            self._filehandle = None
+
+
+class RunStream(object):
+    """Iterate over the output of a Run instance while the process runs (see Run.stream)
+        - lines: yield lines (including the newline), otherwise raw chunks as they are read
+        - encoding: decode the lines/chunks with this encoding
+        The exitcode is set when the iteration is done.
+    """
+    def __init__(self, run, lines=True, encoding=None):
+        self.run = run
+        self.lines = lines
+        self.encoding = encoding
+        self.exitcode = None
+
+    def __iter__(self):
+        for data in self._iter_raw():
+            if self.encoding is not None:
+                data = data.decode(self.encoding, 'replace')
+            yield data
+        self.exitcode = self.run._process_exitcode
+
+    def _iter_raw(self):
+        if not self.lines:
+            for chunk in self.run._stream():
+                yield chunk
+            return
+
+        pending = []  ## incomplete line
+        for chunk in self.run._stream():
+            if not '\n' in chunk:
+                pending.append(chunk)
+                continue
+            pending.append(chunk)
+            lines = ''.join(pending).split('\n')
+            pending = [lines.pop()]
+            for line in lines:
+                yield line + '\n'
+        rest = ''.join(pending)
+        if rest:
+            yield rest
+
+
+class RunCache(object):
+    """On-disk cache of (exitcode, output) of commands, shared between processes
+        - one file per entry, named after the hash of the key; the key is made of
+          the command, the shell mode, the hostname and the path and mtime of the executable
+          (so a new or updated executable does not get an old result)
+        - entries are written to a temporary file and renamed, so concurrent readers see either
+          nothing or a complete entry, without locking
+        - an entry older than the ttl of the reader is a miss; when storing, entries older than
+          MAX_AGE are removed, and the oldest ones once there are more than MAX_ENTRIES
+        - the default directory is private per user in the temporary directory;
+          a directory that is not owned by the user, or not mode 0700, or a symlink is not used
+    """
+    MAX_ENTRIES = 512
+    MAX_AGE = 24 * 60 * 60
+    SUFFIX = '.runcache'
+
+    def __init__(self, dirname=None):
+        self.log = getLogger(self.__class__.__name__)
+        if dirname is None:
+            dirname = os.path.join(tempfile.gettempdir(), 'vsc-run-cache-%s' % os.getuid())
+        self.dirname = dirname
+        self.usable = self._prep_dir()
+
+    def _prep_dir(self):
+        """Create the directory, return True if it can be used"""
+        try:
+            os.makedirs(self.dirname, 0700)
+        except OSError, err:
+            if err.errno != errno.EEXIST:
+                self.log.debug("_prep_dir: failed to create %s: %s" % (self.dirname, err))
+                return False
+        ## lstat: a symlink (eg to a directory of another user) is not followed
+        try:
+            st = os.lstat(self.dirname)
+        except OSError:
+            return False
+        if not stat.S_ISDIR(st.st_mode):
+            self.log.warning("_prep_dir: cache directory %s is not a directory, not using it" % self.dirname)
+            return False
+        if st.st_uid != os.getuid():
+            self.log.warning("_prep_dir: cache directory %s not owned by uid %s, not using it" %
+                             (self.dirname, os.getuid()))
+            return False
+        if stat.S_IMODE(st.st_mode) != 0700:
+            self.log.warning("_prep_dir: cache directory %s has mode %o instead of 0700, not using it" %
+                             (self.dirname, stat.S_IMODE(st.st_mode)))
+            return False
+        return True
+
+    def _which(self, cmd, shell):
+        """Return (path, mtime) of the executable of cmd, (None, None) if it is not found"""
+        try:
+            if isinstance(cmd, (list, tuple,)):
+                exe = cmd[0] if not shell else shlex.split(" ".join(cmd))[0]
+            else:
+                exe = shlex.split(cmd)[0]
+        except (IndexError, ValueError):
+            return None, None
+
+        if os.path.sep in exe:
+            paths = [exe]
+        else:
+            paths = [os.path.join(dirname, exe) for dirname in os.environ.get('PATH', os.defpath).split(os.pathsep)]
+        for path in paths:
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            if os.access(path, os.X_OK):
+                return os.path.abspath(path), st.st_mtime
+        return None, None
+
+    def key(self, cmd, shell=True, extra=None):
+        """Return the key for cmd"""
+        path, mtime = self._which(cmd, shell)
+        return sha1(repr((cmd, shell, socket.gethostname(), path, mtime, extra))).hexdigest()
+
+    def _filename(self, key):
+        return os.path.join(self.dirname, key + self.SUFFIX)
+
+    def get(self, key, ttl):
+        """Return the cached value for key, None if there is no entry younger than ttl seconds"""
+        if not self.usable:
+            return None
+        filename = self._filename(key)
+        try:
+            if time.time() - os.stat(filename).st_mtime > ttl:
+                return None
+            fh = open(filename, 'rb')
+            try:
+                return pickle.load(fh)
+            finally:
+                fh.close()
+        except (OSError, IOError, EOFError, pickle.UnpicklingError, ValueError):
+            return None
+
+    def set(self, key, value):
+        """Store value for key"""
+        if not self.usable:
+            return
+        try:
+            (fd, tmpname) = tempfile.mkstemp(dir=self.dirname, prefix='.tmp')
+            fh = os.fdopen(fd, 'wb')
+            try:
+                pickle.dump(value, fh, pickle.HIGHEST_PROTOCOL)
+            finally:
+                fh.close()
+            os.rename(tmpname, self._filename(key))
+        except (OSError, IOError), err:
+            self.log.debug("set: failed to store key %s: %s" % (key, err))
+            return
+        self.evict()
+
+    def evict(self):
+        """Remove entries older than MAX_AGE, and the oldest entries above MAX_ENTRIES"""
+        entries = []
+        now = time.time()
+        for name in os.listdir(self.dirname):
+            if not name.endswith(self.SUFFIX):
+                continue
+            filename = os.path.join(self.dirname, name)
+            try:
+                mtime = os.stat(filename).st_mtime
+                if now - mtime > self.MAX_AGE:
+                    os.unlink(filename)
+                else:
+                    entries.append((mtime, filename))
+            except OSError:
+                ## removed by someone else
+                continue
+
+        if len(entries) > self.MAX_ENTRIES:
+            entries.sort()
+            for _, filename in entries[:len(entries) - self.MAX_ENTRIES]:
+                try:
+                    os.unlink(filename)
+                except OSError:
+                    continue
+
+
 class Run(object):
     """Base class for static run method"""
+    SHELL = True  ## run the cmd with /bin/bash; if False, the cmd is an argv list executed directly
+    LOG_STATS = False  ## log the stats of each process at debug level
+    KILL_GRACE = 5  ## seconds between SIGTERM and SIGKILL after a timeout
+    TIMEOUT_EXITCODE = 124  ## exitcode of a process killed after a timeout (like coreutils timeout)
+    WAIT_POLL_INTERVAL = 0.1  ## wait for the exit with a timeout, without SIGCHLD self-pipe (not main thread)
     @classmethod
     def run(cls, cmd, **kwargs):
         """static method
@@ -88,12 +513,70 @@ class Run(object):
         r = cls(cmd, **kwargs)
         return r._run()
 
+    @classmethod
+    def stream(cls, cmd, lines=True, encoding=None, **kwargs):
+        """static method
+            return RunStream to iterate over the output lines (or raw chunks with lines=False) while the process runs
+            the output is not collected, the exitcode attribute is set at the end of the iteration
+        """
+        return RunStream(cls(cmd, **kwargs), lines=lines, encoding=encoding)
+
     def __init__(self, cmd=None, **kwargs):
+        """Named arguments for the capture policy of the output
+            - capture_tail: only keep the last capture_tail bytes in memory
+            - capture_tail_lines: only keep the last capture_tail_lines lines in memory
+            - capture_spill: once the output exceeds capture_spill bytes, write all output to a temporary file
+              in capture_dir; the name of the file is returned instead of the output
+              (and the tail, if any of the capture_tail options are set, is kept for logging)
+            Named argument shell (default SHELL)
+            - shell=False: no shell is started; a list cmd is used as argv as is,
+              a string cmd is split with shlex (so quoting works as in the shell)
+              the process is started with posix_spawn (vsc.utils.spawn) when available
+            Named arguments for the result cache (see RunCache)
+            - cache_ttl: reuse the (exitcode, output) of the same command run less than cache_ttl seconds ago,
+              also by other processes; only for commands without side effects and input
+            - cache_dir: directory of the cache (default: private directory in the temporary directory)
+            - cache_failed: also cache the result of a non-zero exitcode (default False)
+            Named argument log_stats (default LOG_STATS): log the stats dict at debug level after the run
+                the stats dict has the wall time, time to first output byte and first_byte (in seconds),
+                bytes and reads of output, loops of the RunLoop, and from the rusage of the child (os.wait4)
+                utime, stime (in seconds), maxrss (in kB), minflt, majflt, nvcsw and nivcsw
+            Named arguments for a timeout
+            - timeout: seconds the process can run; the process is started in its own process group
+              and after the timeout, the process group gets SIGTERM, and SIGKILL kill_grace seconds later
+              the exitcode is TIMEOUT_EXITCODE, the output is what was read until then
+              kill_grace seconds after the SIGKILL, the output is no longer read, even if a descendant
+              that left the process group (eg setsid) keeps the pipe open: the timeout is a hard bound
+            - kill_grace (default KILL_GRACE)
+        """
         if kwargs.pop('disable_log', None):
             self.log = DummyFunction() ## No logging
         if not hasattr(self, 'log'):
             self.log = getLogger(self._get_log_name())
 
+        self.capture_tail = kwargs.pop('capture_tail', None)
+        self.capture_tail_lines = kwargs.pop('capture_tail_lines', None)
+        self.capture_spill = kwargs.pop('capture_spill', None)
+        self.capture_dir = kwargs.pop('capture_dir', None)
+
+        self.shell = kwargs.pop('shell', self.SHELL)
+
+        self.cache_ttl = kwargs.pop('cache_ttl', None)
+        self.cache_dir = kwargs.pop('cache_dir', None)
+        self.cache_failed = kwargs.pop('cache_failed', False)
+
+        self.log_stats = kwargs.pop('log_stats', self.LOG_STATS)
+
+        self.timeout = kwargs.pop('timeout', None)
+        self.kill_grace = kwargs.pop('kill_grace', self.KILL_GRACE)
+        self.timed_out = False
+        self._timeout_deadline = None
+        self._timeout_killed = False  ## SIGKILL was sent
+        self._timeout_abandoned = False  ## the output is no longer read
+        self._own_pgroup = False
+        self.stats = None
+        self._stats_start = None
+
         self.cmd = cmd  ## actual command
         self.input = None
 
@@ -110,6 +593,8 @@ class Run(object):
 
         self._process_exitcode = None
         self._process_output = None
+        self._output_buffer = None  ## collects the output
+        self.output_filename = None  ## file with the output (capture_spill)
 
         self._post_exitcode_log_failure = self.log.error
 
@@ -123,6 +608,13 @@ class Run(object):
         ## these will provide the required Popen, PIPE and STDOUT
         if modulepath is None:
             modulepath = PROCESS_MODULE_SUBPROCESS_PATH
+            if not self.shell:
+                try:
+                    from vsc.utils.spawn import HAVE_POSIX_SPAWN
+                    if HAVE_POSIX_SPAWN:
+                        modulepath = PROCESS_MODULE_SPAWN_PATH
+                except (ImportError, OSError):
+                    self.log.debug("_prep_module: no posix_spawn, using %s" % modulepath)
 
         fromlist = ['Popen', 'PIPE', 'STDOUT']
         if extendfromlist is not None:
@@ -181,10 +673,32 @@ class Run(object):
                 - just return True/False
 
 """
+        if self.cache_ttl is not None:
+            return self._run_cached()
+
         self._run_pre()
         self._wait_for_process()
         return self._run_post()
 
+    def _run_cached(self):
+        """Return the result from the RunCache, run and store it on a miss"""
+        cache = RunCache(dirname=self.cache_dir)
+        key = cache.key(self.cmd, shell=self.shell, extra=(self.__class__.__name__, self.startpath, self.input))
+        res = cache.get(key, self.cache_ttl)
+        if res is not None:
+            self.log.debug("_run_cached: cmd %s result from cache %s" % (self.cmd, cache.dirname))
+            self._process_exitcode, self._process_output = res
+            return res
+
+        self._run_pre()
+        self._wait_for_process()
+        res = self._run_post()
+        ## a failed command is only cached on request
+        cacheable = self._process_exitcode == 0 or self.cache_failed
+        if self.output_filename is None and not self.timed_out and cacheable:
+            cache.set(key, res)
+        return res
+
     def _run_pre(self):
         """Non-blocking start"""
         if self._process_module is None:
@@ -205,15 +719,22 @@ class Run(object):
 
 
     def _run_post(self):
+        if self.timed_out:
+            self._process_exitcode = self.TIMEOUT_EXITCODE
+        if self._timeout_abandoned and self._process.stdout is not None:
+            ## do not wait for the descendant that still has the other end
+            self._process.stdout.close()
+
         self._cleanup_process()
 
         self._post_exitcode()
 
         self._post_output()
 
-        if self.startpath is not None:
+        if self._cwd_before_startpath is not None:
             self._return_to_previous_start_in_path()
 
+        self._stats_post()
 
         return self._run_return()
 
@@ -251,6 +772,7 @@ class Run(object):
                         self.log.warning(("_return_to_previous_start_in_path: current diretory %s does not match "
                                           "startpath %s") % (currentpath, self.startpath))
                     os.chdir(self._cwd_before_startpath)
+                    self._cwd_before_startpath = None
                 except:
                     self.raiseException(("_return_to_previous_start_in_path: failed to change path from current %s "
                                          "to previous path %s") % (currentpath, self._cwd_before_startpath))
@@ -268,9 +790,20 @@ class Run(object):
                                   'stderr':self._process_module.STDOUT,
                                   'stdin':self._process_module.PIPE,
                                   'close_fds':True,
-                                  'shell':True,
-                                  'executable':"/bin/bash",
+                                  'shell':self.shell,
+                                  'executable':None,
                                   }
+        if self.shell:
+            self._popen_named_args['executable'] = "/bin/bash"
+
+        if self.timeout is not None:
+            ## own process group, to kill the whole tree
+            self._own_pgroup = True
+            if self._process_modulepath == PROCESS_MODULE_SPAWN_PATH:
+                self._popen_named_args['pgroup'] = 0
+            else:
+                self._popen_named_args['preexec_fn'] = os.setpgrp
+
         if others is not None:
             self._popen_named_args.update(others)
 
@@ -278,29 +811,168 @@ class Run(object):
 
 
     def _make_shell_command(self):
-        """Convert cmd into shell command"""
+        """Convert cmd into shell command (or argv list when not using a shell)"""
         if self.cmd is None:
             self.log.raiseExcpetion("_make_shell_command: no cmd set.")
 
         if isinstance(self.cmd, str):
-            self._shellcmd = self.cmd
+            if self.shell:
+                self._shellcmd = self.cmd
+            else:
+                self._shellcmd = shlex.split(self.cmd)
         elif isinstance(self.cmd, (list, tuple,)):
-            self._shellcmd = " ".join(self.cmd)
+            if self.shell:
+                self._shellcmd = " ".join(self.cmd)
+            else:
+                self._shellcmd = [str(x) for x in self.cmd]
         else:
             self.log.raiseException("Failed to convert cmd %s (type %s) into shell command" % (self.cmd, type(self.cmd)))
 
     def _init_process(self):
         """Initialise the self._process"""
         try:
+            self._stats_init()
             self._process = self._process_module.Popen(self._shellcmd, **self._popen_named_args)
         except OSError:
-            self.log.raiseException("_init_process: init Popen shellcmd %s failed: %s" % (self._shellcmd))
+            self.log.raiseException("_init_process: init Popen shellcmd %s failed" % (self._shellcmd,))
+
+        if self.timeout is not None:
+            self._timeout_deadline = time.time() + self.timeout
+
+    def _kill(self, sig):
+        """Send signal sig to the process, or to its process group when it has its own"""
+        try:
+            if self._own_pgroup:
+                ## the pgid can not be reused while the group has members, even if the process is reaped
+                os.killpg(self._process.pid, sig)
+            elif self._process.returncode is None:
+                os.kill(self._process.pid, sig)
+        except OSError, err:
+            if err.errno != errno.ESRCH:
+                raise
+
+    def _timeout_check(self, limit=None):
+        """Act on an expired timeout (SIGTERM, then after kill_grace SIGKILL, and after kill_grace again
+            stop reading the output)
+            return the seconds until the next action, or limit if that is sooner (None if both are None)
+        """
+        if self._timeout_deadline is not None and time.time() >= self._timeout_deadline:
+            if not self.timed_out:
+                self.timed_out = True
+                self.log.warning("_timeout_check: timeout %s s reached for cmd %s, sending SIGTERM" %
+                                 (self.timeout, self.cmd))
+                self._kill(signal.SIGTERM)
+                self._timeout_deadline = time.time() + self.kill_grace
+            elif not self._timeout_killed:
+                self.log.warning("_timeout_check: cmd %s still running %s s after SIGTERM, sending SIGKILL" %
+                                 (self.cmd, self.kill_grace))
+                self._kill(signal.SIGKILL)
+                self._timeout_killed = True
+                self._timeout_deadline = time.time() + self.kill_grace
+            else:
+                self.log.warning(("_timeout_check: output of cmd %s still open %s s after SIGKILL "
+                                  "(descendant outside the process group?), not reading it anymore") %
+                                 (self.cmd, self.kill_grace))
+                self._timeout_abandoned = True
+                self._timeout_deadline = None
+                ## the caller acts on it right away
+                return 0
+
+        if self._timeout_deadline is None:
+            return limit
+        remaining = max(self._timeout_deadline - time.time(), 0)
+        if limit is None:
+            return remaining
+        return min(remaining, limit)
+
+    def _process_poll(self, block=False):
+        """Poll (or with block, wait for) the process, return the exitcode (None if it is still running)
+            the process is reaped with os.wait4, for the rusage in the stats
+        """
+        if block and self._timeout_deadline is not None:
+            return self._process_wait_timeout()
+
+        while self._process.returncode is None:
+            try:
+                (pid, sts, rusage) = os.wait4(self._process.pid, 0 if block else os.WNOHANG)
+            except OSError, err:
+                if err.errno == errno.EINTR:
+                    continue
+                elif err.errno == errno.ECHILD:
+                    ## reaped by someone else, let Popen handle it
+                    if block:
+                        return self._process.wait()
+                    return self._process.poll()
+                raise
+            if pid == self._process.pid:
+                self._process._handle_exitstatus(sts)
+                self._stats_exit(rusage)
+            elif not block:
+                break
+        return self._process.returncode
+
+    def _process_wait_timeout(self):
+        """Wait for the process, woken up by SIGCHLD or the timeout, return the exitcode"""
+        poller = select.poll()
+        sigchld = SigChldPipe()
+        if sigchld.start():
+            poller.register(sigchld.fileno(), select.POLLIN)
+        else:
+            sigchld = None
+        try:
+            while self._process_poll() is None:
+                limit = None
+                if sigchld is None:
+                    limit = self.WAIT_POLL_INTERVAL
+                if poll_eintr(poller, self._timeout_check(limit)):
+                    sigchld.drain()
+        finally:
+            if sigchld is not None:
+                sigchld.stop()
+        return self._process.returncode
+
+    def _stats_init(self):
+        """Initialise the stats, right before the start of the process"""
+        self._stats_start = time.time()
+        self.stats = {
+            'wall': None,
+            'first_byte': None,
+            'bytes': 0,
+            'reads': 0,
+            'loops': 0,
+        }
+
+    def _stats_read(self, out):
+        """Account output out in the stats, return out"""
+        if out and self.stats is not None:
+            if self.stats['first_byte'] is None:
+                self.stats['first_byte'] = time.time() - self._stats_start
+            self.stats['bytes'] += len(out)
+            self.stats['reads'] += 1
+        return out
+
+    def _stats_exit(self, rusage):
+        """Add the wall time and the rusage of the child to the stats"""
+        if self.stats is None:
+            return
+        self.stats['wall'] = time.time() - self._stats_start
+        for name in ['utime', 'stime', 'maxrss', 'minflt', 'majflt', 'nvcsw', 'nivcsw']:
+            self.stats[name] = getattr(rusage, 'ru_%s' % name)
+
+    def _stats_post(self):
+        """Finalise the stats, log them with log_stats"""
+        if self.stats is None:
+            return
+        self.stats['loops'] = getattr(self, '_loop_count', None) or 0
+        if self.log_stats:
+            self.log.debug("stats cmd %s: %s" % (self.cmd, ', '.join(["%s %s" % (k, self.stats[k])
+                                                                       for k in sorted(self.stats)])))
 
     def _init_input(self):
         """Handle input, if any in a simple way"""
         if self.input is not None:
             try:
-                self._process.stdin.write(self.input)
+                write_eintr(self._process.stdin.fileno(), self.input)
             except:
                 self.log.raiseException("_init_input: Failed write input %s to process" % self.input)
 
@@ -309,15 +981,58 @@ class Run(object):
 
     def _wait_for_process(self):
         """The main loop
-            This one has most simple loop
+            This one has most simple loop: read the output until EOF, then wait for the exitcode
         """
         try:
-            self._process_exitcode = self._process.wait()
-            self._process_output = self._read_process(-1) ## -1 is read all
+            self._output_buffer = self._make_output_buffer()
+            if self._process.stdout is None:
+                self._output_buffer.write(self._read_process(-1))
+            else:
+                while True:
+                    output = self._read_process_event(READSIZE_ALL)
+                    if not output:
+                        break
+                    self._output_buffer.write(output)
+            self._process_exitcode = self._process_poll(block=True)
+            self._collect_output()
         except:
             self.log.raiseException("_wait_for_process: problem during wait exitcode %s output %s" %
                                     (self._process_exitcode, self._process_output))
 
+    def _make_output_buffer(self):
+        """Return the OutputBuffer for the capture policy"""
+        tail = None
+        if self.capture_tail is not None or self.capture_tail_lines is not None:
+            tail = OutputBufferTail(maxbytes=self.capture_tail, maxlines=self.capture_tail_lines)
+
+        if self.capture_spill is not None:
+            return OutputBufferSpill(self.capture_spill, dirname=self.capture_dir, tail=tail)
+        elif tail is not None:
+            return tail
+        else:
+            return OutputBuffer()
+
+    def _collect_output(self):
+        """Set the output from the output buffer"""
+        self._output_buffer.close()
+        self._process_output = self._output_buffer.getvalue()
+        self.output_filename = self._output_buffer.filename
+        if self.output_filename is not None:
+            self.log.debug("_collect_output: %s bytes output written to %s" %
+                           (self._output_buffer.size, self.output_filename))
+
+    def _stream(self):
+        """Generator over the output while the process runs, the output is not collected"""
+        self._run_pre()
+        while True:
+            output = self._read_process_event(self.readsize)
+            if not output:
+                break
+            yield output
+        self._process_exitcode = self._process_poll(block=True)
+        self._process_output = ''
+        self._run_post()
+
     def _cleanup_process(self):
         """Cleanup any leftovers from the process"""
 
@@ -328,9 +1043,64 @@ class Run(object):
             readsize = self.readsize
         if readsize is None:
             readsize = -1  ## read all
+        if self._timeout_abandoned:
+            return ''
+        if self._timeout_deadline is not None:
+            ## a blocking read of readsize bytes does not stop at the timeout
+            return self._read_process_event(readsize)
         self.log.debug("_read_process: going to read with readsize %s" % readsize)
-        out = self._process.stdout.read(readsize)
-        return out
+        while True:
+            try:
+                out = self._process.stdout.read(readsize)
+                break
+            except IOError, err:
+                if err.errno != errno.EINTR:
+                    raise
+        return self._stats_read(out)
+
+    def _read_process_event(self, readsize=None):
+        """Read from process after an event, return out
+            - readsize >= 0: a single read of at most readsize bytes (does not block after poll event)
+            - readsize < 0: read all until EOF
+        """
+        if readsize is None:
+            readsize = self.readsize
+        if self._timeout_abandoned:
+            return ''
+        fd = self._process.stdout.fileno()
+        poller = None
+        if self._timeout_deadline is not None:
+            poller = select.poll()
+            poller.register(fd, select.POLLIN | select.POLLPRI)
+
+        def read_eintr(size):
+            while True:
+                if self._timeout_abandoned:
+                    ## like EOF
+                    return ''
+                if poller is not None and self._timeout_deadline is not None:
+                    ## do not block beyond the timeout
+                    if not poll_eintr(poller, self._timeout_check()):
+                        continue
+                try:
+                    return os.read(fd, size)
+                except OSError, err:
+                    if err.errno == errno.EAGAIN:
+                        ## non-blocking pipe (eg asyncprocess)
+                        select.select([fd], [], [])
+                    elif err.errno != errno.EINTR:
+                        raise
+
+        if readsize >= 0:
+            return self._stats_read(read_eintr(readsize))
+
+        out = []
+        while True:
+            data = read_eintr(max(self.readsize, READSIZE_ALL))
+            if not data:
+                break
+            out.append(self._stats_read(data))
+        return ''.join(out)
 
     def _post_exitcode(self):
         """Postprocess the exitcode in self._process_exitcode"""
@@ -345,7 +1115,11 @@ class Run(object):
         pass
 
     def _run_return(self):
-        """What to return"""
+        """What to return
+            the output, or the filename with the output when it was spilled to file
+        """
+        if self.output_filename is not None:
+            return self._process_exitcode, self.output_filename
         return self._process_exitcode, self._process_output
 
 class RunNoWorries(Run):
@@ -359,52 +1133,148 @@ class RunLoop(Run):
     """Main process is a while loop which reads the output in blocks
         need to read from time to time.
         otherwise the stdout/stderr buffer gets filled and it all stops working
+
+        By default, the loop is event driven: it blocks (with poll) on the output of the process and on
+        a SIGCHLD self-pipe, so it returns as soon as the process is done.
+        The original timed loop (sleep LOOP_TIMEOUT_INIT, then LOOP_TIMEOUT_MAIN after each empty read)
+        is used when LOOP_EVENT is False or with named argument loop_event=False.
     """
     LOOP_TIMEOUT_INIT = 0.1
     LOOP_TIMEOUT_MAIN = 1
+    LOOP_EVENT = True
 
     def __init__(self, cmd, **kwargs):
+        self.loop_event = kwargs.pop('loop_event', self.LOOP_EVENT)
         super(RunLoop, self).__init__(cmd, **kwargs)
         self._loop_count = None
         self._loop_continue = None  ## intial state, change this to break out the loop
 
     def _wait_for_process(self):
-        """Loop through the process in timesteps
+        """Loop through the process
             collected output is run through _loop_process_output
         """
-        ## these are initialised outside the function (cannot be forgotten, but can be overwritten)
-        self._loop_count = 0  ## internal counter
-        self._loop_continue = True
+        self._loop_reset()
+
+        for output in self._loop_iter():
+            self._output_buffer.write(output)
+
+        self._collect_output()
+
+    def _stream(self):
+        """Generator over the output while the process runs, processed by the loop but not collected"""
+        self._run_pre()
+        self._loop_reset()
+        for output in self._loop_iter():
+            yield output
         self._process_output = ''
+        self._run_post()
 
-        ## further initialisation
-        self._loop_initialise()
+    def _loop_iter(self):
+        """Generator over the output of the loop (see LOOP_EVENT)"""
+        if self.loop_event:
+            return self._loop_iter_event()
+        else:
+            return self._loop_iter_timed()
 
+    def _loop_iter_timed(self):
+        """Loop through the process in timesteps"""
         time.sleep(self.LOOP_TIMEOUT_INIT)
-        ec = self._process.poll()
-        while self._loop_continue and ec < 0:
+        ec = self._process_poll()
+        while self._loop_continue and ec is None:
             output = self._read_process()
             self._loop_process_output(output)
 
-            self._process_output += output
-
-            if len(output) == 0:
-                time.sleep(self.LOOP_TIMEOUT_MAIN)
-            ec = self._process.poll()
+            if output:
+                yield output
+            else:
+                time.sleep(self._timeout_check(self.LOOP_TIMEOUT_MAIN))
+            self._timeout_check()
+            ec = self._process_poll()
 
             self._loop_count += 1
 
 
-        self.log.debug("_wait_for_process: loop stopped after %s iterations (ec %s loop_continue %s)" %
+        self.log.debug("_loop_iter_timed: loop stopped after %s iterations (ec %s loop_continue %s)" %
                        (self._loop_count, ec, self._loop_continue))
 
         # read remaining data (all of it)
         output = self._read_process(-1)
         self._loop_process_output_final(output)
 
-        self._process_output += output
         self._process_exitcode = ec
+        if output:
+            yield output
+
+    def _loop_iter_event(self):
+        """Loop through the process, woken up by new output or by the exit of the process
+            - poll timeout is LOOP_TIMEOUT_MAIN (eg RunQA counts the loops without output)
+            - without SIGCHLD self-pipe (eg not in the main thread), wait blocking for the exit once all output is read
+        """
+        sigchld = SigChldPipe()
+        if not sigchld.start():
+            self.log.debug("_loop_iter_event: no SIGCHLD handler (not main thread?)")
+            sigchld = None
+        try:
+            fd = self._process.stdout.fileno()
+            poller = select.poll()
+            poller.register(fd, select.POLLIN | select.POLLPRI)
+            if sigchld is not None:
+                poller.register(sigchld.fileno(), select.POLLIN)
+
+            fd_open = True
+            ec = self._process_poll()
+            while self._loop_continue and ec is None:
+                if not (fd_open or sigchld):
+                    ec = self._process_poll(block=True)
+                    break
+
+                output = ''
+                for event_fd, _ in poll_eintr(poller, self._timeout_check(self.LOOP_TIMEOUT_MAIN)):
+                    if event_fd == fd:
+                        output = self._read_process_event(self.readsize)
+                        if len(output) == 0:
+                            ## EOF
+                            poller.unregister(fd)
+                            fd_open = False
+                    else:
+                        sigchld.drain()
+
+                self._loop_process_output(output)
+
+                if output:
+                    yield output
+
+                self._timeout_check()
+                ec = self._process_poll()
+
+                self._loop_count += 1
+
+            self.log.debug("_loop_iter_event: loop stopped after %s iterations (ec %s loop_continue %s)" %
+                           (self._loop_count, ec, self._loop_continue))
+
+            # read remaining data (all of it)
+            output = ''
+            if fd_open:
+                output = self._read_process_event(-1)
+        finally:
+            if sigchld is not None:
+                sigchld.stop()
+
+        self._loop_process_output_final(output)
+
+        self._process_exitcode = ec
+        if output:
+            yield output
+
+    def _loop_reset(self):
+        """Set the loop state before the loop starts"""
+        ## these are initialised outside the function (cannot be forgotten, but can be overwritten)
+        self._loop_count = 0  ## internal counter
+        self._loop_continue = True
+        self._output_buffer = self._make_output_buffer()
 
+        ## further initialisation
+        self._loop_initialise()
 
     def _loop_initialise(self):
         """Initialisation before the loop starts"""
@@ -458,26 +1328,37 @@ class RunAsync(Run):
         if modulepath is None:
             modulepath = PROCESS_MODULE_ASYNCPROCESS_PATH
         if extendfromlist is None:
-            extendfromlist = ['send_all', 'recv_some']
+            extendfromlist = ['send_all', 'recv_some', 'recv_all']
         super(RunAsync, self)._prep_module(modulepath=modulepath, extendfromlist=extendfromlist)
 
+    def _init_input(self):
+        """Handle input, if any in a simple way (the pipes are non-blocking)"""
+        if self.input is not None:
+            try:
+                self._process_module.send_all(self._process, self.input)
+            except:
+                self.log.raiseException("_init_input: Failed write input %s to process" % self.input)
+
+        self._process.stdin.close()
+        self.log.debug("_init_input: stdin closed")
+
     def _read_process(self, readsize=None):
         """Read from async process, return out"""
         if readsize is None:
             readsize = self.readsize
 
-        if self._process.stdout is None:
+        if self._process.stdout is None or self._timeout_abandoned:
             ## Nothing yet/anymore
             return ''
 
         try:
             if readsize is not None  and readsize < 0:
                 ## read all blocking (it's not why we should use async
-                out = self._process.stdout.read()
+                out = self._process_module.recv_all(self._process)
             else:
                 ## non-blocking read (readsize is a maximum to return !
                 out = self._process_module.recv_some(self._process, maxread=readsize)
-            return out
+            return self._stats_read(out)
         except (IOError, Exception):
             # recv_some may throw Exception
             self.log.exception("_read_process: read failed")
@@ -522,12 +1403,32 @@ class RunFile(Run):
         super(RunFile, self)._make_popen_named_args(others=others)
 
     def _cleanup_process(self):
-        """Close the filehandle"""
+        """Close the filehandle
+            with one of the capture_tail options, the output is the tail of the file
+        """
         try:
             self.filehandle.close()
         except:
             self.log.raiseException("_cleanup_process: failed to close filehandle for filename %s" % self.filename)
 
+        if self.capture_tail is None and self.capture_tail_lines is None:
+            return
+
+        tail = OutputBufferTail(maxbytes=self.capture_tail, maxlines=self.capture_tail_lines)
+        try:
+            fh = open(self.filename, 'rb')
+            if self.capture_tail_lines is None:
+                fh.seek(max(os.path.getsize(self.filename) - self.capture_tail, 0))
+            while True:
+                data = fh.read(READSIZE_ALL)
+                if not data:
+                    break
+                tail.write(data)
+            fh.close()
+        except (OSError, IOError):
+            self.log.raiseException("_cleanup_process: failed to read tail of filename %s" % self.filename)
+        self._process_output = tail.getvalue()
+
     def _read_process(self, readsize=None):
         """Meaningless for filehandle"""
         return ''
@@ -569,17 +1470,31 @@ class RunLog(Run):
 
 
 class RunQA(RunLoop, RunAsync):
-    """Question/Answer processing"""
+    """Question/Answer processing
+        The questions are matched incrementally: only against a window with the last
+        max_question_length bytes of the output (questions are anchored at the end of the output).
+        - qa: all questions are combined in one regular expression, matched at the start of the reversed window
+        - qa_std and no_qa: regular expressions, searched in the window one by one
+          (arbitrary regular expressions can not be reversed, and an alternation of them is slower than the
+          separate searches: it loses the literal prefix search of re, eg 430 vs 370 us for 120 patterns
+          in a 1 kB window)
+    """
     LOOP_MAX_MISS_COUNT = 20
+    MAX_QUESTION_LENGTH = 1024
 
     def __init__(self, cmd, **kwargs):
         qa = kwargs.pop('qa', None)
-        self.qa, self.qa_std, self.no_qa = self._parse_qa(qa)
+        self.max_question_length = kwargs.pop('max_question_length', self.MAX_QUESTION_LENGTH)
         self._loop_miss_count = None ## maximum number of misses
         self._loop_previous_ouput_length = None ## track length of output through loop
+        self._qa_output_length = None ## total length of the output processed (also when it is not collected)
+        self._qa_window = None ## tail of the output
 
         super(RunQA, self).__init__(cmd, **kwargs)
 
+        self.qa, self.qa_std, self.no_qa = self._parse_qa(qa)
+        self._qa_reversed = self._make_qa_reversed()
+
     def _init_input(self):
         """Handle input, if any in a simple way"""
         ## do nothing here
@@ -588,47 +1503,35 @@ class RunQA(RunLoop, RunAsync):
     def _parse_qa(self, init_qa):
         """
         process the QandA dictionary
-            - given initial set of Q and A (in dict), return dict of reg. exp. and A
-
-            - make regular expression that matches the string with
-            - replace whitespace
-            - replace newline
+            - given initial set of Q and A (in dict), return
+                - dict of normalised question (single space between words) and A
+                - dict of reg. exp. and A for qa_std
+                - list of reg. exp for no_qa
         """
+        if init_qa is None:
+            init_qa = {}
 
-        def escape_special(string):
-            return re.sub(r"([\+\?\(\)\[\]\*\.\\])" , r"\\\1", string)
-
-        split = '[\s\n]+'
-        reg_split = re.compile(r"" + split)
-
-        def process_qa(q, a):
-            split_q = [escape_special(x) for x in reg_split.split(q)]
-            reg_q_txt = split.join(split_q) + split.rstrip('+') + "*$"
-            ## add optional split at the end
-            if not a.endswith('\n'):
-                a += '\n'
-            reg_q = re.compile(r"" + reg_q_txt)
-            if reg_q.search(q):
-                return (a, reg_q)
-            else:
-                self.log.error("_parse_q_a process_qa: question %s converted in %s does not match itself" %
-                               (q, reg_q_txt))
+        def add_newline(answer):
+            if not answer.endswith('\n'):
+                answer += '\n'
+            return answer
 
         new_qa = {}
         self.log.debug("new_qa: ")
-        for question, answer in init_qa.get('qa').items():
-            (a, reg_q) = process_qa(question, answer)
-            new_qa[reg_q] = a
-            self.log.debug("new_qa[%s]: %s" % (reg_q.pattern, a))
+        for question, answer in init_qa.get('qa', {}).items():
+            norm_q = " ".join(question.split())
+            if len(norm_q) > self.max_question_length:
+                self.log.warning("_parse_qa: question %s longer than max_question_length %s, it will never match" %
+                                 (norm_q, self.max_question_length))
+            new_qa[norm_q] = add_newline(answer)
+            self.log.debug("new_qa[%s]: %s" % (norm_q, new_qa[norm_q]))
 
         new_qa_std = {}
         self.log.debug("new_qa_std: ")
         for question, answer in init_qa.get('qa_std', {}).items():
             reg_q = re.compile(r"" + question + r"[\s\n]*$")
-            if not answer.endswith('\n'):
-                answer += '\n'
-            new_qa_std[reg_q] = answer
-            self.log.debug("new_qa_std[%s]: %s" % (reg_q.pattern, answer))
+            new_qa_std[reg_q] = add_newline(answer)
+            self.log.debug("new_qa_std[%s]: %s" % (reg_q.pattern, new_qa_std[reg_q]))
 
         # simple statements, can contain wildcards
         new_no_qa = [re.compile(r"" + x + r"[\s\n]*$") for x in init_qa.get('no_qa', [])]
@@ -636,39 +1539,74 @@ class RunQA(RunLoop, RunAsync):
 
         return new_qa, new_qa_std, new_no_qa
 
+    def _make_qa_reversed(self):
+        """Combine all qa questions in one regular expression that matches the reversed output
+            - whitespace between the words and trailing whitespace is free
+            - longest questions first, so the most specific question wins
+            (no named groups per question, python re supports only 100 of them: the matched text identifies
+            the question)
+        """
+        if not self.qa:
+            return None
+
+        questions = sorted(self.qa.keys(), key=len, reverse=True)
+        reversed_q = [r"[\s\n]+".join([re.escape(word[::-1]) for word in question.split()[::-1]])
+                      for question in questions]
+        return re.compile(r"[\s\n]*(?:%s)" % "|".join(reversed_q))
+
+    def _qa_answer(self):
+        """Return (question, answer) for the question at the end of the window, None if there is none"""
+        if self._qa_reversed is not None:
+            res = self._qa_reversed.match(self._qa_window[::-1])
+            if res:
+                question = " ".join(res.group(0)[::-1].split())
+                return question, self.qa[question]
+
+        for reg_q, answer in self.qa_std.items():
+            res = reg_q.search(self._qa_window)
+            if res:
+                return reg_q.pattern, answer % res.groupdict()
+
+        return None
+
     def _loop_initialise(self):
         """Initialisation before the loop starts"""
         self._loop_miss_count = 0
         self._loop_previous_ouput_length = 0
+        self._qa_output_length = 0
+        self._qa_window = ''
 
     def _loop_process_output(self, output):
         """Process the output that is read in blocks
-            simplest form: do nothing
+            answer questions found at the end of the output
         """
         hit = False
+        self._qa_output_length += len(output)
 
-        ## qa first and then qa_std
-        nr_qa = len(self.qa)
-        for idx, q, a in enumerate(self.qa.items() + self.qa_std.items()):
-            res = q.search(self._process_output)
-            if output and res:
-                fa = a % res.groupdict()
-                self.log.debug("_loop_process_output: answer %s question %s (std: %s) out %s" %
-                               (fa, q.pattern, idx >= nr_qa, self._process_output[-50:]))
-                self._process_module.send_all(self._process, fa)
+        if output:
+            if len(output) >= self.max_question_length:
+                self._qa_window = output[-self.max_question_length:]
+            else:
+                self._qa_window = (self._qa_window + output)[-self.max_question_length:]
+
+            ## qa first and then qa_std
+            qa = self._qa_answer()
+            if qa is not None:
+                question, answer = qa
+                self.log.debug("_loop_process_output: answer %s question %s out %s" %
+                               (answer, question, self._qa_window[-50:]))
+                self._process_module.send_all(self._process, answer)
                 hit = True
-                break
 
         if not hit:
-            curoutlen = len(self._process_output)
-            if curoutlen > self._loop_previous_ouput_length:
+            if self._qa_output_length > self._loop_previous_ouput_length:
                 ## still progress in output, just continue (but don't reset miss counter either)
-                self._loop_previous_ouput_length = curoutlen
+                self._loop_previous_ouput_length = self._qa_output_length
             else:
                 noqa = False
                 for r in self.no_qa:
-                    if r.search(self._process_output):
-                        self.log.debug("_loop_porcess_output: no_qa found for out %s" % self._process_output[-50:])
+                    if r.search(self._qa_window):
+                        self.log.debug("_loop_process_output: no_qa found for out %s" % self._qa_window[-50:])
                         noqa = True
                 if not noqa:
                     self._loop_miss_count += 1
@@ -677,20 +1615,16 @@ class RunQA(RunLoop, RunAsync):
 
 
         if  self._loop_miss_count > self.LOOP_MAX_MISS_COUNT:
-            # explicitly kill the child process before exiting
-            pid = None
-            pgid = None
+            # explicitly kill the child process (its process group with a timeout) before exiting
+            # the child is only in its own process group with a timeout, killpg(getpgid(child)) would kill us
             try:
-                pid = self._process.pid
-                pgid = os.getpgid(pid)
-                os.killpg(pgid, signal.SIGKILL)
-                os.kill(pid, signal.SIGKILL)
+                self._kill(signal.SIGKILL)
             except OSError, err:
-                self.log.debug("_loop_process_output exception caught when killing child process (pid %s pgid %s): %s" %
-                               (pid, pgid, err))
+                self.log.debug("_loop_process_output exception caught when killing child process (pid %s): %s" %
+                               (self._process.pid, err))
 
             self.log.error("_loop_process_output: max misses %s reached: end of output %s" %
-                           (self.LOOP_MAX_MISS_COUNT, self._process_output[-500:]))
+                           (self.LOOP_MAX_MISS_COUNT, self._qa_window[-500:]))
 
             ## stop the main loop (although process.poll will also stop it)
             self._loop_continue = False
@@ -698,9 +1632,9 @@ class RunQA(RunLoop, RunAsync):
 
     def _loop_process_output_final(self, output):
         """Process the remaining output that is read
-            do nothing
+            do nothing: the process is done, there is no one to answer
         """
-        ## TODO: do super ?
+        pass
 
 class RunAsyncLoop(RunLoop, RunAsync):
     """Async read in loop"""
@@ -715,6 +1649,212 @@ class RunAsyncLoopStdout(RunLoopStdout, RunAsync):
     """Async read, flush to stdout"""
     pass
 
+class RunPool(object):
+    """Run many commands in parallel, with at most max_workers running processes at any time.
+        All processes are handled in a single poll loop (no thread per process).
+
+        The commands are either cmds (instances of runclass are created with the named arguments)
+        or Run instances (eg to set input or startpath).
+        The semantics of the Run classes are kept: logging of the exitcode, input
+        and _loop_process_output of the RunLoop classes (eg RunQA answers).
+
+        Iterating yields (cmd, exitcode, output) in order of completion, or in order of submission with ordered=True.
+    """
+    MAX_WORKERS = 16
+
+    @classmethod
+    def run(cls, cmds, **kwargs):
+        """static method
+            return list of (cmd, exitcode, output)
+        """
+        return list(cls(cmds, **kwargs))
+
+    def __init__(self, cmds, runclass=None, max_workers=None, ordered=False, **kwargs):
+        self.log = getLogger(self.__class__.__name__)
+
+        self.cmds = cmds
+        if runclass is None:
+            runclass = Run
+        self.runclass = runclass
+        self.runkwargs = kwargs
+
+        if max_workers is None:
+            max_workers = self.MAX_WORKERS
+        if max_workers < 1:
+            self.log.raiseException("max_workers should be at least 1, got %s" % max_workers)
+        self.max_workers = max_workers
+        self.ordered = ordered
+
+    def __iter__(self):
+        return self._run()
+
+    def _start(self, idx, cmd):
+        """Start the process for cmd, return the state dict"""
+        if isinstance(cmd, Run):
+            r = cmd
+        else:
+            r = self.runclass(cmd, **self.runkwargs)
+
+        r._run_pre()
+        if r._cwd_before_startpath is not None:
+            ## the processes share the cwd of this process
+            r._return_to_previous_start_in_path()
+
+        state = {
+            'idx': idx,
+            'run': r,
+            'fd': None,
+            'loop': isinstance(r, RunLoop),
+            'output': r._make_output_buffer(),
+            'last': time.time(),
+        }
+        if r._process.stdout is not None:
+            state['fd'] = r._process.stdout.fileno()
+        if state['loop']:
+            r._loop_reset()
+        self.log.debug("_start: started idx %s cmd %s" % (idx, r.cmd))
+        return state
+
+    def _output(self, state, output):
+        """Process the output of one process"""
+        r = state['run']
+        if state['loop']:
+            r._loop_process_output(output)
+            r._output_buffer.write(output)
+            r._loop_count += 1
+        else:
+            state['output'].write(output)
+        state['last'] = time.time()
+
+    def _finish(self, state, ec):
+        """Postprocess the finished process, return (cmd, exitcode, output)"""
+        r = state['run']
+        if state['loop']:
+            r._loop_process_output_final('')
+        else:
+            r._output_buffer = state['output']
+        r._collect_output()
+        r._process_exitcode = ec
+        ec, output = r._run_post()
+        return r.cmd, ec, output
+
+    def _poll_timeout(self, running, sigchld):
+        """Return the timeout for the next poll, None to block"""
+        timeouts = []
+        now = time.time()
+        for state in running:
+            timeout = state['run']._timeout_check()
+            if timeout is not None:
+                timeouts.append(timeout)
+            if state['loop']:
+                timeouts.append(state['last'] + state['run'].LOOP_TIMEOUT_MAIN - now)
+            if state['fd'] is None and sigchld is None:
+                ## no way to get notified of the exit
+                timeouts.append(RunLoop.LOOP_TIMEOUT_INIT)
+        if timeouts:
+            return max(min(timeouts), 0)
+        else:
+            return None
+
+    def _run(self):
+        """The main loop, generator of results"""
+        cmds = iter(self.cmds)
+        exhausted = False
+        nr_started = 0
+
+        running = []
+        by_fd = {}
+        done = {}  ## results by idx, for ordered
+        next_idx = 0
+
+        sigchld = SigChldPipe()
+        poller = select.poll()
+        if sigchld.start():
+            poller.register(sigchld.fileno(), select.POLLIN)
+        else:
+            self.log.debug("_run: no SIGCHLD handler (not main thread?)")
+            sigchld = None
+
+        try:
+            while True:
+                while not exhausted and len(running) < self.max_workers:
+                    try:
+                        cmd = cmds.next()
+                    except StopIteration:
+                        exhausted = True
+                        break
+                    state = self._start(nr_started, cmd)
+                    nr_started += 1
+                    running.append(state)
+                    if state['fd'] is not None:
+                        by_fd[state['fd']] = state
+                        poller.register(state['fd'], select.POLLIN | select.POLLPRI)
+
+                if not running:
+                    break
+
+                for event_fd, _ in poll_eintr(poller, self._poll_timeout(running, sigchld)):
+                    if event_fd in by_fd:
+                        state = by_fd[event_fd]
+                        output = state['run']._read_process_event()
+                        if len(output) == 0:
+                            ## EOF
+                            poller.unregister(event_fd)
+                            del by_fd[event_fd]
+                            state['fd'] = None
+                        else:
+                            self._output(state, output)
+                    else:
+                        sigchld.drain()
+
+                now = time.time()
+                for state in running[:]:
+                    if state['loop'] and state['fd'] is not None and \
+                            now - state['last'] >= state['run'].LOOP_TIMEOUT_MAIN:
+                        ## loop without output
+                        self._output(state, '')
+
+                    if state['fd'] is not None and state['run']._timeout_abandoned:
+                        ## like EOF
+                        poller.unregister(state['fd'])
+                        del by_fd[state['fd']]
+                        state['fd'] = None
+
+                    if state['fd'] is not None:
+                        ## wait for EOF first
+                        continue
+                    ec = state['run']._process_poll()
+                    if ec is None:
+                        continue
+
+                    running.remove(state)
+                    result = self._finish(state, ec)
+                    if self.ordered:
+                        done[state['idx']] = result
+                        while next_idx in done:
+                            yield done.pop(next_idx)
+                            next_idx += 1
+                    else:
+                        yield result
+        finally:
+            ## the iteration was stopped early (or failed): no children are left behind
+            self._kill_running(running)
+            if sigchld is not None:
+                sigchld.stop()
+
+    def _kill_running(self, running):
+        """Kill (SIGKILL) and reap the processes that are still running"""
+        for state in running:
+            r = state['run']
+            if r._process_poll() is None:
+                self.log.warning("_kill_running: killing cmd %s (pool stopped)" % (r.cmd,))
+                r._kill(signal.SIGKILL)
+                ## no timeout handling anymore, just wait for the exit
+                r._timeout_deadline = None
+                r._process_poll(block=True)
+            if r._process.stdout is not None:
+                r._process.stdout.close()
+
 ## convenient names
 ## eg: from vsc.utils.run import trivial
 
@@ -723,6 +1863,8 @@ run_simple_noworries = RunNoWorries.run
 
 run_async = RunAsync.run
 
+run_pool = RunPool.run
+
 run_to_file = RunFile.run
 run_async_to_stdout = RunAsyncLoopStdout.run
 
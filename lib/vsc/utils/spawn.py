@@ -0,0 +1,286 @@
+##
+# Copyright 2012 Ghent University
+# Copyright 2012 Stijn De Weirdt
+#
+# This file is part of VSC-tools,
+# originally created by the HPC team of Ghent University (http://ugent.be/hpc/en),
+# with support of Ghent University (http://ugent.be/hpc),
+# the Flemish Supercomputer Centre (VSC) (https://vscentrum.be/nl/en),
+# the Hercules foundation (http://www.herculesstichting.be/in_English)
+# and the Department of Economy, Science and Innovation (EWI) (http://www.ewi-vlaanderen.be/en).
+#
+# http://github.com/hpcugent/VSC-tools
+#
+# VSC-tools is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation v2.
+#
+# VSC-tools is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with VSC-tools. If not, see <http://www.gnu.org/licenses/>.
+##
+
+"""
+Start processes with C{posix_spawnp} instead of C{fork}/C{exec}.
+    - Based on C{spawn.h}, see man page of C{posix_spawn}
+    - glibc implements it with C{vfork} semantics (C{CLONE_VM|CLONE_VFORK}): the page tables of the parent
+      are not copied, so the cost of starting a process does not grow with the RSS of the parent
+    - the file descriptors are closed with a single C{closefrom} action (or one close action per open fd),
+      not by trying all fds up to C{MAXFD} like C{subprocess} with C{close_fds=True}
+    - provides a C{Popen} class with the subset of the C{subprocess.Popen} API used by L{vsc.utils.run}
+"""
+
+import ctypes
+import errno
+import fcntl
+import os
+import signal
+from ctypes.util import find_library
+from subprocess import PIPE, STDOUT
+
+_libc_lib = find_library('c')
+_libc = ctypes.CDLL(_libc_lib, use_errno=True)
+
+HAVE_POSIX_SPAWN = hasattr(_libc, 'posix_spawnp')
+## glibc 2.34+
+HAVE_CLOSEFROM = hasattr(_libc, 'posix_spawn_file_actions_addclosefrom_np')
+## glibc 2.29+
+HAVE_CHDIR = hasattr(_libc, 'posix_spawn_file_actions_addchdir_np')
+
+##define POSIX_SPAWN_SETPGROUP    0x02
+##define POSIX_SPAWN_SETSIGDEF    0x04
+##define POSIX_SPAWN_SETSIGMASK   0x08
+##define POSIX_SPAWN_USEVFORK     0x40
+POSIX_SPAWN_SETPGROUP = 0x02
+POSIX_SPAWN_SETSIGDEF = 0x04
+POSIX_SPAWN_SETSIGMASK = 0x08
+POSIX_SPAWN_USEVFORK = 0x40
+
+## the structs are opaque; these sizes are larger than the glibc ones (80 and 336 bytes on x86_64)
+#typedef struct { int __allocated; int __used; struct __spawn_action *__actions; int __pad[16]; }
+#        posix_spawn_file_actions_t;
+#typedef struct { short int __flags; pid_t __pgrp; sigset_t __sd; sigset_t __ss; ... } posix_spawnattr_t;
+class posix_spawn_file_actions_t(ctypes.Structure):
+    """Opaque posix_spawn_file_actions_t"""
+    _fields_ = [('__opaque', ctypes.c_char * 128)]
+
+
+class posix_spawnattr_t(ctypes.Structure):
+    """Opaque posix_spawnattr_t"""
+    _fields_ = [('__opaque', ctypes.c_char * 512)]
+
+
+class sigset_t(ctypes.Structure):
+    """Opaque sigset_t (1024 bits)"""
+    _fields_ = [('__val', ctypes.c_ulong * (1024 / (8 * ctypes.sizeof(ctypes.c_ulong))))]
+
+
+pid_t = ctypes.c_int
+
+
+def _check(ec, name):
+    """posix_spawn functions return the errno, they do not set it"""
+    if ec != 0:
+        raise OSError(ec, "%s: %s" % (name, os.strerror(ec)))
+
+
+def _cstrings(strings):
+    """Return NULL terminated char *[] array"""
+    arr = (ctypes.c_char_p * (len(strings) + 1))()
+    arr[:-1] = strings
+    arr[-1] = None
+    return arr
+
+
+def _open_fds():
+    """Return list of open fds, None if unknown"""
+    try:
+        return [int(fd) for fd in os.listdir('/proc/self/fd')]
+    except OSError:
+        return None
+
+
+def _is_cloexec(fd):
+    """Return True if fd has FD_CLOEXEC set (or is not open anymore, like the fd of the /proc/self/fd listing)"""
+    try:
+        return bool(fcntl.fcntl(fd, fcntl.F_GETFD) & fcntl.FD_CLOEXEC)
+    except IOError:
+        return True
+
+
+def _set_cloexec(fd):
+    """Set FD_CLOEXEC on fd"""
+    fcntl.fcntl(fd, fcntl.F_SETFD, fcntl.fcntl(fd, fcntl.F_GETFD) | fcntl.FD_CLOEXEC)
+
+
+def _pipe():
+    """Return pipe (read, write) with FD_CLOEXEC, both fds > 2
+        (the dup2 to the standard fds in the child clears the FD_CLOEXEC)
+    """
+    fds = []
+    for fd in os.pipe():
+        if fd < 3:
+            newfd = fcntl.fcntl(fd, fcntl.F_DUPFD, 3)
+            os.close(fd)
+            fd = newfd
+        _set_cloexec(fd)
+        fds.append(fd)
+    return fds
+
+
+class Popen(object):
+    """Subset of subprocess.Popen, started with posix_spawnp
+        - stdin, stdout and stderr can be None, PIPE, a fd or a file object (and STDOUT for stderr)
+        - with shell=True, the args are run with executable (default /bin/sh) -c
+        - pgroup: if not None, the child is put in process group pgroup (0 creates a new group)
+    """
+    def __init__(self, args, stdin=None, stdout=None, stderr=None, close_fds=False, shell=False,
+                 executable=None, cwd=None, env=None, pgroup=None):
+        if not HAVE_POSIX_SPAWN:
+            raise OSError(errno.ENOSYS, "posix_spawnp not available")
+
+        if isinstance(args, basestring):
+            args = [args]
+        else:
+            args = list(args)
+
+        if shell:
+            if executable is None:
+                executable = '/bin/sh'
+            args = [executable, '-c'] + args
+        elif executable is None:
+            executable = args[0]
+
+        self.args = args
+        self.pid = None
+        self.returncode = None
+        self.stdin = None
+        self.stdout = None
+        self.stderr = None
+
+        ## fds to close in the parent after the spawn, parent ends of the pipes
+        child_fds = []
+        parent_fds = {}
+
+        fa = posix_spawn_file_actions_t()
+        attr = posix_spawnattr_t()
+        _check(_libc.posix_spawn_file_actions_init(ctypes.byref(fa)), 'posix_spawn_file_actions_init')
+        _check(_libc.posix_spawnattr_init(ctypes.byref(attr)), 'posix_spawnattr_init')
+        try:
+            for childfd, spec in ((0, stdin), (1, stdout), (2, stderr)):
+                if spec is None:
+                    continue
+                elif spec == PIPE:
+                    (rfd, wfd) = _pipe()
+                    if childfd == 0:
+                        (fd, parent_fds[childfd]) = (rfd, wfd)
+                    else:
+                        (parent_fds[childfd], fd) = (rfd, wfd)
+                    child_fds.append(fd)
+                elif spec == STDOUT:
+                    fd = 1
+                elif isinstance(spec, (int, long)):
+                    fd = spec
+                else:
+                    fd = spec.fileno()
+                _check(_libc.posix_spawn_file_actions_adddup2(ctypes.byref(fa), fd, childfd),
+                       'posix_spawn_file_actions_adddup2')
+
+            if close_fds:
+                if HAVE_CLOSEFROM:
+                    _check(_libc.posix_spawn_file_actions_addclosefrom_np(ctypes.byref(fa), 3),
+                           'posix_spawn_file_actions_addclosefrom_np')
+                else:
+                    ## glibc ignores EBADF for close actions, so fds closed in the meantime are harmless
+                    for fd in _open_fds() or []:
+                        if fd > 2 and not _is_cloexec(fd):
+                            _check(_libc.posix_spawn_file_actions_addclose(ctypes.byref(fa), fd),
+                                   'posix_spawn_file_actions_addclose')
+
+            if cwd is not None:
+                if not HAVE_CHDIR:
+                    raise OSError(errno.ENOSYS, "posix_spawn_file_actions_addchdir_np not available")
+                _check(_libc.posix_spawn_file_actions_addchdir_np(ctypes.byref(fa), cwd),
+                       'posix_spawn_file_actions_addchdir_np')
+
+            ## python ignores SIGPIPE, the child should get the default action
+            flags = POSIX_SPAWN_USEVFORK | POSIX_SPAWN_SETSIGDEF
+            sigdef = sigset_t()
+            _libc.sigemptyset(ctypes.byref(sigdef))
+            _libc.sigaddset(ctypes.byref(sigdef), signal.SIGPIPE)
+            _check(_libc.posix_spawnattr_setsigdefault(ctypes.byref(attr), ctypes.byref(sigdef)),
+                   'posix_spawnattr_setsigdefault')
+            if pgroup is not None:
+                flags |= POSIX_SPAWN_SETPGROUP
+                _check(_libc.posix_spawnattr_setpgroup(ctypes.byref(attr), pid_t(pgroup)),
+                       'posix_spawnattr_setpgroup')
+            _check(_libc.posix_spawnattr_setflags(ctypes.byref(attr), ctypes.c_short(flags)),
+                   'posix_spawnattr_setflags')
+
+            if env is None:
+                env = os.environ
+            envp = _cstrings(["%s=%s" % (k, v) for k, v in env.items()])
+            argv = _cstrings(args)
+
+            pid = pid_t()
+            _check(_libc.posix_spawnp(ctypes.byref(pid), executable, ctypes.byref(fa), ctypes.byref(attr),
+                                      argv, envp), 'posix_spawnp %s' % executable)
+            self.pid = pid.value
+        except:
+            for fd in parent_fds.values():
+                os.close(fd)
+            raise
+        finally:
+            for fd in child_fds:
+                os.close(fd)
+            _libc.posix_spawn_file_actions_destroy(ctypes.byref(fa))
+            _libc.posix_spawnattr_destroy(ctypes.byref(attr))
+
+        if 0 in parent_fds:
+            self.stdin = os.fdopen(parent_fds[0], 'wb')
+        if 1 in parent_fds:
+            self.stdout = os.fdopen(parent_fds[1], 'rb')
+        if 2 in parent_fds:
+            self.stderr = os.fdopen(parent_fds[2], 'rb')
+
+    def _handle_exitstatus(self, sts):
+        """Set returncode like subprocess: negative signal number if the child was killed"""
+        if os.WIFSIGNALED(sts):
+            self.returncode = -os.WTERMSIG(sts)
+        else:
+            self.returncode = os.WEXITSTATUS(sts)
+
+    def poll(self):
+        """Return returncode, None if the child is still running"""
+        if self.returncode is None:
+            try:
+                (pid, sts) = os.waitpid(self.pid, os.WNOHANG)
+                if pid == self.pid:
+                    self._handle_exitstatus(sts)
+            except OSError, err:
+                if err.errno == errno.ECHILD:
+                    ## someone else reaped the child
+                    self.returncode = 0
+                else:
+                    raise
+        return self.returncode
+
+    def wait(self):
+        """Wait for the child to terminate, return returncode"""
+        while self.returncode is None:
+            try:
+                (pid, sts) = os.waitpid(self.pid, 0)
+                if pid == self.pid:
+                    self._handle_exitstatus(sts)
+            except OSError, err:
+                if err.errno == errno.EINTR:
+                    continue
+                elif err.errno == errno.ECHILD:
+                    self.returncode = 0
+                else:
+                    raise
+        return self.returncode
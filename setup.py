@@ -41,7 +41,7 @@ PACKAGE = {
     'provides': ['python-vsc-packages-common = 0.5',
                  'python-vsc-packages-logging = 0.14',
                  'python-vsc-packages-utils = 0.11'],
-    'scripts': ['bin/logdaemon.py', 'bin/startlogdaemon.sh'],
+    'scripts': ['bin/logdaemon.py', 'bin/startlogdaemon.sh', 'bin/nagiosdaemon.py'],
 }
 
 if __name__ == '__main__':
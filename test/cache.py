@@ -28,13 +28,16 @@ Unit tests for vsc.utils.cache
 """
 
 import os
+import shutil
 import tempfile
 import time
 import sys
+import zlib
 from paycheck import with_checker, irange
 from unittest import TestCase, TestLoader, main
 
-from vsc.utils.cache import FileCache
+from vsc.utils.cache import CacheEviction, FileCache, FileCacheJournal, FileCacheIndexed, FileCacheSharded, FileLock
+from vsc.utils.cache import JsonSerializer, MarshalSerializer, PickleSerializer, Serializer
 
 
 class TestCache(TestCase):
@@ -82,6 +85,324 @@ class TestCache(TestCase):
 
         os.unlink(filename)
 
+    def test_journal(self):
+        """Updates survive without close, the journal is replayed and compacted"""
+        filename = os.path.join(tempfile.mkdtemp(), 'cache')
+        cache = FileCacheJournal(filename, retain_old=True)
+        for key in range(10):
+            cache.update(key, 'value %s' % key, 0)
+        ## no close: the updates are in the journal
+        cache = FileCacheJournal(filename, retain_old=True)
+        self.assertEqual(cache.load(3)[1], 'value 3')
+        cache.update(3, 'new', 0)
+
+        ## partial record at the end (crash during an update) is skipped, without lock the journal is not changed
+        journal = filename + FileCacheJournal.JOURNAL_SUFFIX
+        f = open(journal, 'ab')
+        f.write('\x00\x00\x01\x00garbage')
+        f.close()
+        size = os.path.getsize(journal)
+        cache = FileCacheJournal(filename)
+        self.assertEqual(os.path.getsize(journal), size)
+        self.assertEqual(cache.load(3)[1], 'new')
+        self.assertEqual(len(cache.shelf), 10)
+        ## the records appended after it are replayed
+        cache.update(4, 'kept', 0)
+        cache.close()
+        self.assertEqual(FileCacheJournal(filename, retain_old=True).load(4)[1], 'kept')
+
+        ## without retain_old, only the updated keys are kept
+        cache = FileCacheJournal(filename)
+        self.assertEqual(cache.shelf.keys(), [4])
+        cache.update(5, 'five', 0)
+        cache.compact()
+        self.assertFalse(os.path.exists(filename + FileCacheJournal.JOURNAL_SUFFIX))
+
+        ## the snapshot is a FileCache file
+        cache = FileCache(filename)
+        self.assertEqual(cache.load(4)[1], 'kept')
+        self.assertEqual(cache.load(5)[1], 'five')
+
+        ## compact on open when the journal is large, only with lock (truncating a partial record too)
+        cache = FileCacheJournal(filename, retain_old=True)
+        for key in range(100):
+            cache.update(key, key, 0)
+        f = open(journal, 'ab')
+        f.write('\x00\x00\x01\x00garbage')
+        f.close()
+        size = os.path.getsize(journal)
+        FileCacheJournal.COMPACT_MIN_SIZE = 0
+        try:
+            cache = FileCacheJournal(filename, retain_old=True)
+            self.assertEqual(os.path.getsize(journal), size)
+            cache = FileCacheJournal(filename, retain_old=True, lock=True)
+        finally:
+            FileCacheJournal.COMPACT_MIN_SIZE = 1024 * 1024
+        self.assertFalse(os.path.exists(journal))
+        self.assertEqual(FileCache(filename).load(99)[1], 99)
+
+        cache = FileCacheJournal(filename, retain_old=True)
+        cache.update(1, 'one', 0)
+        size = os.path.getsize(journal)
+        f = open(journal, 'ab')
+        f.write('\x00\x00\x01\x00garbage')
+        f.close()
+        cache = FileCacheJournal(filename, retain_old=True, lock=True)
+        self.assertEqual(os.path.getsize(journal), size)
+        self.assertEqual(cache.load(1)[1], 'one')
+        shutil.rmtree(os.path.dirname(filename))
+
+    @with_checker({int: int}, irange(0, sys.maxint))
+    def test_indexed_save_and_load(self, data, threshold):
+        """Check if the loaded data is the same as the saved data, also for retained data."""
+        (handle, filename) = tempfile.mkstemp()
+        os.close(handle)
+        os.unlink(filename)
+        cache = FileCacheIndexed(filename)
+        for (key, value) in data.items():
+            cache.update(key, value, threshold)
+        cache.close()
+
+        cache = FileCacheIndexed(filename, retain_old=True)
+        cache.update('new', 'value', 0)
+        cache.close()
+
+        new_cache = FileCacheIndexed(filename)
+        for key in data.keys():
+            self.assertEqual(new_cache.load(key)[1], data[key])
+        self.assertEqual(new_cache.load('new')[1], 'value')
+        self.assertEqual(new_cache.load('missing'), None)
+        new_cache.close()
+        os.unlink(filename)
+
+    def test_indexed_lazy(self):
+        """Only the used values are unpickled, FileCache files can be read"""
+        (handle, filename) = tempfile.mkstemp()
+        os.close(handle)
+        os.unlink(filename)
+        cache = FileCache(filename)
+        for key in range(100):
+            cache.update(key, 'value %s' % key, 0)
+        cache.close()
+
+        ## convert
+        cache = FileCacheIndexed(filename, retain_old=True)
+        self.assertEqual(cache.load(1)[1], 'value 1')
+        cache.close()
+
+        cache = FileCacheIndexed(filename, retain_old=True)
+        self.assertEqual(len(cache.shelf), 100)
+        self.assertEqual(cache.load(42)[1], 'value 42')
+        self.assertEqual(cache.shelf.values.keys(), [42])
+        cache.close()
+
+        ## load after close, like FileCache
+        self.assertEqual(cache.load(43)[1], 'value 43')
+        self.assertEqual(cache.load('missing'), None)
+        os.unlink(filename)
+
+    def test_lock_merge(self):
+        """Concurrent writers with lock do not lose each others updates"""
+        tmpdir = tempfile.mkdtemp()
+        for klass in [FileCache, FileCacheIndexed]:
+            filename = os.path.join(tmpdir, klass.__name__)
+            cache = klass(filename, lock=True)
+            cache.update('old', 'old', 0)
+            cache.update('shared', 'first', 0)
+            cache.close()
+
+            first = klass(filename, lock=True, lock_timeout=10)
+            second = klass(filename, lock=True, lock_timeout=10)
+            first.update('first', 1, 0)
+            second.update('second', 2, 0)
+            second.update('shared', 'second', 0)
+            second.close()
+            first.close()
+
+            cache = klass(filename)
+            self.assertEqual(cache.load('first')[1], 1)
+            self.assertEqual(cache.load('second')[1], 2)
+            self.assertEqual(cache.load('shared')[1], 'second')
+            ## not updated by anyone
+            self.assertEqual(cache.load('old'), None)
+            cache.close()
+
+        ## lock timeout
+        filename = os.path.join(tmpdir, 'timeout')
+        lock = FileLock(filename + FileCache.LOCK_SUFFIX)
+        lock.acquire()
+        start = time.time()
+        self.assertRaises(IOError, FileCache, filename, lock=True, lock_timeout=0.2)
+        self.assertTrue(time.time() - start < 2)
+        lock.release()
+        shutil.rmtree(tmpdir)
+
+    def test_lock_processes(self):
+        """Many processes updating the same cache do not lose updates"""
+        tmpdir = tempfile.mkdtemp()
+        for klass in [FileCache, FileCacheIndexed, FileCacheJournal]:
+            filename = os.path.join(tmpdir, klass.__name__)
+            pids = []
+            for idx in range(8):
+                pid = os.fork()
+                if pid == 0:
+                    try:
+                        for step in range(5):
+                            cache = klass(filename, retain_old=True, lock=True)
+                            cache.update((idx, step), step, 0)
+                            cache.close()
+                    finally:
+                        os._exit(0)
+                pids.append(pid)
+            for pid in pids:
+                os.waitpid(pid, 0)
+            cache = klass(filename, lock=True)
+            self.assertEqual(len(cache.shelf), 8 * 5)
+            cache.close()
+        shutil.rmtree(tmpdir)
+
+    def test_eviction(self):
+        """LRU, size and TTL eviction, and the counters"""
+        tmpdir = tempfile.mkdtemp()
+        for klass in [FileCache, FileCacheIndexed, FileCacheJournal]:
+            filename = os.path.join(tmpdir, klass.__name__)
+            cache = klass(filename, retain_old=True, eviction=CacheEviction(max_entries=10))
+            for key in range(100):
+                cache.update(key, key, 0)
+                if key > 0:
+                    ## keep 0 recently used
+                    cache.load(0)
+            ## incremental: never more than the slack above the limit
+            self.assertTrue(cache._count <= 11)
+            self.assertEqual(cache.load(0)[1], 0)
+            self.assertEqual(cache.load(50), None)
+            self.assertEqual(cache.stats['misses'], 1)
+            self.assertTrue(cache.stats['hits'] >= 100)
+            cache.close()
+
+            cache = klass(filename, retain_old=True)
+            self.assertEqual(sorted(cache.shelf.keys()), [0] + range(91, 100))
+            cache.close()
+
+            ## size
+            cache = klass(filename, retain_old=True, eviction=CacheEviction(max_bytes=1000))
+            cache.update('big', 'x' * 800, 0)
+            cache.update('bigger', 'x' * 900, 0)
+            cache.close()
+            cache = klass(filename, retain_old=True)
+            self.assertEqual(cache.load('big'), None)
+            self.assertEqual(cache.load('bigger')[1], 'x' * 900)
+            cache.close()
+
+            ## ttl, based on the stored timestamp
+            cache = klass(filename, retain_old=True, eviction=CacheEviction(ttl=3600))
+            cache.new_shelf['old'] = (time.time() - 7200, 'old')
+            self.assertEqual(cache.load('old'), None)
+            self.assertEqual(cache.stats['evictions'], 1)
+            self.assertEqual(cache.load('bigger')[1], 'x' * 900)
+            cache.close()
+        shutil.rmtree(tmpdir)
+
+    def test_serializers(self):
+        """Store and load with every serializer, and open the file without knowing the serializer"""
+        tmpdir = tempfile.mkdtemp()
+        data = {
+            'a': {'x': [1, 2, 3], 'y': 'value'},
+            ('host', 1): [1.5, 'b'],
+        }
+        for klass in [FileCache, FileCacheJournal, FileCacheIndexed]:
+            for serializer in [None, PickleSerializer(), MarshalSerializer(), JsonSerializer()]:
+                filename = os.path.join(tmpdir, 'cache')
+                cache = klass(filename, serializer=serializer)
+                for (key, value) in data.items():
+                    cache.update(key, value, 0)
+                cache.close()
+
+                cache = klass(filename)
+                for (key, value) in data.items():
+                    self.assertEqual(cache.load(key)[1], value)
+                cache.close()
+                for name in os.listdir(tmpdir):
+                    os.unlink(os.path.join(tmpdir, name))
+
+        ## marshal does not support instances
+        cache = FileCache(os.path.join(tmpdir, 'cache'), serializer=MarshalSerializer())
+        cache.update('now', object(), 0)
+        self.assertRaises(Exception, cache.close)
+        shutil.rmtree(tmpdir)
+
+        ## a serializer has to implement dumps and loads
+        class HalfSerializer(Serializer):
+            TAG = 'half'
+
+            def dumps(self, obj):
+                return repr(obj)
+
+        self.assertRaises(TypeError, Serializer)
+        self.assertRaises(TypeError, HalfSerializer)
+
+    def test_sharded(self):
+        """Sharded cache: only the used shards are read and written, parallel compaction"""
+        tmpdir = tempfile.mkdtemp()
+        for klass in [FileCache, FileCacheJournal, FileCacheIndexed]:
+            dirname = os.path.join(tmpdir, klass.__name__)
+            cache = FileCacheSharded(dirname, shards=16, shard_class=klass)
+            for idx in range(1000):
+                cache.update(('user', idx), idx, 0)
+            cache.close()
+
+            ## the number of shards is kept
+            cache = FileCacheSharded(dirname, retain_old=True, shard_class=klass)
+            self.assertEqual(cache.shards, 16)
+            self.assertEqual(cache.load(('user', 10))[1], 10)
+            cache.update(('user', 2000), 2000, 0)
+            self.assertEqual(len(cache._shards), 2)
+            cache.close()
+
+            cache = FileCacheSharded(dirname, shard_class=klass)
+            for idx in range(1000) + [2000]:
+                self.assertEqual(cache.load(('user', idx))[1], idx)
+            cache.close()
+
+            ## discard: the unused shards are removed
+            cache = FileCacheSharded(dirname, shard_class=klass)
+            cache.update('new', 'data', 0)
+            cache.close()
+            shards = set([name.split('.')[1] for name in os.listdir(dirname)
+                          if name.startswith(FileCacheSharded.SHARD_PREFIX) and not name.endswith('.lock')])
+            self.assertEqual(shards, set(['%04d' % cache.shard_index('new')]))
+
+            ## parallel compaction applies the eviction policy
+            cache = FileCacheSharded(dirname, shard_class=klass)
+            for idx in range(100):
+                cache.update(idx, idx, 0)
+            cache.close()
+            cache = FileCacheSharded(dirname, shard_class=klass, eviction=CacheEviction(max_entries=2))
+            cache.compact(processes=4)
+            cache = FileCacheSharded(dirname, retain_old=True, shard_class=klass)
+            found = [idx for idx in range(100) if cache.load(idx) is not None]
+            self.assertEqual(len(found), 2 * 16)
+            cache.close()
+
+        ## equal keys are in the same shard
+        cache = FileCacheSharded(os.path.join(tmpdir, 'keys'), shards=256)
+        for (key, other) in [('a', u'a'), ('caf\xc3\xa9', u'caf\xe9'), (1, 1L), (1, 1.0), (1, True),
+                             (('user', 1), (u'user', 1L)), (('a',), (u'a',))]:
+            self.assertEqual(cache.shard_index(key), cache.shard_index(other))
+        ## the same shards as before for str, int and tuple keys
+        self.assertEqual(cache.shard_index(('user', 1)), (zlib.crc32(repr(('user', 1))) & 0xffffffff) % 256)
+        cache.update('a', 'str', 0)
+        cache.close()
+        cache = FileCacheSharded(os.path.join(tmpdir, 'keys'))
+        self.assertEqual(cache.load(u'a')[1], 'str')
+        cache.update(u'a', 'unicode', 0)
+        cache.close()
+        cache = FileCacheSharded(os.path.join(tmpdir, 'keys'))
+        self.assertEqual(cache.load('a')[1], 'unicode')
+        self.assertEqual(len(cache._shards), 1)
+        cache.close()
+        shutil.rmtree(tmpdir)
+
 def suite():
     """ return all the tests"""
     return TestLoader().loadTestsFromTestCase(TestCache)
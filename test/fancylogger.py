@@ -0,0 +1,407 @@
+##
+# Copyright 2012 Ghent University
+# Copyright 2012 Jens Timmerman
+#
+# This file is part of VSC-tools,
+# originally created by the HPC team of Ghent University (http://ugent.be/hpc/en),
+# with support of Ghent University (http://ugent.be/hpc),
+# the Flemish Supercomputer Centre (VSC) (https://vscentrum.be/nl/en),
+# the Hercules foundation (http://www.herculesstichting.be/in_English)
+# and the Department of Economy, Science and Innovation (EWI) (http://www.ewi-vlaanderen.be/en).
+#
+# http://github.com/hpcugent/VSC-tools
+#
+# VSC-tools is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation v2.
+#
+# VSC-tools is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with VSC-tools. If not, see <http://www.gnu.org/licenses/>.
+##
+"""
+Unit tests for vsc.fancylogger
+"""
+import logging
+import logging.handlers
+import os
+import shutil
+import socket
+import tempfile
+import threading
+import time
+from StringIO import StringIO
+from unittest import TestCase, TestLoader, main
+
+from vsc import fancylogger
+from vsc.fancylogger import AsyncHandler, BatchedDatagramDecoder, BatchedDatagramHandler
+from vsc.fancylogger import BatchedStreamDecoder, BatchedStreamHandler
+
+from test.utils import handler_logger
+
+
+class BlockingHandler(logging.Handler):
+    """Handler that keeps the messages, and blocks on the first record until released"""
+
+    def __init__(self):
+        logging.Handler.__init__(self)
+        self.messages = []
+        self.threads = []
+        self.started = threading.Event()
+        self.unblock = threading.Event()
+
+    def emit(self, record):
+        self.started.set()
+        self.unblock.wait()
+        self.messages.append(record.getMessage())
+        self.threads.append(record.threadname)
+
+
+class FancyLoggerTest(TestCase):
+    """Tests for fancylogger"""
+
+    def test_async(self):
+        """Records are handled in order in the background thread, with the message formatted when logged"""
+        target = BlockingHandler()
+        target.unblock.set()
+        handler = AsyncHandler([target])
+        logger = handler_logger('test_async', handler)
+
+        data = ['before']
+        logger.info("data %s", data)
+        data[0] = 'after'
+        for idx in range(100):
+            logger.debug("record %s", idx)
+        handler.flush()
+        self.assertEqual(target.messages, ["data ['before']"] + ["record %s" % idx for idx in range(100)])
+        self.assertEqual(set(target.threads), set([fancylogger.thread_name()]))
+        handler.close()
+
+    def test_async_shared_record(self):
+        """The other handlers of the logger get the record as it was logged"""
+        target = BlockingHandler()
+        target.unblock.set()
+        handler = AsyncHandler([target])
+        other = logging.handlers.BufferingHandler(10)
+        logger = handler_logger('test_async_shared_record', handler)
+        logger.addHandler(other)
+        try:
+            raise ValueError('boom')
+        except ValueError:
+            logger.exception("data %s", 'x')
+        handler.close()
+        self.assertEqual(target.messages, ["data x"])
+        self.assertEqual((other.buffer[0].msg, other.buffer[0].args), ("data %s", ('x',)))
+        self.assertTrue(other.buffer[0].exc_info is not None)
+
+    def test_async_shutdown(self):
+        """logging.shutdown closes the targets after the queue is handled, also the ones added later"""
+        handler = AsyncHandler()
+        target = BlockingHandler()
+        target.closed = False
+        target.close = lambda: setattr(target, 'closed', True)
+        handler.addTarget(target)
+        logger = handler_logger('test_async_shutdown', handler)
+        for idx in range(10):
+            logger.info("record %s", idx)
+        target.started.wait()
+
+        ## the handlers in the order logging.shutdown would close them
+        refs = [ref for ref in logging._handlerList if ref() in (handler, target)]
+        self.assertEqual([ref() for ref in refs], [handler])
+        threading.Timer(0.1, target.unblock.set).start()
+        logging.shutdown(refs)
+        self.assertEqual(target.messages, ["record %s" % idx for idx in range(10)])
+        self.assertTrue(target.closed)
+
+        ## removed targets are closed by logging.shutdown again
+        handler = AsyncHandler([target])
+        self.assertFalse(target in [ref() for ref in logging._handlerList])
+        handler.removeTarget(target)
+        self.assertTrue(target in [ref() for ref in logging._handlerList])
+        handler.close()
+
+    def test_async_overflow(self):
+        """Overflow policies when the queue is full"""
+        for (overflow, expected) in [
+            (AsyncHandler.OVERFLOW_DROP, range(10)),
+            (AsyncHandler.OVERFLOW_DROP_OLDEST, range(20, 30)),
+        ]:
+            target = BlockingHandler()
+            handler = AsyncHandler([target], maxsize=10, overflow=overflow)
+            logger = handler_logger('test_async_overflow', handler)
+
+            ## the thread blocks on the first record
+            logger.info("first")
+            target.started.wait()
+            for idx in range(30):
+                logger.info("%s", idx)
+            self.assertEqual(handler.dropped, 20)
+
+            target.unblock.set()
+            handler.flush()
+            self.assertEqual(target.messages, ["first", "AsyncHandler dropped 20 records (queue full)"] +
+                             ["%s" % idx for idx in expected])
+            handler.close()
+
+        self.assertRaises(ValueError, AsyncHandler, [], overflow='nosuchpolicy')
+
+    def test_logasync(self):
+        """logAsync moves the handlers to the background thread, also the ones added later"""
+        tmpdir = tempfile.mkdtemp()
+        logfile = os.path.join(tmpdir, 'log')
+        name = 'test_logasync'
+        stream = StringIO()
+        logger = handler_logger(name, logging.StreamHandler(stream))
+
+        handler = fancylogger.logAsync(name=name)
+        self.assertEqual(logger.handlers, [handler])
+        filehandler = fancylogger.logToFile(logfile, name=name)
+        self.assertEqual(len(handler.targets), 2)
+
+        logger.info("message")
+        logger.streamInfo("stream data\n")
+        fancylogger.logAsync(enable=False, name=name)
+        self.assertEqual(len(logger.handlers), 2)
+        self.assertFalse(handler in logger.handlers)
+        self.assertEqual(stream.getvalue().splitlines(), ["message", "stream data"])
+        self.assertTrue(open(logfile).read().endswith("message\nstream data\n"))
+
+        fancylogger.logToFile(logfile, enable=False, filehandler=filehandler, name=name)
+        filehandler.close()
+        shutil.rmtree(tmpdir)
+
+    def test_getlogger_names(self):
+        """The root module name is the same everywhere, fname uses the calling function"""
+        root = fancylogger.getRootLoggerName()
+        self.assertTrue(root.startswith(fancylogger.LOGGER_NAME))
+        self.assertEqual(fancylogger.getLogger('name').name, "%s.name" % root)
+        self.assertEqual(fancylogger.getLogger('name', fname=True).name, "%s.name.test_getlogger_names" % root)
+
+        names = []
+        thread = threading.Thread(target=lambda: names.append(fancylogger.getRootLoggerName()))
+        thread.start()
+        thread.join()
+        self.assertEqual(names, [root])
+
+    def _receive(self, sock):
+        """Return all datagrams received on sock"""
+        datagrams = []
+        sock.settimeout(0.5)
+        try:
+            while True:
+                datagrams.append(sock.recvfrom(65535))
+        except socket.timeout:
+            pass
+        return datagrams
+
+    def test_batched_udp(self):
+        """Batched records over UDP, with compression, fragments and lost datagrams"""
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.bind(('127.0.0.1', 0))
+        port = sock.getsockname()[1]
+
+        for compress in [False, True]:
+            handler = BatchedDatagramHandler('127.0.0.1', port, compress=compress, max_size=1024)
+            logger = handler_logger('test_batched_udp', handler)
+            messages = ["record %s" % idx for idx in range(100)] + ['x' * 5000]
+            for message in messages:
+                logger.info(message)
+            try:
+                raise ValueError('boom')
+            except ValueError:
+                logger.exception('exception')
+            handler.close()
+
+            datagrams = self._receive(sock)
+            self.assertTrue(len(datagrams) < len(messages))
+            self.assertTrue(max([len(datagram) for (datagram, _) in datagrams]) <= 1024 + 20)
+            decoder = BatchedDatagramDecoder()
+            records = []
+            for (datagram, address) in datagrams:
+                records.extend(decoder.decode(datagram, address))
+            self.assertEqual([record['msg'] for record in records], messages + ['exception'])
+            self.assertTrue('ValueError: boom' in records[-1]['exc_text'])
+            self.assertEqual(decoder.lost, 0)
+            self.assertEqual(records[0]['threadname'], fancylogger.thread_name())
+
+            ## losing a datagram loses its records (all of a fragmented batch), and is detected
+            header = BatchedDatagramHandler.DATAGRAM_HEADER
+            parts = [header.unpack(datagram[:header.size])[-1] for (datagram, _) in datagrams]
+            if compress:
+                self.assertEqual(max(parts), 1)
+                drop = 1
+            else:
+                drop = [idx for (idx, part) in enumerate(parts) if part > 1][0]
+            decoder = BatchedDatagramDecoder()
+            lossy = []
+            for (datagram, address) in datagrams[:drop] + datagrams[drop + 1:]:
+                lossy.extend([record['msg'] for record in decoder.decode(datagram, address)])
+            self.assertEqual(decoder.lost, 1)
+            self.assertTrue(len(lossy) < len(records))
+            self.assertEqual([msg for msg in messages + ['exception'] if msg in lossy], lossy)
+            if not compress:
+                self.assertFalse(messages[-1] in lossy)
+
+        ## the batch is sent after the interval
+        handler = BatchedDatagramHandler('127.0.0.1', port, max_size=1024, interval=0.1)
+        logger = handler_logger('test_batched_udp', handler)
+        logger.info("alone")
+        datagrams = self._receive(sock)
+        self.assertEqual(len(datagrams), 1)
+        self.assertEqual(BatchedDatagramDecoder().decode(datagrams[0][0])[0]['msg'], "alone")
+        handler.close()
+
+        ## one flusher thread per handler, also in a forked child (which does not send the batch of the parent)
+        handler = BatchedDatagramHandler('127.0.0.1', port, max_size=2048, interval=0.1)
+        logger = handler_logger('test_batched_udp', handler)
+        logger.info("first")
+        threads = threading.activeCount()
+        for idx in range(20):
+            logger.info("record %s" % idx)
+        self.assertEqual(threading.activeCount(), threads)
+        self._receive(sock)
+        logger.info("parent")
+        pid = os.fork()
+        if pid == 0:
+            try:
+                logger.info("child")
+                time.sleep(0.3)
+            finally:
+                os._exit(0)
+        os.waitpid(pid, 0)
+        header = BatchedDatagramHandler.DATAGRAM_HEADER
+        streams = {}
+        for (datagram, _) in self._receive(sock):
+            streams[BatchedDatagramDecoder().decode(datagram)[0]['msg']] = header.unpack(datagram[:header.size])
+        self.assertEqual(sorted(streams.keys()), ['child', 'parent'])
+        (parent, child) = (streams['parent'], streams['child'])
+        self.assertNotEqual(parent[3], child[3])
+        self.assertEqual(child[4], 0)
+        handler.close()
+
+        ## a plain DatagramHandler record
+        handler = logging.handlers.DatagramHandler('127.0.0.1', port)
+        logger = handler_logger('test_batched_udp', handler)
+        logger.info("plain")
+        datagrams = self._receive(sock)
+        self.assertEqual(BatchedDatagramDecoder().decode(datagrams[0][0])[0]['msg'], "plain")
+        handler.close()
+        sock.close()
+
+    def _accept(self, server):
+        """Accept a connection on server, return all it sends until it is closed"""
+        (conn, _) = server.accept()
+        chunks = []
+        for chunk in iter(lambda: conn.recv(4096), ''):
+            chunks.append(chunk)
+        conn.close()
+        return ''.join(chunks)
+
+    def test_stream(self):
+        """Batched records over a unix socket (also while there is no connection), and from a plain SocketHandler"""
+        tmpdir = tempfile.mkdtemp()
+        path = os.path.join(tmpdir, 'socket')
+
+        ## no daemon yet: the frames are queued, the oldest dropped
+        handler = BatchedStreamHandler(path, max_size=1024, max_queue=4096)
+        logger = handler_logger('test_stream', handler)
+        messages = ["record %s" % idx for idx in range(200)]
+        for message in messages:
+            logger.info(message)
+        handler.flush()
+        self.assertTrue(handler.dropped > 0)
+        self.assertTrue(0 < handler.queued <= 4096)
+
+        server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        server.bind(path)
+        server.listen(1)
+        handler.retryTime = None
+        logger.info("connected")
+        try:
+            raise ValueError('boom')
+        except ValueError:
+            logger.exception('exception')
+        handler.close()
+        self.assertEqual(handler.queued, 0)
+
+        ## fed in small pieces
+        data = self._accept(server)
+        decoder = BatchedStreamDecoder()
+        records = []
+        for idx in range(0, len(data), 100):
+            records.extend(decoder.feed(data[idx:idx + 100]))
+        self.assertEqual(decoder.pending(), 0)
+        msgs = [record['msg'] for record in records]
+        self.assertEqual(msgs[0], "BatchedStreamHandler dropped %s records (no connection)" % handler.dropped)
+        self.assertEqual(msgs[1:], messages[handler.dropped:] + ['connected', 'exception'])
+        self.assertTrue('ValueError: boom' in records[-1]['exc_text'])
+        self.assertEqual(records[-2]['threadname'], fancylogger.thread_name())
+
+        ## compressed, the batch is sent after the interval
+        handler = BatchedStreamHandler(path, compress=True, interval=0.1)
+        logger = handler_logger('test_stream', handler)
+        logger.info("alone")
+        (conn, _) = server.accept()
+        data = conn.recv(4096)
+        self.assertEqual([record['msg'] for record in BatchedStreamDecoder().feed(data)], ['alone'])
+        handler.close()
+        conn.close()
+
+        ## one flusher thread per handler, also in a forked child (with its own connection)
+        server.settimeout(5)
+        handler = BatchedStreamHandler(path, interval=0.1)
+        logger = handler_logger('test_stream', handler)
+        logger.info("first")
+        handler.flush()
+        (conn, _) = server.accept()
+        threads = threading.activeCount()
+        for idx in range(20):
+            logger.info("record %s" % idx)
+        self.assertEqual(threading.activeCount(), threads)
+        logger.info("parent")
+        pid = os.fork()
+        if pid == 0:
+            try:
+                logger.info("child")
+                time.sleep(0.3)
+            finally:
+                os._exit(0)
+        os.waitpid(pid, 0)
+        handler.close()
+        data = ''.join(iter(lambda: conn.recv(4096), ''))
+        conn.close()
+        msgs = [record['msg'] for record in BatchedStreamDecoder().feed(data)]
+        self.assertEqual(msgs, ['first'] + ["record %s" % idx for idx in range(20)] + ['parent'])
+        self.assertEqual([record['msg'] for record in BatchedStreamDecoder().feed(self._accept(server))], ['child'])
+
+        server.close()
+
+        ## a plain SocketHandler, over tcp
+        server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        server.bind(('127.0.0.1', 0))
+        server.listen(1)
+        handler = logging.handlers.SocketHandler('127.0.0.1', server.getsockname()[1])
+        logger = handler_logger('test_stream', handler)
+        logger.info("plain 1")
+        logger.info("plain 2")
+        handler.close()
+        decoder = BatchedStreamDecoder()
+        self.assertEqual([record['msg'] for record in decoder.feed(self._accept(server))], ['plain 1', 'plain 2'])
+        self.assertEqual(decoder.frames, 2)
+
+        server.close()
+        shutil.rmtree(tmpdir)
+
+
+def suite():
+    """ return all the tests"""
+    return TestLoader().loadTestsFromTestCase(FancyLoggerTest)
+
+
+if __name__ == '__main__':
+    main()  # unittest.main
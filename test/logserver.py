@@ -0,0 +1,222 @@
+##
+# Copyright 2012 Ghent University
+# Copyright 2012 Jens Timmerman
+#
+# This file is part of VSC-tools,
+# originally created by the HPC team of Ghent University (http://ugent.be/hpc/en),
+# with support of Ghent University (http://ugent.be/hpc),
+# the Flemish Supercomputer Centre (VSC) (https://vscentrum.be/nl/en),
+# the Hercules foundation (http://www.herculesstichting.be/in_English)
+# and the Department of Economy, Science and Innovation (EWI) (http://www.ewi-vlaanderen.be/en).
+#
+# http://github.com/hpcugent/VSC-tools
+#
+# VSC-tools is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation v2.
+#
+# VSC-tools is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with VSC-tools. If not, see <http://www.gnu.org/licenses/>.
+##
+"""
+Unit tests for vsc.utils.logserver
+"""
+import logging
+import logging.handlers
+import os
+import shutil
+import socket
+import tempfile
+import threading
+import time
+from unittest import TestCase, TestLoader, main
+
+from vsc import fancylogger
+from vsc.fancylogger import BatchedDatagramHandler, BatchedStreamHandler
+from vsc.utils.logserver import LogServer, StreamLogServer
+
+from test.utils import handler_logger
+
+
+class SlowStreamLogServer(StreamLogServer):
+    """StreamLogServer with a slow writer"""
+    MAX_QUEUED_BATCHES = 1
+
+    def _write_batch(self, batch):
+        time.sleep(0.01)
+        StreamLogServer._write_batch(self, batch)
+
+
+class LogServerTest(TestCase):
+    """Tests for the LogServer"""
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.logfile = os.path.join(self.tmpdir, 'log.log')
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.bind(('127.0.0.1', 0))
+        self.port = self.sock.getsockname()[1]
+
+    def tearDown(self):
+        self.sock.close()
+        shutil.rmtree(self.tmpdir)
+
+    def _wait(self, server, thread, records):
+        """Wait until server has written records records, and stop it"""
+        start = time.time()
+        while server.stats['records'] < records and time.time() - start < 10:
+            time.sleep(0.05)
+        server.stop()
+        thread.join()
+
+    def test_serve(self):
+        """Plain and batched records are written to a single file"""
+        server = LogServer(self.sock, self.logfile)
+        thread = threading.Thread(target=server.serve)
+        thread.start()
+
+        handler = BatchedDatagramHandler('127.0.0.1', self.port, compress=True)
+        logger = handler_logger('test_serve', handler)
+        for idx in range(500):
+            logger.info("batched %s" % idx)
+        handler.close()
+
+        handler = logging.handlers.DatagramHandler('127.0.0.1', self.port)
+        logger = handler_logger('test_serve_plain', handler)
+        logger.warning("plain")
+        handler.close()
+
+        ## a plain logger does not have the fancylogger fields
+        handler = logging.handlers.DatagramHandler('127.0.0.1', self.port)
+        plain = logging.getLogger('test_serve_nonfancy')
+        plain.handlers = [handler]
+        plain.propagate = False
+        plain.error("nonfancy")
+        handler.close()
+
+        self.sock.sendto('garbage', ('127.0.0.1', self.port))
+
+        self._wait(server, thread, 502)
+        lines = open(self.logfile).read().splitlines()
+        self.assertEqual(len(lines), 502)
+        batched = [line for line in lines if 'batched' in line]
+        self.assertEqual([line.split()[-1] for line in batched], [str(idx) for idx in range(500)])
+        self.assertTrue('test_serve_plain' in [line for line in lines if line.endswith('plain')][0])
+        self.assertTrue(lines[-1].endswith('nonfancy'))
+
+        stats = server.stats
+        self.assertEqual(stats['records'], 502)
+        self.assertEqual(stats['errors'], 1)
+        self.assertEqual(stats['dropped'], 0)
+        self.assertEqual(stats['lost'], 0)
+        self.assertEqual(stats['bytes_written'], os.path.getsize(self.logfile))
+        self.assertTrue(stats['received'] >= 4)
+        self.assertTrue('records=502' in server.stats_line())
+        self.assertEqual(server.files, {})
+
+    def test_split(self):
+        """One file per MPI rank, with a limited number of open files"""
+        server = LogServer(self.sock, self.logfile, split=LogServer.SPLIT_RANK)
+        server.MAX_OPEN_FILES = 2
+        thread = threading.Thread(target=server.serve)
+        thread.start()
+
+        handler = BatchedDatagramHandler('127.0.0.1', self.port)
+        logger = handler_logger('test_split', handler)
+        ranks = [0, 1, 2, 3]
+        for idx in range(40):
+            rank = ranks[idx % len(ranks)]
+            record = logger.makeRecord(logger.name, logging.INFO, __file__, 0, "rank %s" % rank, (), None)
+            record.mpirank = rank
+            handler.handle(record)
+        handler.close()
+
+        self._wait(server, thread, 40)
+        for rank in ranks:
+            lines = open("%s.rank%s" % (self.logfile, rank)).read().splitlines()
+            self.assertEqual(len(lines), 10)
+            self.assertTrue(all([line.endswith("rank %s" % rank) for line in lines]))
+        self.assertFalse(os.path.exists(self.logfile))
+
+        ## by host
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.bind(('127.0.0.1', 0))
+        server = LogServer(sock, self.logfile, split=LogServer.SPLIT_HOST)
+        thread = threading.Thread(target=server.serve)
+        thread.start()
+        handler = BatchedDatagramHandler('127.0.0.1', sock.getsockname()[1])
+        handler_logger('test_split_host', handler).info('from localhost')
+        handler.close()
+        self._wait(server, thread, 1)
+        sock.close()
+        self.assertTrue(open("%s.127.0.0.1" % self.logfile).read().endswith('from localhost\n'))
+
+        self.assertRaises(ValueError, LogServer, self.sock, self.logfile, split='user')
+
+    def test_stream(self):
+        """Records of many connections, over tcp and a unix socket, are not lost when the writer is slow"""
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.bind(('127.0.0.1', 0))
+        server = SlowStreamLogServer(sock, self.logfile, split=LogServer.SPLIT_RANK)
+        thread = threading.Thread(target=server.serve)
+        thread.start()
+
+        ## an incomplete frame
+        conn = socket.create_connection(sock.getsockname())
+        conn.sendall(BatchedStreamHandler.FRAME_HEADER.pack(BatchedStreamHandler.MAGIC, 1, 0, 100) + 'x' * 10)
+        conn.close()
+
+        handlers = [BatchedStreamHandler('127.0.0.1', sock.getsockname()[1], max_size=4096) for _ in range(3)]
+        for (rank, handler) in enumerate(handlers):
+            logger = handler_logger('test_stream_%s' % rank, handler)
+            for idx in range(2000):
+                record = logger.makeRecord(logger.name, logging.INFO, __file__, 0, "%s %s" % (rank, idx), (), None)
+                record.mpirank = rank
+                handler.handle(record)
+        for handler in handlers:
+            handler.close()
+            self.assertEqual(handler.dropped, 0)
+
+        self._wait(server, thread, 6000)
+        sock.close()
+        for rank in range(3):
+            lines = open("%s.rank%s" % (self.logfile, rank)).read().splitlines()
+            self.assertEqual([line.split()[-1] for line in lines], [str(idx) for idx in range(2000)])
+        self.assertEqual(server.stats['records'], 6000)
+        self.assertEqual(server.stats['dropped'], 0)
+        self.assertEqual(server.stats['accepted'], 4)
+        self.assertEqual(server.stats['connections'], 0)
+        self.assertEqual(server.stats['errors'], 1)
+        self.assertEqual(server.decoders, {})
+
+        ## unix socket, with logToUnixSocket
+        path = os.path.join(self.tmpdir, 'socket')
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.bind(path)
+        server = StreamLogServer(sock, self.logfile, split=LogServer.SPLIT_HOST)
+        thread = threading.Thread(target=server.serve)
+        thread.start()
+        handler = fancylogger.logToUnixSocket(path, name='test_stream_unix')
+        logger = fancylogger.getLogger('test_stream_unix')
+        logger.propagate = False
+        logger.warning('over a unix socket')
+        handler.flush()
+        self._wait(server, thread, 1)
+        fancylogger.logToUnixSocket(path, enable=False, streamhandler=handler, name='test_stream_unix')
+        handler.close()
+        sock.close()
+        self.assertTrue(open("%s.local" % self.logfile).read().endswith('over a unix socket\n'))
+
+
+def suite():
+    """ return all the tests"""
+    return TestLoader().loadTestsFromTestCase(LogServerTest)
+
+
+if __name__ == '__main__':
+    main()  # unittest.main
@@ -28,6 +28,11 @@
 Tests for the vsc.utils.nagios module.
 """
 import os
+import shutil
+import signal
+import socket
+import stat
+import subprocess
 import tempfile
 import time
 import sys
@@ -37,7 +42,8 @@ import StringIO
 from paycheck import with_checker, irange
 from unittest import TestCase, TestLoader, main
 
-from vsc.utils.nagios import NagiosReporter, NAGIOS_EXIT_OK, NAGIOS_EXIT_WARNING, NAGIOS_EXIT_CRITICAL, NAGIOS_EXIT_UNKNOWN
+from vsc.utils.nagios import NagiosReporter, NagiosMultiReporter, NagiosResultServer, NagiosPassiveSpooler
+from vsc.utils.nagios import NagiosResult, NagiosRange, batch_perfdata, evaluate_ranges, numpy, NAGIOS_EXIT_OK, NAGIOS_EXIT_WARNING, NAGIOS_EXIT_CRITICAL, NAGIOS_EXIT_UNKNOWN
 from pwd import getpwuid
 
 class TestNagios(TestCase):
@@ -121,6 +127,216 @@ class TestNagios(TestCase):
 
         os.unlink(filename)
 
+    def _report(self, func, *args):
+        """Return the exit code and output of the report function"""
+        old_stdout = sys.stdout
+        buffer = StringIO.StringIO()
+        sys.stdout = buffer
+        code = None
+        try:
+            func(*args)
+        except SystemExit, err:
+            code = err.code
+        sys.stdout = old_stdout
+        return (code, buffer.getvalue().rstrip())
+
+    def test_multi(self):
+        """Test the reporter with many checks in one cache file."""
+        (handle, filename) = tempfile.mkstemp()
+        os.close(handle)
+        os.unlink(filename)
+
+        reporter = NagiosMultiReporter('test_multi', filename, 60, self.nagios_user)
+        reporter.add('disk', NAGIOS_EXIT_OK, 'disk ok')
+        reporter.add('load', NAGIOS_EXIT_WARNING, 'load high')
+        reporter.cache()
+        ## another script adds its check to the same file
+        reporter = NagiosMultiReporter('test_multi', filename, 60, self.nagios_user)
+        reporter.add('mem', NAGIOS_EXIT_CRITICAL, 'mem low')
+        reporter.cache()
+
+        reader = NagiosMultiReporter('test_multi', filename, 60, self.nagios_user)
+        self.assertEqual(reader.checks(), ['disk', 'load', 'mem'])
+        self.assertEqual(self._report(reader.report_and_exit, 'load'), (NAGIOS_EXIT_WARNING[0], 'WARNING load high'))
+        self.assertEqual(self._report(reader.report_and_exit, 'disk'), (NAGIOS_EXIT_OK[0], 'OK disk ok'))
+        (code, output) = self._report(reader.report_and_exit, 'nosuchcheck')
+        self.assertEqual(code, NAGIOS_EXIT_UNKNOWN[0])
+
+        (code, output) = self._report(reader.report_all_and_exit)
+        self.assertEqual(code, NAGIOS_EXIT_CRITICAL[0])
+        self.assertEqual(output.split('\n'), ['CRITICAL test_multi 3 checks', 'disk: OK disk ok',
+                                               'load: WARNING load high', 'mem: CRITICAL mem low'])
+
+        ## too old results are unknown
+        reader = NagiosMultiReporter('test_multi', filename, 1, self.nagios_user)
+        time.sleep(1.1)
+        (code, output) = self._report(reader.report_and_exit, 'disk')
+        self.assertEqual(code, NAGIOS_EXIT_UNKNOWN[0])
+        self.assertTrue(output.startswith('UNKNOWN test_multi result of check disk too old'))
+
+        os.unlink(filename)
+        os.unlink(filename + '.lock')
+
+    def test_server(self):
+        """Test the resident result server and its client."""
+        tmpdir = tempfile.mkdtemp()
+        filename = os.path.join(tmpdir, 'cache')
+        socket_path = os.path.join(tmpdir, 'socket')
+        reporter = NagiosReporter('test_server', filename, 60, self.nagios_user)
+        reporter.cache(NAGIOS_EXIT_WARNING, 'first')
+
+        ## the socket is not world writable, unless asked for
+        server = NagiosResultServer(socket_path, {'test': reporter}, os.path.join(tmpdir, 'pid'), socket_mode=0666)
+        server.bind()
+        self.assertEqual(stat.S_IMODE(os.stat(socket_path).st_mode), 0666)
+        server.socket_.close()
+
+        server = NagiosResultServer(socket_path, {'test': reporter}, os.path.join(tmpdir, 'pid'))
+        server.bind()
+        self.assertEqual(stat.S_IMODE(os.stat(socket_path).st_mode), 0660)
+        pid = os.fork()
+        if pid == 0:
+            try:
+                server.run()
+            finally:
+                os._exit(0)
+        server.socket_.close()
+
+        client = os.path.join(os.path.dirname(__file__), '..', 'bin', 'nagiosdaemon.py')
+
+        def check(name):
+            proc = subprocess.Popen([sys.executable, client, 'check', name, socket_path], stdout=subprocess.PIPE)
+            output = proc.communicate()[0]
+            return (proc.returncode, output.rstrip())
+
+        try:
+            self.assertEqual(check('test'), (NAGIOS_EXIT_WARNING[0], 'WARNING first'))
+            ## a new result is picked up
+            time.sleep(0.01)
+            reporter.cache(NAGIOS_EXIT_CRITICAL, 'second')
+            self.assertEqual(check('test'), (NAGIOS_EXIT_CRITICAL[0], 'CRITICAL second'))
+            (code, output) = check('nosuchreporter')
+            self.assertEqual(code, NAGIOS_EXIT_UNKNOWN[0])
+
+            ## a client that stalls does not delay the others, and is disconnected after CLIENT_TIMEOUT
+            stalled = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            stalled.connect(socket_path)
+            start = time.time()
+            other = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            other.connect(socket_path)
+            other.sendall('test\n')
+            self.assertEqual(other.recv(1024), '%d CRITICAL second\n' % NAGIOS_EXIT_CRITICAL[0])
+            self.assertTrue(time.time() - start < NagiosResultServer.CLIENT_TIMEOUT / 2.0)
+            other.close()
+            stalled.settimeout(5)
+            self.assertEqual(stalled.recv(1024), '')
+            stalled.close()
+        finally:
+            os.kill(pid, signal.SIGTERM)
+            os.waitpid(pid, 0)
+
+        ## no server
+        (code, output) = check('test')
+        self.assertEqual(code, NAGIOS_EXIT_UNKNOWN[0])
+        self.assertTrue(output.startswith('UNKNOWN nagios result server unavailable'))
+        shutil.rmtree(tmpdir)
+
+    def test_passive(self):
+        """Test the passive check result spooler."""
+        tmpdir = tempfile.mkdtemp()
+
+        ## command file, flushed per 2 results
+        command_file = os.path.join(tmpdir, 'nagios.cmd')
+        open(command_file, 'w').close()
+        spooler = NagiosPassiveSpooler(command_file=command_file, max_results=2)
+        spooler.add('node1', 'disk', NAGIOS_EXIT_OK, NagiosResult('disk ok', used=10))
+        self.assertEqual(open(command_file).read(), '')
+        spooler.add('node1', None, NAGIOS_EXIT_CRITICAL, 'down\nreally')
+        spooler.add('node2', 'load', NAGIOS_EXIT_WARNING, 'load high')
+        self.assertEqual(len(open(command_file).readlines()), 2)
+        spooler.close()
+        lines = [line.split(' ', 1)[1] for line in open(command_file).read().splitlines()]
+        self.assertEqual(lines, ['PROCESS_SERVICE_CHECK_RESULT;node1;disk;0;disk ok | used=10;;;',
+                                 'PROCESS_HOST_CHECK_RESULT;node1;2;down\\nreally',
+                                 'PROCESS_SERVICE_CHECK_RESULT;node2;load;1;load high'])
+        self.assertEqual(spooler.stats, {'results': 3, 'flushes': 2})
+
+        ## FIFO, in chunks of whole lines
+        fifo = os.path.join(tmpdir, 'nagios.fifo')
+        os.mkfifo(fifo)
+        spooler = NagiosPassiveSpooler(command_file=fifo)
+        spooler.add('node1', 'disk', NAGIOS_EXIT_OK, 'ok')
+        self.assertRaises(Exception, spooler.flush)  # no reader
+        reader = os.open(fifo, os.O_RDONLY | os.O_NONBLOCK)
+        for idx in range(200):
+            spooler.add('node%s' % idx, 'disk', NAGIOS_EXIT_OK, 'ok')
+        spooler.close()
+        data = ''
+        while True:
+            try:
+                chunk = os.read(reader, 65536)
+            except OSError:
+                break
+            if not chunk:
+                break
+            data += chunk
+        os.close(reader)
+        self.assertEqual(len(data.splitlines()), 201)
+
+        ## check result directory
+        checkresult_dir = os.path.join(tmpdir, 'checkresults')
+        os.mkdir(checkresult_dir)
+        spooler = NagiosPassiveSpooler(checkresult_dir=checkresult_dir)
+        spooler.add('node1', 'disk', NAGIOS_EXIT_WARNING, 'disk full')
+        spooler.add('node2', None, NAGIOS_EXIT_OK, 'up')
+        self.assertEqual(os.listdir(checkresult_dir), [])
+        spooler.close()
+        names = sorted(os.listdir(checkresult_dir))
+        self.assertEqual(len(names), 2)
+        self.assertEqual(names[0] + '.ok', names[1])
+        self.assertTrue(names[0].startswith('c'))
+        spool = open(os.path.join(checkresult_dir, names[0])).read()
+        self.assertEqual(spool.count('### Nagios Service Check Result ###'), 1)
+        self.assertEqual(spool.count('### Nagios Host Check Result ###'), 1)
+        self.assertTrue('host_name=node1\nservice_description=disk\n' in spool)
+        self.assertTrue('return_code=1\noutput=disk full\n' in spool)
+
+        shutil.rmtree(tmpdir)
+
+    def test_ranges(self):
+        """Test the nagios ranges and the batch perfdata."""
+        for (nrange, alerts, ok) in [
+            ('10', [-1, 11], [0, 5, 10]),
+            ('10:', [9.9, -5], [10, 1000]),
+            ('~:20', [21], [-1000, 20]),
+            ('5:10', [4, 11], [5, 10]),
+            ('@5:10', [5, 7, 10], [4, 11]),
+        ]:
+            for value in alerts:
+                self.assertTrue(NagiosRange(nrange).alert(value), "%s alerts for %s" % (nrange, value))
+            for value in ok:
+                self.assertFalse(NagiosRange(nrange).alert(value), "%s does not alert for %s" % (nrange, value))
+        self.assertRaises(ValueError, NagiosRange, '10:5')
+        self.assertRaises(ValueError, NagiosRange, 'a:b')
+
+        modes = [False]
+        if numpy is not None:
+            modes.append(True)
+        for use_numpy in modes:
+            states = evaluate_ranges([1, 50, 95, 100], warning='~:90', critical='~:99', use_numpy=use_numpy)
+            self.assertEqual(list(states), [0, 0, 1, 2])
+            states = evaluate_ranges([1, 50, 95], warning=['10', '10', None], critical=['@0:1', None, None],
+                                     use_numpy=use_numpy)
+            self.assertEqual(list(states), [2, 1, 0])
+
+            self.assertEqual(batch_perfdata(['home', 'data'], [80, 95], warning='~:90', critical='~:99', uom='%',
+                                            use_numpy=use_numpy),
+                             (NAGIOS_EXIT_WARNING, 'home=80%;~:90;~:99; data=95%;~:90;~:99;'))
+            self.assertEqual(batch_perfdata(['my home', 'data'], [5, 30], warning=['10:', None],
+                                            critical=[None, '20'], use_numpy=use_numpy),
+                             (NAGIOS_EXIT_CRITICAL, "'my home'=5;10:;; data=30;;20;"))
+            self.assertEqual(batch_perfdata([], [], use_numpy=use_numpy), (NAGIOS_EXIT_OK, ''))
+
 
 def suite():
     """ return all the tests"""
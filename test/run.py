@@ -0,0 +1,334 @@
+##
+# Copyright 2012 Ghent University
+# Copyright 2012 Stijn De Weirdt
+#
+# This file is part of VSC-tools,
+# originally created by the HPC team of Ghent University (http://ugent.be/hpc/en),
+# with support of Ghent University (http://ugent.be/hpc),
+# the Flemish Supercomputer Centre (VSC) (https://vscentrum.be/nl/en),
+# the Hercules foundation (http://www.herculesstichting.be/in_English)
+# and the Department of Economy, Science and Innovation (EWI) (http://www.ewi-vlaanderen.be/en).
+#
+# http://github.com/hpcugent/VSC-tools
+#
+# VSC-tools is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation v2.
+#
+# VSC-tools is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with VSC-tools. If not, see <http://www.gnu.org/licenses/>.
+##
+"""
+Unit tests for vsc.utils.run
+"""
+import os
+import shutil
+import signal
+import tempfile
+import time
+from unittest import TestCase, TestLoader, main
+
+from vsc.utils import asyncprocess
+from vsc.utils.run import run_simple, run_pool, run_to_file, Run, RunLoop, RunAsyncLoop, RunNoWorries, RunQA, RunCache
+from vsc.utils.run import RunPool, RunStream, SigChldPipe
+
+
+class TestRun(TestCase):
+    """Tests for the Run classes"""
+
+    def test_simple(self):
+        """Test the simple run"""
+        ec, output = run_simple('echo ok')
+        self.assertEqual(ec, 0)
+        self.assertEqual(output, 'ok\n')
+
+    def test_no_shell(self):
+        """argv mode: no shell expansion, string cmd split with shell quoting, startpath"""
+        for klass in [Run, RunLoop, RunAsyncLoop]:
+            self.assertEqual(klass.run(['echo', 'a  b', '$HOME'], shell=False), (0, 'a  b $HOME\n'))
+            self.assertEqual(klass.run('echo "a  b" \'c\'', shell=False), (0, 'a  b c\n'))
+            self.assertEqual(klass.run(['sh', '-c', 'echo x >&2; exit 3'], shell=False), (3, 'x\n'))
+
+            tmpdir = tempfile.mkdtemp()
+            run = klass(['pwd'], shell=False)
+            run.startpath = tmpdir
+            self.assertEqual(run._run(), (0, '%s\n' % os.path.realpath(tmpdir)))
+            shutil.rmtree(tmpdir)
+
+        ## only the standard fds are inherited (ls has the listing fd open itself)
+        fd = os.open(os.devnull, os.O_RDONLY)
+        ec, output = Run.run(['ls', '/proc/self/fd'], shell=False)
+        os.close(fd)
+        self.assertEqual(output.split(), ['0', '1', '2', '3'])
+
+    def test_cache(self):
+        """Results are reused within the ttl, until the executable changes"""
+        tmpdir = tempfile.mkdtemp()
+        cachedir = os.path.join(tmpdir, 'cache')
+        script = os.path.join(tmpdir, 'probe')
+        counter = os.path.join(tmpdir, 'counter')
+        open(script, 'w').write("#!/bin/sh\necho x >> %s\nwc -l < %s\n" % (counter, counter))
+        os.chmod(script, 0755)
+
+        self.assertEqual(run_simple(script, cache_ttl=60, cache_dir=cachedir), (0, '1\n'))
+        self.assertEqual(run_simple(script, cache_ttl=60, cache_dir=cachedir), (0, '1\n'))
+        self.assertEqual(run_simple(script, cache_ttl=0, cache_dir=cachedir), (0, '2\n'))
+        self.assertEqual(run_simple(script + ' ', cache_ttl=60, cache_dir=cachedir), (0, '3\n'))
+
+        ## a changed executable is a miss
+        os.utime(script, (time.time() + 10, time.time() + 10))
+        self.assertEqual(run_simple(script, cache_ttl=60, cache_dir=cachedir), (0, '4\n'))
+
+        ## eviction of the oldest entries
+        cache = RunCache(dirname=cachedir)
+        cache.MAX_ENTRIES = 2
+        for idx in range(4):
+            cache.set(cache.key('cmd%s' % idx), (0, idx))
+        self.assertEqual(len(os.listdir(cachedir)), 2)
+
+        ## failed commands are only cached with cache_failed
+        open(script, 'w').write("#!/bin/sh\necho x >> %s\nwc -l < %s\nexit 1\n" % (counter, counter))
+        os.utime(script, (time.time() + 20, time.time() + 20))
+        self.assertEqual(RunNoWorries.run(script, cache_ttl=60, cache_dir=cachedir), (1, '5\n'))
+        self.assertEqual(RunNoWorries.run(script, cache_ttl=60, cache_dir=cachedir), (1, '6\n'))
+        self.assertEqual(RunNoWorries.run(script, cache_ttl=60, cache_dir=cachedir, cache_failed=True), (1, '7\n'))
+        self.assertEqual(RunNoWorries.run(script, cache_ttl=60, cache_dir=cachedir, cache_failed=True), (1, '7\n'))
+
+        ## only a private directory of the user is used, not a symlink to it
+        link = os.path.join(tmpdir, 'link')
+        os.symlink(cachedir, link)
+        self.assertFalse(RunCache(dirname=link).usable)
+        os.chmod(cachedir, 0755)
+        self.assertFalse(RunCache(dirname=cachedir).usable)
+        os.chmod(cachedir, 0700)
+        self.assertTrue(RunCache(dirname=cachedir).usable)
+        shutil.rmtree(tmpdir)
+
+    def test_stats(self):
+        """Timing, output and rusage stats of the child"""
+        for klass in [Run, RunLoop, RunAsyncLoop]:
+            run = klass('sleep 0.1; seq 1 1000', log_stats=True)
+            self.assertEqual(run._run()[0], 0)
+            self.assertEqual(run.stats['bytes'], len(''.join(['%s\n' % x for x in range(1, 1001)])))
+            self.assertTrue(run.stats['reads'] > 0)
+            self.assertTrue(0.1 <= run.stats['first_byte'] <= run.stats['wall'])
+            self.assertTrue(run.stats['maxrss'] > 0)
+            for name in ['utime', 'stime', 'nvcsw', 'nivcsw']:
+                self.assertTrue(name in run.stats)
+            if klass is not Run:
+                self.assertTrue(run.stats['loops'] > 0)
+
+        ## the same stats for the runs of a pool
+        runs = [klass('sleep 0.1; seq 1 1000', log_stats=True) for klass in [Run, RunLoop, RunAsyncLoop]]
+        self.assertEqual([x[1] for x in run_pool(runs)], [0] * len(runs))
+        for run in runs:
+            self.assertTrue(0.1 <= run.stats['wall'])
+            for name in ['utime', 'stime', 'maxrss', 'nvcsw', 'nivcsw']:
+                self.assertTrue(name in run.stats)
+
+    def test_timeout(self):
+        """Process group gets SIGTERM and SIGKILL after the timeout, the partial output is returned"""
+        cmd = 'echo start; sleep 10 & sleep 20; echo never'
+        for klass in [Run, RunLoop, RunAsyncLoop]:
+            for run in [klass(cmd, timeout=0.3), klass(['sh', '-c', cmd], shell=False, timeout=0.3)]:
+                start = time.time()
+                self.assertEqual(run._run(), (Run.TIMEOUT_EXITCODE, 'start\n'))
+                self.assertTrue(run.timed_out)
+                ## the background sleep does not keep the output pipe open
+                self.assertTrue(time.time() - start < 5)
+
+        ## SIGTERM is ignored
+        start = time.time()
+        cmd = 'trap "" TERM; echo start; sleep 20'
+        self.assertEqual(RunLoop.run(cmd, timeout=0.2, kill_grace=0.2), (Run.TIMEOUT_EXITCODE, 'start\n'))
+        self.assertTrue(time.time() - start < 5)
+
+        ## a descendant outside the process group keeps the output open: not read after SIGKILL and kill_grace
+        cmd = 'echo start; setsid sleep 10 & sleep 20'
+        for klass in [Run, RunLoop, RunAsyncLoop]:
+            start = time.time()
+            self.assertEqual(klass.run(cmd, timeout=0.3, kill_grace=0.3), (Run.TIMEOUT_EXITCODE, 'start\n'))
+            self.assertTrue(time.time() - start < 3)
+        start = time.time()
+        res = run_pool([cmd], timeout=0.3, kill_grace=0.3)
+        self.assertEqual(res, [(cmd, Run.TIMEOUT_EXITCODE, 'start\n')])
+        self.assertTrue(time.time() - start < 3)
+
+        self.assertEqual(run_simple('echo ok', timeout=5), (0, 'ok\n'))
+
+    def test_loop_event(self):
+        """Event driven loop returns the output and exitcode without the timed sleeps"""
+        for klass in [RunLoop, RunAsyncLoop]:
+            start = time.time()
+            ec, output = klass.run('echo ok; echo nok; exit 2')
+            self.assertTrue(time.time() - start < RunLoop.LOOP_TIMEOUT_INIT)
+            self.assertEqual(ec, 2)
+            self.assertEqual(output, 'ok\nnok\n')
+
+    def test_loop_timed(self):
+        """The timed loop still works"""
+        for klass in [RunLoop, RunAsyncLoop]:
+            ec, output = klass.run('echo ok; exit 3', loop_event=False)
+            self.assertEqual(ec, 3)
+            self.assertEqual(output, 'ok\n')
+
+    def test_stream(self):
+        """Stream the output lines or chunks, exitcode at the end"""
+        cmd = 'echo a; echo -n b; sleep 0.1; echo c; echo -n d; exit 3'
+        for klass in [RunNoWorries, RunLoop]:
+            stream = klass.stream(cmd)
+            self.assertEqual(list(stream), ['a\n', 'bc\n', 'd'])
+            self.assertEqual(stream.exitcode, 3)
+
+            stream = klass.stream(cmd, lines=False)
+            self.assertEqual(''.join(stream), 'a\nbc\nd')
+
+    def test_capture_tail(self):
+        """Only the tail of the output is kept"""
+        for klass in [Run, RunLoop, RunAsyncLoop]:
+            self.assertEqual(klass.run('seq 1 10000', capture_tail_lines=2), (0, '9999\n10000\n'))
+            self.assertEqual(klass.run('seq 1 10000', capture_tail=4), (0, '000\n'))
+
+        tmpdir = tempfile.mkdtemp()
+        filename = os.path.join(tmpdir, 'out')
+        self.assertEqual(run_to_file('seq 1 10000', filename=filename, capture_tail_lines=1), (0, '10000\n'))
+        shutil.rmtree(tmpdir)
+
+    def test_capture_spill(self):
+        """Output beyond the threshold is spilled to file"""
+        tmpdir = tempfile.mkdtemp()
+        expected = ''.join(["%s\n" % x for x in range(1, 10001)])
+        for klass in [Run, RunLoop]:
+            ec, filename = klass.run('seq 1 10000', capture_spill=1024, capture_dir=tmpdir)
+            self.assertEqual(os.path.dirname(filename), tmpdir)
+            self.assertEqual(open(filename).read(), expected)
+
+            self.assertEqual(klass.run('seq 1 10', capture_spill=1024, capture_dir=tmpdir)[1], expected[:21])
+        shutil.rmtree(tmpdir)
+
+    def test_qa(self):
+        """Questions are answered, the most specific question first"""
+        cmd = 'echo -n "your  name?"; read x; echo "got $x"; echo -n "port 12? "; read y; echo "got $y"'
+        qa = {
+            'qa': {'name?': 'no', 'your name?': 'bob'},
+            'qa_std': {r'port (?P<port>\d+)\?': '%(port)s1'},
+        }
+        ec, output = RunQA.run(cmd, qa=qa)
+        self.assertEqual(ec, 0)
+        self.assertEqual(output, 'your  name?got bob\nport 12? got 121\n')
+
+    def test_qa_stream(self):
+        """Questions are answered and the output progress is tracked when the output is streamed"""
+        cmd = 'echo -n "name?"; read x; echo "got $x"; for i in $(seq 10 40); do echo "line $i"; sleep 0.02; done'
+        r = RunQA(cmd, qa={'qa': {'name?': 'bob'}})
+        ## the output of each loop has the same length, but it is new output
+        r.LOOP_MAX_MISS_COUNT = 3
+        stream = RunStream(r)
+        lines = list(stream)
+        self.assertEqual(stream.exitcode, 0)
+        self.assertEqual(lines[0], 'name?got bob\n')
+        self.assertEqual(lines[1:], ["line %s\n" % idx for idx in range(10, 41)])
+        self.assertEqual(r._qa_output_length, len(''.join(lines)))
+
+    def test_qa_window(self):
+        """Questions are only matched in the last max_question_length bytes"""
+        r = RunQA('true', qa={'qa': {'a b c?': 'yes'}}, max_question_length=10)
+        r._loop_initialise()
+        r._qa_window = 'x' * 100 + 'a  b\nc? '
+        self.assertEqual(r._qa_answer(), ('a b c?', 'yes\n'))
+        r._qa_window = r._qa_window[-7:]
+        self.assertEqual(r._qa_answer(), None)
+
+    def test_pool(self):
+        """Commands run in parallel, results in completion or submission order"""
+        cmds = ["sleep 0.%s; echo %s" % (4 - idx, idx) for idx in range(5)]
+        start = time.time()
+        res = run_pool(cmds, max_workers=5)
+        self.assertTrue(time.time() - start < 1)
+        self.assertEqual([x[2] for x in res], ["%s\n" % idx for idx in range(5)[::-1]])
+
+        res = run_pool(cmds, max_workers=2, ordered=True)
+        self.assertEqual(res, [(cmd, 0, "%s\n" % idx) for idx, cmd in enumerate(cmds)])
+
+    def test_pool_run_semantics(self):
+        """Pool keeps runclass, input and startpath"""
+        res = run_pool(['echo ok; exit 1'], runclass=RunNoWorries)
+        self.assertEqual(res, [('echo ok; exit 1', 1, 'ok\n')])
+
+        tmpdir = tempfile.mkdtemp()
+        cwd = os.getcwd()
+        r_path = Run('pwd')
+        r_path.startpath = tmpdir
+        r_input = Run('cat')
+        r_input.input = 'hello'
+        res = run_pool([r_path, r_input, 'pwd'], runclass=RunLoop, ordered=True)
+        self.assertEqual([x[2] for x in res], [os.path.realpath(tmpdir) + '\n', 'hello', cwd + '\n'])
+        self.assertEqual(os.getcwd(), cwd)
+        shutil.rmtree(tmpdir)
+
+    def test_pool_close(self):
+        """Stopping the iteration early kills and reaps the running processes"""
+        runs = [Run('sleep 30'), Run('sleep 31')]
+        pool = iter(RunPool(['sleep 0.1'] + runs, max_workers=3))
+        self.assertEqual(pool.next(), ('sleep 0.1', 0, ''))
+        pool.close()
+        for r in runs:
+            self.assertEqual(r._process.returncode, -signal.SIGKILL)
+            self.assertRaises(OSError, os.kill, r._process.pid, 0)
+
+    def test_sigchld_pipe(self):
+        """The started pipes share one SIGCHLD handler, the last stop restores the original one"""
+        orig = signal.getsignal(signal.SIGCHLD)
+        first = SigChldPipe()
+        second = SigChldPipe()
+        self.assertTrue(first.start())
+        self.assertTrue(second.start())
+        first.stop()
+        run_simple('true')
+        self.assertTrue(os.read(second.fileno(), 1024))
+        second.stop()
+        self.assertEqual(signal.getsignal(signal.SIGCHLD), orig)
+
+    def test_async_recv(self):
+        """recv_some reads at most maxread bytes (tr is ignored), recv_all reads everything"""
+        size = 3 * asyncprocess.READSIZE + 10
+        proc = asyncprocess.Popen(['head', '-c', str(size), '/dev/zero'], stdout=asyncprocess.PIPE)
+        self.assertEqual(asyncprocess.recv_some(proc, t=5, maxread=10), '\0' * 10)
+        data = asyncprocess.recv_some(proc, t=5, tr=5, maxread=asyncprocess.READSIZE + 1)
+        self.assertTrue(0 < len(data) <= asyncprocess.READSIZE + 1)
+        self.assertEqual(len(asyncprocess.recv_all(proc)), size - 10 - len(data))
+        self.assertEqual(asyncprocess.recv_some(proc), '')
+        self.assertRaises(Exception, asyncprocess.recv_some, proc, e=True)
+        proc.wait()
+
+    def test_async_input_unicode(self):
+        """Unicode input is sent utf-8 encoded"""
+        r_input = RunAsyncLoop('cat')
+        r_input.input = u'h\xe9llo'
+        self.assertEqual(r_input._run(), (0, 'h\xc3\xa9llo'))
+
+    def test_pool_input_sigchld(self):
+        """Input is written completely while other children of the pool exit (SIGCHLD)"""
+        data = 'x' * (4 * 1024 * 1024)
+        runs = []
+        for runclass in [Run, RunAsyncLoop]:
+            r_input = runclass('sleep 0.3; wc -c')
+            r_input.input = data
+            runs.append(r_input)
+        cmds = ["sleep 0.%s" % idx for idx in range(3)] + runs
+        res = run_pool(cmds, max_workers=len(cmds), ordered=True)
+        self.assertEqual([x[1] for x in res], [0] * len(cmds))
+        self.assertEqual([int(x[2]) for x in res[-2:]], [len(data)] * 2)
+
+
+def suite():
+    """ return all the tests"""
+    return TestLoader().loadTestsFromTestCase(TestRun)
+
+if __name__ == '__main__':
+    main()
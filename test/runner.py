@@ -3,12 +3,15 @@ import sys
 import os
 import test.cache as tc
 import test.dateandtime as td
+import test.fancylogger as tf
 import test.nagios as tn
 import test.generaloption as tg
+import test.logserver as tl
 import test.nagios_results as tr
+import test.run as trun
 import unittest
 
-suite = unittest.TestSuite([x.suite() for  x in (tc, td, tn, tg, tr)])
+suite = unittest.TestSuite([x.suite() for  x in (tc, td, tf, tn, tg, tl, tr, trun)])
 
 try:
     import xmlrunner